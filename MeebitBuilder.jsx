@@ -78,9 +78,19 @@ function getRarityInfo(count) {
 
 // ─── Rule Engine ────────────────────────────────────────────────────────────
 
+// Decode a base64 string of little-endian uint32 words
+function decodeWords(b64) {
+  const bytes = Uint8Array.from(atob(b64), (c) => c.charCodeAt(0));
+  return new Uint32Array(bytes.buffer);
+}
+
 class RuleEngine {
-  constructor(rules) {
+  // compiled: optional meebits_builder_index.json (precompiled exclusion bitsets)
+  constructor(rules, compiled = null) {
     this.rules = rules;
+    this.compiled = compiled && compiled.version === 2 ? compiled : null;
+    this._contexts = {};
+    this._buildBitsCache = new WeakMap();
     this.typeRules = rules.type_level_rules || {};
     this.perTypePools = rules.per_type_value_pools || {};
     this.colorMappings = rules.color_element_mappings || {};
@@ -104,8 +114,9 @@ class RuleEngine {
     }
 
     // Value exclusion lookup: { "cat=val" -> Set<"cat=val"> }
+    // (not needed when the precompiled bitsets are available)
     this.exclusionIndex = {};
-    for (const ex of this.valueExclusions) {
+    for (const ex of this.compiled ? [] : this.valueExclusions) {
       if (!this.exclusionIndex[ex.trait_a]) this.exclusionIndex[ex.trait_a] = new Set();
       if (!this.exclusionIndex[ex.trait_b]) this.exclusionIndex[ex.trait_b] = new Set();
       this.exclusionIndex[ex.trait_a].add(ex.trait_b);
@@ -157,8 +168,94 @@ class RuleEngine {
       .sort((a, b) => b.count - a.count);
   }
 
+  // Precompiled context for a type/gender: trait IDs plus, for the type-wide
+  // (no gender) context, incompatibility bitsets
+  _compiledContext(type, gender) {
+    if (!this.compiled) return null;
+    const ctxKey = `${type}/${type === "Human" && gender ? gender : ""}`;
+    if (!(ctxKey in this._contexts)) {
+      const raw = (this.compiled.types[type] || {})[type === "Human" && gender ? gender : ""];
+      this._contexts[ctxKey] = raw ? {
+        traits: raw.traits,
+        words: raw.words,
+        ids: new Map(raw.traits.map((t, i) => [t, i])),
+        incompatible: raw.incompatible && decodeWords(raw.incompatible),
+      } : null;
+    }
+    return this._contexts[ctxKey];
+  }
+
+  // Bitset of the build's selected trait IDs, cached per build object
+  _buildBits(ctx, currentBuild) {
+    let perBuild = this._buildBitsCache.get(currentBuild);
+    if (!perBuild) {
+      perBuild = new Map();
+      this._buildBitsCache.set(currentBuild, perBuild);
+    }
+    let bits = perBuild.get(ctx);
+    if (!bits) {
+      bits = new Uint32Array(ctx.words);
+      for (const [bCat, bVal] of Object.entries(currentBuild)) {
+        const id = ctx.ids.get(`${bCat}=${bVal}`);
+        if (id !== undefined) bits[id >>> 5] |= 1 << (id & 31);
+      }
+      perBuild.set(ctx, bits);
+    }
+    return bits;
+  }
+
+  // First selected category that never co-occurs with category, or null
+  _excludedCategory(category, currentBuild) {
+    for (const excCat of this.catExclusionIndex[category] || []) {
+      if (currentBuild[excCat] != null) return excCat;
+    }
+    return null;
+  }
+
+  _checkCompiled(ctx, type, gender, category, value, currentBuild) {
+    if (!ctx.ids.has(`${category}=${value}`)) {
+      const pool = this.perTypePools[type];
+      if (!pool || !pool[category] || !pool[category][value]) {
+        return { available: false, reason: `Not available for ${type} type` };
+      }
+      return { available: false, reason: gender === "male" ? "Female-only trait" : "Male-only trait" };
+    }
+
+    // Category exclusions come first, as in the fallback, and go by presence
+    const blocked = this._excludedCategory(category, currentBuild);
+    if (blocked) {
+      return {
+        available: false,
+        reason: `Can't combine ${CATEGORY_LABELS[category]} with ${CATEGORY_LABELS[blocked]}`,
+      };
+    }
+
+    // Value exclusions against the type-wide context, where every selectable
+    // value of the type (either gender's included) has an ID
+    const all = this._compiledContext(type, null);
+    const bits = this._buildBits(all, currentBuild);
+    const base = all.ids.get(`${category}=${value}`) * all.words;
+    let hit = 0;
+    for (let w = 0; w < all.words && !hit; w++) hit = all.incompatible[base + w] & bits[w];
+    if (!hit) return { available: true, reason: null };
+
+    // Name the first conflicting value in build order, as the fallback does
+    for (const [bCat, bVal] of Object.entries(currentBuild)) {
+      const id = all.ids.get(`${bCat}=${bVal}`);
+      if (id !== undefined && all.incompatible[base + (id >>> 5)] & (1 << (id & 31))) {
+        return {
+          available: false,
+          reason: `Incompatible with ${formatName(bVal)} (${CATEGORY_LABELS[bCat]})`,
+        };
+      }
+    }
+  }
+
   checkTraitAvailability(type, gender, category, value, currentBuild) {
     // Returns { available: bool, reason: string|null }
+    const ctx = this._compiledContext(type, gender);
+    if (ctx) return this._checkCompiled(ctx, type, gender, category, value, currentBuild);
+
     const key = `${category}=${value}`;
 
     // 1. Type-level: is this value in the type's pool?
@@ -179,16 +276,12 @@ class RuleEngine {
     }
 
     // 3. Category exclusions: is this category blocked by a selected category?
-    const excludedCats = this.catExclusionIndex[category];
-    if (excludedCats) {
-      for (const excCat of excludedCats) {
-        if (currentBuild[excCat]) {
-          return {
-            available: false,
-            reason: `Can't combine ${CATEGORY_LABELS[category]} with ${CATEGORY_LABELS[excCat]}`,
-          };
-        }
-      }
+    const blocked = this._excludedCategory(category, currentBuild);
+    if (blocked) {
+      return {
+        available: false,
+        reason: `Can't combine ${CATEGORY_LABELS[category]} with ${CATEGORY_LABELS[blocked]}`,
+      };
     }
 
     // 4. Value exclusions: is this specific value blocked by a selected value?
@@ -225,16 +318,12 @@ class RuleEngine {
     }
 
     // Category exclusions
-    const excludedCats = this.catExclusionIndex[category];
-    if (excludedCats) {
-      for (const excCat of excludedCats) {
-        if (currentBuild[excCat]) {
-          return {
-            disabled: true,
-            reason: `Blocked by ${CATEGORY_LABELS[excCat]} (never co-occur)`,
-          };
-        }
-      }
+    const blocked = this._excludedCategory(category, currentBuild);
+    if (blocked) {
+      return {
+        disabled: true,
+        reason: `Blocked by ${CATEGORY_LABELS[blocked]} (never co-occur)`,
+      };
     }
 
     // Color category: check if element value implies never_has_color
@@ -555,6 +644,7 @@ function BuildSummary({ build, onRemove, onReset }) {
 
 export default function MeebitBuilder() {
   const [rules, setRules] = useState(null);
+  const [compiled, setCompiled] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
 
@@ -562,12 +652,15 @@ export default function MeebitBuilder() {
   const [selectedGender, setSelectedGender] = useState(null);
   const [build, setBuild] = useState({});
 
-  // Load rules
+  // Load rules (the precompiled bitsets are optional)
   useEffect(() => {
-    fetch("/meebits_rules.json")
-      .then(r => r.json())
-      .then(data => {
+    const index = fetch("/meebits_builder_index.json")
+      .then(r => (r.ok ? r.json() : null))
+      .catch(() => null);
+    Promise.all([fetch("/meebits_rules.json").then(r => r.json()), index])
+      .then(([data, compiledIndex]) => {
         setRules(data);
+        setCompiled(compiledIndex);
         setLoading(false);
       })
       .catch(err => {
@@ -578,8 +671,8 @@ export default function MeebitBuilder() {
 
   const ruleEngine = useMemo(() => {
     if (!rules) return null;
-    return new RuleEngine(rules);
-  }, [rules]);
+    return new RuleEngine(rules, compiled);
+  }, [rules, compiled]);
 
   const types = useMemo(() => {
     if (!rules) return {};
@@ -773,6 +773,41 @@ function generateDescription(meebit) {
   return parts.join(" ");
 }
 
+// ─── Columnar Database ──────────────────────────────────────────────────────
+
+const TYPED_ARRAYS = { Uint8Array, Uint16Array, Uint32Array };
+
+// meebits_quiz_columns.json + .bin: dictionary-encoded code columns in one
+// little-endian buffer, viewed in place as typed arrays (code 0 = none)
+async function loadQuizColumns() {
+  const header = await fetch("/meebits_quiz_columns.json").then((r) => {
+    if (!r.ok) throw new Error(`HTTP ${r.status}`);
+    return r.json();
+  });
+  if (header.version !== 1) throw new Error(`Unsupported quiz columns version ${header.version}`);
+  const buffer = await fetch(`/${header.buffer}`).then((r) => {
+    if (!r.ok) throw new Error(`HTTP ${r.status}`);
+    return r.arrayBuffer();
+  });
+
+  const columns = {};
+  const values = {};
+  for (const [name, col] of Object.entries(header.columns)) {
+    columns[name] = new TYPED_ARRAYS[col.array](buffer, col.offset, header.rows);
+    if (col.values) values[name] = col.values;
+  }
+  return { rows: header.rows, columns, values };
+}
+
+// Decode one row of the columnar database into a Meebit object
+function columnRow(db, i) {
+  const meebit = {};
+  for (const [name, codes] of Object.entries(db.columns)) {
+    meebit[name] = db.values[name] ? db.values[name][codes[i]] : codes[i];
+  }
+  return meebit;
+}
+
 // ─── Matching Engine ────────────────────────────────────────────────────────
 
 function buildTraitProfile(answers) {
@@ -801,25 +836,29 @@ function buildTraitProfile(answers) {
   return { profile, preferNone };
 }
 
+// Trait categories scored after type, in scoring order
+const SCORED_TRAITS = [
+  "hair_style", "hair_color", "hat", "hat_color",
+  "beard", "beard_color", "glasses", "glasses_color",
+  "earring", "necklace", "shirt", "shirt_color",
+  "overshirt", "overshirt_color", "pants", "pants_color",
+  "shoes", "shoes_color",
+];
+
+// Moderate boost for rare types (not in denominator)
+const TYPE_RARE_BOOST = { Human: 1.0, Pig: 2.0, Elephant: 3.0, Robot: 4.0, Skeleton: 5.0, Visitor: 6.0, Dissected: 8.0 };
+
 function scoreMeebit(meebit, profile, preferNone) {
   let score = 0;
   let maxPossible = 0;
 
-  const traitCats = [
-    "hair_style", "hair_color", "hat", "hat_color",
-    "beard", "beard_color", "glasses", "glasses_color",
-    "earring", "necklace", "shirt", "shirt_color",
-    "overshirt", "overshirt_color", "pants", "pants_color",
-    "shoes", "shoes_color",
-  ];
-
   // Type scoring — use a fixed importance, no extreme rarity multiplier in denominator
   const typePrefs = profile.type || {};
   if (Object.keys(typePrefs).length > 0) {
     const typeImportance = CATEGORY_IMPORTANCE.type;
     // Score: how well does this meebit's type match preferences?
     // Use moderate boost for rare types (not in denominator)
-    const rareBoost = { Human: 1.0, Pig: 2.0, Elephant: 3.0, Robot: 4.0, Skeleton: 5.0, Visitor: 6.0, Dissected: 8.0 };
+    const rareBoost = TYPE_RARE_BOOST;
     const rawTypeScore = (typePrefs[meebit.type] || 0) * (rareBoost[meebit.type] || 1);
     const maxRawType = Math.max(...Object.entries(typePrefs).map(([t, w]) => w * (rareBoost[t] || 1)));
     score += (rawTypeScore / Math.max(maxRawType, 1)) * typeImportance;
@@ -827,7 +866,7 @@ function scoreMeebit(meebit, profile, preferNone) {
   }
 
   // Trait scoring
-  for (const cat of traitCats) {
+  for (const cat of SCORED_TRAITS) {
     const importance = CATEGORY_IMPORTANCE[cat] || 1.0;
     const meebitVal = meebit[cat] || null;
 
@@ -864,7 +903,90 @@ function scoreMeebit(meebit, profile, preferNone) {
   return maxPossible > 0 ? (score / maxPossible) * 100 : 50;
 }
 
+// Per-code score contributions for one category of the columnar database,
+// mirroring scoreMeebit term for term (a zero entry adds nothing)
+function categoryScores(cat, values, profile, preferNone) {
+  const importance = CATEGORY_IMPORTANCE[cat] || 1.0;
+  const lut = new Float64Array(values.length);
+
+  if (cat === "type") {
+    const typePrefs = profile.type || {};
+    if (Object.keys(typePrefs).length === 0) return null;
+    const maxRawType = Math.max(...Object.entries(typePrefs).map(([t, w]) => w * (TYPE_RARE_BOOST[t] || 1)));
+    values.forEach((v, code) => {
+      const rawTypeScore = (typePrefs[v] || 0) * (TYPE_RARE_BOOST[v] || 1);
+      lut[code] = (rawTypeScore / Math.max(maxRawType, 1)) * importance;
+    });
+    return { lut, importance };
+  }
+
+  if (preferNone.has(cat)) {
+    lut[0] = importance;
+    return { lut, importance };
+  }
+
+  const prefs = profile[cat];
+  if (!prefs || Object.keys(prefs).length === 0) return null;
+
+  if (cat === "tattoo" && prefs._has) {
+    lut.fill(importance, 1);
+    return { lut, importance };
+  }
+
+  const maxWeight = Math.max(...Object.values(prefs));
+  values.forEach((v, code) => {
+    if (v && prefs[v]) lut[code] = (prefs[v] / maxWeight) * importance;
+  });
+  return { lut, importance };
+}
+
+// Score every Meebit at once: one lookup-table gather per category over the
+// code columns, in the same order as scoreMeebit so the floats agree
+function scoreColumns(db, profile, preferNone) {
+  const scores = new Float64Array(db.rows);
+  let maxPossible = 0;
+
+  for (const cat of ["type", ...SCORED_TRAITS]) {
+    const scored = categoryScores(cat, db.values[cat], profile, preferNone);
+    if (!scored) continue;
+    const { lut } = scored;
+    const codes = db.columns[cat];
+    for (let i = 0; i < db.rows; i++) scores[i] += lut[codes[i]];
+    maxPossible += scored.importance;
+  }
+
+  for (let i = 0; i < db.rows; i++) {
+    scores[i] = maxPossible > 0 ? (scores[i] / maxPossible) * 100 : 50;
+  }
+  return scores;
+}
+
+function rankColumns(db, answers) {
+  const { profile, preferNone } = buildTraitProfile(answers);
+  const scores = scoreColumns(db, profile, preferNone);
+
+  // Ties keep database order, like the stable sort in rankMeebits
+  const order = Array.from({ length: db.rows }, (_, i) => i);
+  order.sort((a, b) => scores[b] - scores[a] || a - b);
+
+  // Diversify on codes; only the winners are decoded into Meebit objects
+  const { type, shirt, pants, shoes } = db.columns;
+  const seen = new Set();
+  const results = [];
+  for (const i of order) {
+    if (results.length >= 6) break;
+    const key = `${type[i]}|${shirt[i]}|${pants[i]}|${shoes[i]}`;
+    if (!seen.has(key)) {
+      seen.add(key);
+      results.push({ meebit: columnRow(db, i), score: scores[i] });
+    }
+  }
+
+  return { results, profile, preferNone };
+}
+
 function rankMeebits(database, answers) {
+  if (!Array.isArray(database)) return rankColumns(database, answers);
   const { profile, preferNone } = buildTraitProfile(answers);
 
   const scored = database.map((m) => ({
@@ -1385,8 +1507,9 @@ export default function MeebitQuiz() {
   const [matchProfile, setMatchProfile] = useState(null);
 
   useEffect(() => {
-    fetch("/meebits_quiz_db.json")
-      .then((r) => r.json())
+    // Typed-array columns when exported, else the JSON database
+    loadQuizColumns()
+      .catch(() => fetch("/meebits_quiz_db.json").then((r) => r.json()))
       .then((data) => { setDatabase(data); setDbLoaded(true); })
       .catch((err) => console.error("Failed to load database:", err));
   }, []);
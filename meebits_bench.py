@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Meebits pipeline benchmarks.
+
+Generates rule-conformant corpora of any size from meebits_rules.json (see
+meebits_generate.py), then times and memory-profiles gender inference, the shared indexes and every stage of
+process_meebits.PIPELINE_STAGES on each. Results are written as JSON; given
+a baseline from an earlier run, stages slower than the tolerance are flagged
+and the exit status is 1.
+
+    python meebits_bench.py                                  # 20k, 200k, 2M records
+    python meebits_bench.py --sizes 20000 --stages analyze_value_exclusions
+    python meebits_bench.py --baseline bench_main.json --tolerance 0.2
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import process_meebits
+from meebits_generate import RULES_PATH, MeebitGenerator, load_rules
+from process_meebits import (OUTPUT_DIR, PIPELINE_STAGES, BitmapIndex, ContingencyEngine,
+                             ExportOptions, infer_gender)
+
+BENCH_PATH = "meebits_bench.json"
+BENCH_VERSION = 1
+
+DEFAULT_SIZES = [20_000, 200_000, 2_000_000]
+DEFAULT_TOLERANCE = 0.25
+# Differences below this many seconds are noise, never flagged
+MIN_SECONDS = 0.05
+
+
+def _measure(func, args, memory):
+    """(result, seconds, peak traced bytes or None) of func(*args), console output discarded."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = None
+        if memory:
+            # A second, traced run: tracemalloc slows the code it watches
+            tracemalloc.start()
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def _needed_stages(names):
+    """PIPELINE_STAGES required to run the named stages (all of them if names is empty)."""
+    if not names:
+        return list(PIPELINE_STAGES)
+    producers = {out: st for st in PIPELINE_STAGES for out in st.outputs}
+    wanted = set()
+    todo = [st for st in PIPELINE_STAGES if st.func.__name__ in names]
+    while todo:
+        st = todo.pop()
+        if st.func.__name__ not in wanted:
+            wanted.add(st.func.__name__)
+            todo.extend(producers[name] for name in st.inputs if name in producers)
+    return [st for st in PIPELINE_STAGES if st.func.__name__ in wanted]
+
+
+def bench_corpus(table, stages, memory=True):
+    """Time (and trace peak memory of) each step of the pipeline on table, in order."""
+    timings = {}
+
+    def record(name, func, *args):
+        result, seconds, peak = _measure(func, args, memory)
+        timings[name] = {"seconds": round(seconds, 4)}
+        if peak is not None:
+            timings[name]["peak_bytes"] = peak
+        print(f"  {name:<40} {seconds:9.3f}s" + (f" {peak / 2**20:10.1f} MiB" if peak is not None else ""))
+        return result
+
+    gender_confidence = record("infer_gender", infer_gender, table)[4]
+    context = {"table": table, "export_options": ExportOptions(),
+               "gender_confidence": gender_confidence}
+    needed = {name for st in stages for name in st.inputs}
+    if "engine" in needed:
+        context["engine"] = record("build_engine", lambda: ContingencyEngine(table).build())
+    if "bitmaps" in needed:
+        context["bitmaps"] = record("build_bitmaps", BitmapIndex.build, table)
+
+    for st in stages:
+        result = record(st.func.__name__, st.func, *(context[name] for name in st.inputs))
+        if len(st.outputs) == 1:
+            context[st.outputs[0]] = result
+        else:
+            context.update(zip(st.outputs, result or ()))
+    return timings
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing each stage slower than baseline by more than tolerance; [] if none."""
+    flagged = []
+    for size, corpus in results["corpora"].items():
+        base_corpus = baseline.get("corpora", {}).get(size)
+        if not base_corpus:
+            continue
+        for name, timing in corpus["stages"].items():
+            base = base_corpus["stages"].get(name)
+            if not base:
+                continue
+            slower = timing["seconds"] - base["seconds"]
+            if slower > MIN_SECONDS and timing["seconds"] > base["seconds"] * (1 + tolerance):
+                flagged.append(f"{int(size):>9,} records  {name:<40} {base['seconds']:8.3f}s -> "
+                               f"{timing['seconds']:8.3f}s (+{slower / base['seconds']:.0%})")
+            base_peak, peak = base.get("peak_bytes"), timing.get("peak_bytes")
+            if base_peak and peak and peak > base_peak * (1 + tolerance) and peak - base_peak > 2**20:
+                flagged.append(f"{int(size):>9,} records  {name:<40} {base_peak / 2**20:7.1f} MiB -> "
+                               f"{peak / 2**20:7.1f} MiB (+{(peak - base_peak) / base_peak:.0%})")
+    return flagged
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Meebits pipeline on synthetic corpora")
+    parser.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")], default=DEFAULT_SIZES,
+                        help="comma-separated corpus sizes (default: 20000,200000,2000000)")
+    parser.add_argument("--stages", nargs="+", default=[], metavar="FUNC",
+                        help="only these stage functions (plus the stages they depend on)")
+    parser.add_argument("--seed", type=int, default=0, help="corpus random seed (default: 0)")
+    parser.add_argument("--rules", default=os.path.join(OUTPUT_DIR, RULES_PATH),
+                        help=f"rules to generate corpora from (default: {RULES_PATH})")
+    parser.add_argument("--output", default=BENCH_PATH, help=f"results file (default: {BENCH_PATH})")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the traced second run that measures peak memory")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"flag stages this fraction slower than the baseline "
+                             f"(default: {DEFAULT_TOLERANCE})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rules = load_rules(args.rules)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    unknown = set(args.stages) - {st.func.__name__ for st in PIPELINE_STAGES}
+    if unknown:
+        sys.exit(f"Unknown stage: {', '.join(sorted(unknown))}")
+    stages = _needed_stages(set(args.stages))
+
+    results = {
+        "version": BENCH_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "corpora": {},
+    }
+    # Stages that export files write them to a scratch directory
+    with tempfile.TemporaryDirectory() as scratch:
+        process_meebits.OUTPUT_DIR = scratch
+        for n in args.sizes:
+            print(f"\n{n:,} records")
+            start = time.perf_counter()
+            table = MeebitGenerator(rules, args.seed).table(n)
+            generate_seconds = time.perf_counter() - start
+            print(f"  {'(generate corpus)':<40} {generate_seconds:9.3f}s")
+            results["corpora"][str(n)] = {
+                "records": n,
+                "generate_seconds": round(generate_seconds, 4),
+                "stages": bench_corpus(table, stages, memory=not args.no_memory),
+            }
+            del table
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nWrote {args.output}")
+
+    if baseline is not None:
+        flagged = compare(results, baseline, args.tolerance)
+        if flagged:
+            print(f"\n{len(flagged)} regressions beyond {args.tolerance:.0%} of {args.baseline}:")
+            print("\n".join(flagged))
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
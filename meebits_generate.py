@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Rule-conformant synthetic Meebits.
+
+Samples new records from the rules process_meebits.py derives: type from
+the collection's type mix, gender for Humans, each element from its type's
+(for Humans, its gender's) value pool, colors and tattoo motifs from their
+element's distribution and jersey numbers only on the shirts that carry
+them. Rows breaking an exclusion rule (all population, per type or within
+gender) or an "always" dependency are then redrawn, and deterministic
+rules applied. Sampling is column-wise with a seeded RNG: the same rules
+and seed always give the same corpus.
+
+    python meebits_generate.py 1000000 --seed 7 > meebits_synthetic.jsonl
+    python meebits_generate.py 200000 --format columns --output-dir synthetic
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+from array import array
+from collections import Counter, defaultdict
+from itertools import compress, repeat
+from operator import gt, is_not
+
+import process_meebits
+from process_meebits import (ELEMENT_CATS, ELEMENT_COLOR_PAIRS, OUTPUT_DIR, RECORD_FIELDS,
+                             MeebitTable, encode_column, export_quiz_columns, parse_trait_key)
+
+RULES_PATH = "meebits_rules.json"
+DEFAULT_CHUNK = 100_000
+# Attempts at redrawing a value that breaks a rule before leaving the row as is
+MAX_REDRAWS = 100
+MAX_REPAIR_PASSES = 5
+
+
+class MeebitGenerator:
+    """Draws MeebitTables of rule-conformant records from a meebits_rules.json dict."""
+
+    def __init__(self, rules, seed=0):
+        self.rng = random.Random(seed)
+        self.type_mix = rules["metadata"]["types"]
+        self.gender_mix = rules["metadata"].get("gender_counts") or {}
+        pools = rules.get("per_type_value_pools", {})
+        catalogs = rules.get("gender_trait_catalogs", {})
+
+        # Element distributions per (type, gender) stratum; None weighs the rows without one
+        self.strata = [(t, g) for t in self.type_mix
+                       for g in (self.gender_mix if t == "Human" and self.gender_mix else [None])]
+        self.elements = {}
+        for t, g in self.strata:
+            rows = self.gender_mix[g] if g else self.type_mix[t]
+            source = catalogs.get(g) if g else None
+            for cat in ELEMENT_CATS:
+                pool = (source or pools.get(t, {})).get(cat, {})
+                self.elements[(t, g), cat] = {**pool, None: rows - sum(pool.values())}
+        # Uncolored, non-element categories (jersey numbers are drawn from the shirt)
+        self.others = [cat for cat in MeebitTable.COLUMNS
+                       if cat not in ("type", "gender", "jersey_number") and cat not in ELEMENT_CATS
+                       and cat not in dict(map(reversed, ELEMENT_COLOR_PAIRS))]
+        for t, g in self.strata:
+            for cat in self.others:
+                pool = pools.get(t, {}).get(cat, {})
+                self.elements[(t, g), cat] = {**pool, None: self.type_mix[t] - sum(pool.values())}
+
+        # Color (or tattoo motif) given the element value
+        self.colors = {}
+        for element, color in ELEMENT_COLOR_PAIRS:
+            for m in rules.get("color_element_mappings", {}).get(f"{element} -> {color}", []):
+                self.colors[color, m["value"]] = {**m.get("color_distribution", {}),
+                                                  None: m["without_color"]}
+
+        # Jersey number given (type, shirt): numbers only on the shirts that had them
+        self.jerseys = {}
+        for t, info in rules.get("jersey_number_analysis", {}).get("by_type", {}).items():
+            shirts = [s for s in info["shirts"] if s is not None and s != "null"]
+            shirt_rows = sum(pools.get(t, {}).get("shirt", {}).get(s, 0) for s in shirts)
+            for s in shirts:
+                self.jerseys[t, s] = {**info["numbers"], None: max(shirt_rows - info["count"], 0)}
+
+        # Exclusions: stratum (None = all) -> forbidden value pairs, per category pair
+        self.forbidden = defaultdict(lambda: defaultdict(set))
+        self.partners = defaultdict(set)  # (stratum, (cat, value)) -> values it can't go with
+        scoped = [(None, r) for r in rules.get("value_exclusion_rules_all_population", [])]
+        scoped += [(t, r) for t, rs in rules.get("per_type_exclusion_rules", {}).items() for r in rs]
+        scoped += [(("Human", r["gender"]), r) for r in rules.get("value_exclusion_rules_within_gender", [])]
+        for scope, r in scoped:
+            a, b = parse_trait_key(r["trait_a"]), parse_trait_key(r["trait_b"])
+            strata = [s for s in self.strata if scope in (None, s, s[0])]
+            for s in strata:
+                self.forbidden[a[0], b[0]][s].add((a[1], b[1]))
+                self.partners[s, a].add(b)
+                self.partners[s, b].add(a)
+
+        # "always" dependencies between elements: if_present -> then_present
+        self.requires = [(r["if_present"], r["then_present"]) for r in rules.get("dependency_rules", [])
+                         if r["strength"] == "always" and r["if_present"] in ELEMENT_CATS
+                         and r["then_present"] in ELEMENT_CATS]
+        self.required_by = defaultdict(list)
+        for a, b in self.requires:
+            self.required_by[b].append(a)
+
+        self.deterministic = [(parse_trait_key(r["if_trait"]), parse_trait_key(r["then_trait"]))
+                              for r in rules.get("deterministic_rules", []) if r.get("ratio") == 1.0]
+
+    def _draw(self, keys, distributions, counts=None):
+        """One value per row from distributions[key] for each row's key."""
+        draws = {}
+        for key, k in (counts or Counter(keys)).items():
+            dist = {v: w for v, w in distributions.get(key, {}).items() if w > 0}
+            draws[key] = iter(self.rng.choices(list(dist), list(dist.values()), k=k)) if dist else repeat(None)
+        return list(map(next, map(draws.__getitem__, keys)))
+
+    def _allowed(self, values, i, stratum, cat, value):
+        if value is None:
+            return not any(values[a][i] is not None for a in self.required_by[cat])
+        return not any(values[c][i] == v for c, v in self.partners[stratum, (cat, value)])
+
+    def _redraw(self, values, strata, cat, rows):
+        """Redraw cat in each of rows until no rule is broken; returns the rows that still are."""
+        stuck = []
+        for i in rows:
+            dist = self.elements[strata[i], cat]
+            choices, weights = list(dist), list(dist.values())
+            for _ in range(MAX_REDRAWS):
+                value = self.rng.choices(choices, weights)[0]
+                if self._allowed(values, i, strata[i], cat, value):
+                    values[cat][i] = value
+                    break
+            else:
+                stuck.append(i)
+        return stuck
+
+    def table(self, n, first_token_id=1):
+        """A MeebitTable of n generated records, token IDs counting from first_token_id."""
+        types = self.rng.choices(list(self.type_mix), list(self.type_mix.values()), k=n)
+        values = {"type": types}
+        if self.gender_mix:
+            humans = types.count("Human")
+            genders = iter(self.rng.choices(list(self.gender_mix), list(self.gender_mix.values()), k=humans))
+            values["gender"] = [next(genders) if t == "Human" else None for t in types]
+        else:
+            values["gender"] = [None] * n
+        strata = list(zip(types, values["gender"]))
+
+        sizes = Counter(strata)
+        for cat in ELEMENT_CATS + self.others:
+            values[cat] = self._draw(strata, {s: self.elements[s, cat] for s in self.strata}, sizes)
+
+        # Repairs touch few rows: filter candidates at C speed, then check them one by one
+        for a, b in self.requires:
+            missing = map(gt, map(is_not, values[a], repeat(None)), map(is_not, values[b], repeat(None)))
+            self._redraw(values, strata, b, list(compress(range(n), missing)))
+        # A row stuck on one rule may be freed by another rule's redraw, so repeat until clean
+        for _ in range(MAX_REPAIR_PASSES):
+            broken = 0
+            for (cat_a, cat_b), by_stratum in self.forbidden.items():
+                anywhere = set().union(*by_stratum.values())
+                rows = [i for i in compress(range(n), map(anywhere.__contains__, zip(values[cat_a], values[cat_b])))
+                        if (values[cat_a][i], values[cat_b][i]) in by_stratum.get(strata[i], ())]
+                broken += len(rows)
+                # Every cat_b value clashes with something else in the row: redraw cat_a instead
+                self._redraw(values, strata, cat_a, self._redraw(values, strata, cat_b, rows))
+            if not broken:
+                break
+
+        for element, color in ELEMENT_COLOR_PAIRS:
+            keys = list(zip(repeat(color), values[element]))
+            values[color] = self._draw(keys, self.colors)
+        values["jersey_number"] = self._draw(list(zip(types, values["shirt"])), self.jerseys)
+
+        for (cat_a, va), (cat_b, vb) in self.deterministic:
+            for i in compress(range(n), map(va.__eq__, values[cat_a])):
+                values[cat_b][i] = vb
+
+        columns, dictionaries = {}, {}
+        for col in MeebitTable.COLUMNS:
+            columns[col], dictionaries[col] = encode_column(values.pop(col))
+        return MeebitTable(array("I", range(first_token_id, first_token_id + n)), columns, dictionaries)
+
+    def tables(self, n, chunk=DEFAULT_CHUNK):
+        """n records as consecutive tables of at most chunk rows, for streaming."""
+        for start in range(0, n, chunk):
+            yield self.table(min(chunk, n - start), first_token_id=start + 1)
+
+
+def load_rules(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except OSError:
+        sys.exit(f"No {path} found; run process_meebits.py first")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate rule-conformant synthetic Meebits")
+    parser.add_argument("count", type=int, help="records to generate")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--rules", default=os.path.join(OUTPUT_DIR, RULES_PATH),
+                        help=f"rules to sample from (default: {RULES_PATH})")
+    parser.add_argument("--format", choices=["jsonl", "columns"], default="jsonl",
+                        help="JSON lines, or the quiz's typed-array columns (default: jsonl)")
+    parser.add_argument("--output", default="-", help="JSON lines file (default: stdout)")
+    parser.add_argument("--output-dir", default="synthetic",
+                        help="directory for --format columns (default: synthetic)")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK,
+                        help=f"records generated per batch when streaming (default: {DEFAULT_CHUNK:,})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    generator = MeebitGenerator(load_rules(args.rules), args.seed)
+    start = time.perf_counter()
+
+    if args.format == "columns":
+        os.makedirs(args.output_dir, exist_ok=True)
+        table = generator.table(args.count)
+        process_meebits.OUTPUT_DIR = args.output_dir
+        export_quiz_columns(table)
+    else:
+        with contextlib.nullcontext(sys.stdout) if args.output == "-" else open(args.output, "w") as out:
+            for table in generator.tables(args.count, args.chunk):
+                out.writelines(json.dumps(dict(zip(RECORD_FIELDS, row))) + "\n" for row in table.rows())
+
+    elapsed = time.perf_counter() - start
+    print(f"Generated {args.count:,} records in {elapsed:.2f}s "
+          f"({args.count / max(elapsed, 1e-9):,.0f} records/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Meebits partial-build query service.
+
+Answers "which Meebits have this combination" from a bitmap index over the
+records produced by process_meebits.py: matching token IDs, the match count
+and per-category value histograms of the remaining candidates. It also ranks
+Meebits against a quiz trait profile, as MeebitQuiz.jsx's rankMeebits does,
+and pages through the full rule store (meebits_rules.sqlite) by kind, trait,
+category pair, type or gender.
+
+    python meebits_query.py hat=Cap shirt_color=Red --type Human --gender male
+    python meebits_query.py --rank profile.json
+    python meebits_query.py --rules --kind value_exclusion --trait hat=Cap
+    python meebits_query.py --serve --port 8765
+    curl 'localhost:8765/query?hat=Cap&type=Human&limit=20'
+    curl -d '{"profile": {"type": {"Pig": 1.5}}, "prefer_none": ["hat"]}' localhost:8765/rank
+    curl 'localhost:8765/rules?pair=hat+%2B+shirt&after=1200'
+
+Repeating a category ORs its values (hat=Cap&hat=Beanie); an empty value
+(hat=) selects Meebits without that trait.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from process_meebits import (CACHE_PATH, DATABASE_PATH, OUTPUT_DIR, QUIZ_CATEGORY_IMPORTANCE,
+                             QUIZ_SCORED_CATEGORIES, QUIZ_TYPE_RARE_BOOST, RECORD_FIELDS,
+                             RULE_PAGE_SIZE, RULE_STORE_PATH, BitmapIndex, MeebitTable,
+                             load_from_database, load_table_cache, query_rules, source_fingerprint)
+
+DEFAULT_LIMIT = 100
+
+# Results rankMeebits shows, one per archetype
+DEFAULT_TOP_K = 6
+ARCHETYPE_FIELDS = ("type", "shirt", "pants", "shoes")
+
+# Headroom for summing upper bounds in a different order than the exact score
+BOUND_SLACK = 1e-9
+
+
+def load_table():
+    """The pipeline's records: the memory-mapped record cache if valid, else the database."""
+    table = load_table_cache(os.path.join(OUTPUT_DIR, CACHE_PATH), source_fingerprint())
+    if table is not None:
+        return table
+    if not os.path.exists(os.path.join(OUTPUT_DIR, DATABASE_PATH)):
+        sys.exit(f"No {CACHE_PATH} or {DATABASE_PATH} found; run process_meebits.py first")
+    return MeebitTable.from_records(load_from_database())
+
+
+def open_rule_store():
+    """A read-only connection to the rule store; FileNotFoundError if it hasn't been built."""
+    path = os.path.join(OUTPUT_DIR, RULE_STORE_PATH)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def rule_page(filters, after=0, limit=RULE_PAGE_SIZE):
+    """query_rules on a fresh connection (connections can't cross server threads)."""
+    if limit < 1 or after < 0:
+        raise ValueError("limit must be positive and after non-negative")
+    conn = open_rule_store()
+    try:
+        return query_rules(conn, after=after, limit=limit, **filters)
+    finally:
+        conn.close()
+
+
+class QueryIndex:
+    """Partial-build lookups over a BitmapIndex."""
+
+    def __init__(self, table):
+        self.index = BitmapIndex.build(table)
+
+    def categories(self):
+        """Every queryable column and its known values."""
+        dictionaries = self.index.table.dictionaries
+        return {col: dictionaries[col][1:] for col in MeebitTable.COLUMNS}
+
+    def query(self, terms, limit=DEFAULT_LIMIT, histograms=True):
+        """
+        terms maps a column to the values it may take (OR within a column, AND
+        across columns; None selects missing). Raises KeyError for an unknown
+        column.
+        """
+        start = time.perf_counter()
+        view = self.index
+        for col, values in terms.items():
+            if col not in view.bitmaps:
+                raise KeyError(col)
+            bits = 0
+            for value in values:
+                bits |= view.bits(col, value)
+            view = view.view(bits)
+
+        result = {
+            "query": {col: list(values) for col, values in terms.items()},
+            "count": len(view),
+            "token_ids": view.token_ids(limit),
+        }
+        if histograms:
+            result["histograms"] = {col: self._histogram(view, col) for col in MeebitTable.COLUMNS}
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        return result
+
+    def _histogram(self, view, col):
+        # One AND + popcount per value; cheaper than value_counts' first-appearance order
+        names = self.index.table.dictionaries[col]
+        counts = [(n, names[code]) for code, bits in self.index.bitmaps[col].items()
+                  if (n := (bits & view.mask).bit_count())]
+        counts.sort(key=lambda x: -x[0])
+        return {value: n for n, value in counts}
+
+
+def parse_terms(pairs):
+    """[("hat", "Cap"), ("hat", ""), ...] -> {"hat": ["Cap", None]}"""
+    terms = {}
+    for col, value in pairs:
+        terms.setdefault(col, []).append(value or None)
+    return terms
+
+
+def parse_cli_terms(terms, types=(), genders=()):
+    """CATEGORY=VALUE arguments plus --type/--gender values -> query terms; ValueError if malformed."""
+    pairs = []
+    for term in terms:
+        col, sep, value = term.partition("=")
+        if not sep:
+            raise ValueError(f"Expected CATEGORY=VALUE, got {term!r}")
+        pairs.append((col, value))
+    pairs += [("type", t) for t in types] + [("gender", g) for g in genders]
+    return parse_terms(pairs)
+
+
+class QuizRetriever:
+    """
+    Top-k quiz ranking over the bitmap index's (category, value) posting lists.
+
+    Reproduces rankMeebits in MeebitQuiz.jsx: scoreMeebit scores (type
+    rarity boosts, prefer-none categories, proportional credit), ties in
+    token order, at most one result per type|shirt|pants|shoes archetype.
+    Rather than scoring every row it searches the scored categories in
+    descending order of their best contribution, intersecting the postings
+    of each score level; a branch is dropped once it is empty or its upper
+    bound cannot beat the current k-th archetype. Every row reaching a leaf
+    shares one exact score.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        table = index.table
+        self.archetypes = list(zip(*(table.column(col) for col in ARCHETYPE_FIELDS)))
+
+    def contributions(self, profile, prefer_none=()):
+        """
+        Per-category score for every code, in scoreMeebit's summation order,
+        plus the profile's maximum possible score: ([(cat, scores)], max_possible).
+        """
+        table = self.index.table
+        terms = []
+        max_possible = 0
+        type_prefs = profile.get("type") or {}
+        if type_prefs:
+            importance = QUIZ_CATEGORY_IMPORTANCE["type"]
+            max_raw = max(w * QUIZ_TYPE_RARE_BOOST.get(t, 1) for t, w in type_prefs.items())
+            scores = [(type_prefs.get(v) or 0) * QUIZ_TYPE_RARE_BOOST.get(v, 1) / max(max_raw, 1) * importance
+                      for v in table.values("type")]
+            terms.append(("type", scores))
+            max_possible += importance
+
+        for cat in QUIZ_SCORED_CATEGORIES[1:]:
+            importance = QUIZ_CATEGORY_IMPORTANCE.get(cat, 1.0)
+            values = table.values(cat)
+            if cat in prefer_none:
+                terms.append((cat, [importance] + [0] * (len(values) - 1)))
+                max_possible += importance
+                continue
+            prefs = profile.get(cat)
+            if not prefs:
+                continue
+            max_weight = max(prefs.values())
+            terms.append((cat, [prefs[v] / max_weight * importance if v and prefs.get(v) else 0
+                                for v in values]))
+            max_possible += importance
+        return terms, max_possible
+
+    def rank(self, profile, prefer_none=(), k=DEFAULT_TOP_K):
+        """
+        The k best Meebits for a trait profile ({category: {value: weight}},
+        as built by the quiz's buildTraitProfile), diversified by archetype.
+        """
+        start = time.perf_counter()
+        terms, max_possible = self.contributions(profile, set(prefer_none))
+
+        def final(raw):
+            return raw / max_possible * 100 if max_possible > 0 else 50
+
+        # Per scored category: (position in summation order, [(score, rows)] best first)
+        levels = []
+        for position, (cat, scores) in enumerate(terms):
+            by_score = defaultdict(int)
+            for code, bits in self.index.bitmaps[cat].items():
+                by_score[scores[code]] |= bits
+            if set(by_score) != {0}:
+                levels.append((position, sorted(by_score.items(), reverse=True)))
+        levels.sort(key=lambda level: -level[1][0][0])
+        bounds = [0] * (len(levels) + 1)
+        for i in range(len(levels) - 1, -1, -1):
+            bounds[i] = bounds[i + 1] + levels[i][1][0][0]
+
+        top = {}  # archetype -> (score, -row) of its best row, for the current top k
+        chosen = [0] * len(terms)
+        stats = {"leaves": 0, "rows": 0}
+
+        def search(depth, bits, partial):
+            if depth == len(levels):
+                # Exact score, summed in scoreMeebit's order
+                raw = 0
+                for contribution in chosen:
+                    raw += contribution
+                self._offer_rows(top, k, bits, final(raw), stats)
+                return
+            position, options = levels[depth]
+            for score, rows in options:
+                # Options are best first: once one cannot reach the k-th, none can
+                if len(top) == k and final(partial + score + bounds[depth + 1] + BOUND_SLACK) < min(top.values())[0]:
+                    break
+                subset = bits & rows
+                if subset:
+                    chosen[position] = score
+                    search(depth + 1, subset, partial + score)
+            chosen[position] = 0
+
+        search(0, self.index.mask, 0)
+        ranked = sorted(top.values(), reverse=True)
+        return {
+            "results": [{"score": s, "meebit": self._record(-neg_row)} for s, neg_row in ranked],
+            "evaluated": stats["rows"],
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+        }
+
+    def _offer_rows(self, top, k, bits, score, stats):
+        """Offer a leaf's rows, all scoring score, in token order."""
+        stats["leaves"] += 1
+        while bits:
+            low = bits & -bits
+            row = low.bit_length() - 1
+            bits ^= low
+            if len(top) == k and (score, -row) < min(top.values()):
+                break  # later rows of this leaf lose the tie too
+            stats["rows"] += 1
+            key = self.archetypes[row]
+            current = top.get(key)
+            if current is None:
+                if len(top) == k:
+                    del top[min(top, key=top.get)]
+                top[key] = (score, -row)
+            elif (score, -row) > current:
+                top[key] = (score, -row)
+
+    def _record(self, row):
+        table = self.index.table
+        record = {"token_id": table.token_ids[row]}
+        for col in RECORD_FIELDS[1:]:
+            record[col] = table.values(col)[table.column(col)[row]]
+        return record
+
+
+def parse_rank_request(body):
+    """{"profile": {...}, "prefer_none": [...], "k": N} -> rank() arguments; ValueError if malformed."""
+    if not isinstance(body, dict) or not isinstance(body.get("profile", {}), dict):
+        raise ValueError("expected {\"profile\": {category: {value: weight}}, ...}")
+    profile = body.get("profile", {})
+    for prefs in profile.values():
+        if not isinstance(prefs, dict) or not all(isinstance(w, (int, float)) for w in prefs.values()):
+            raise ValueError("profile weights must be numbers")
+    k = int(body.get("k", DEFAULT_TOP_K))
+    if k < 1:
+        raise ValueError("k must be positive")
+    return profile, list(body.get("prefer_none", [])), k
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /query?cat=value&...&limit=N&histograms=0, GET /categories,
+    GET /rules?kind=&trait=&pair=&type=&gender=&after=ID&limit=N and
+    POST /rank with a quiz trait profile.
+    """
+
+    query_index = None
+    retriever = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/categories":
+            self._send(200, self.query_index.categories())
+        elif url.path == "/query":
+            params = parse_qs(url.query, keep_blank_values=True)
+            try:
+                limit = int(params.pop("limit", [DEFAULT_LIMIT])[-1])
+                histograms = params.pop("histograms", ["1"])[-1] not in ("0", "false")
+                terms = parse_terms((col, v) for col, values in params.items() for v in values)
+                self._send(200, self.query_index.query(terms, limit, histograms))
+            except ValueError as e:
+                self._send(400, {"error": f"bad parameter: {e}"})
+            except KeyError as e:
+                self._send(400, {"error": f"unknown category: {e.args[0]}"})
+        elif url.path == "/rules":
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            filters = {"kind": params.get("kind"), "trait": params.get("trait"),
+                       "category_pair": params.get("pair"), "type_name": params.get("type"),
+                       "gender": params.get("gender")}
+            try:
+                after, limit = int(params.get("after", 0)), int(params.get("limit", RULE_PAGE_SIZE))
+                self._send(200, rule_page(filters, after, limit))
+            except ValueError as e:
+                self._send(400, {"error": f"bad parameter: {e}"})
+            except (FileNotFoundError, sqlite3.Error) as e:
+                self._send(503, {"error": f"rule store unavailable: {e}"})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/rank":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            profile, prefer_none, k = parse_rank_request(body)
+        except ValueError as e:
+            self._send(400, {"error": f"bad request: {e}"})
+            return
+        self._send(200, self.retriever.rank(profile, prefer_none, k))
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        # The Builder dev server runs on another port
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Query Meebits by partial trait assignment")
+    parser.add_argument("terms", nargs="*", metavar="CATEGORY=VALUE",
+                        help="trait constraints; repeat a category to OR values, leave VALUE "
+                             "empty to require the trait be absent")
+    parser.add_argument("--type", action="append", default=[], help="restrict to a type (repeatable)")
+    parser.add_argument("--gender", action="append", default=[], help="restrict to a gender (repeatable)")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT,
+                        help=f"token IDs to return (default: {DEFAULT_LIMIT})")
+    parser.add_argument("--no-histograms", action="store_true",
+                        help="skip per-category histograms of the matches")
+    parser.add_argument("--rank", metavar="PROFILE",
+                        help="rank Meebits against a quiz profile JSON file ('-' for stdin) "
+                             "instead of querying")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP_K,
+                        help=f"results to rank (default: {DEFAULT_TOP_K})")
+    parser.add_argument("--rules", action="store_true",
+                        help=f"page through {RULE_STORE_PATH} instead of querying Meebits "
+                             "(--type, --gender and --limit filter it too)")
+    parser.add_argument("--kind", help="with --rules: rule kind, e.g. value_exclusion")
+    parser.add_argument("--trait", help="with --rules: rules involving this CATEGORY=VALUE")
+    parser.add_argument("--pair", metavar="'CAT + CAT'", help="with --rules: category pair")
+    parser.add_argument("--after", type=int, default=0, help="with --rules: page after this rule ID")
+    parser.add_argument("--serve", action="store_true", help="run the HTTP query server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.rules:
+        filters = {"kind": args.kind, "trait": args.trait, "category_pair": args.pair,
+                   "type_name": args.type[-1] if args.type else None,
+                   "gender": args.gender[-1] if args.gender else None}
+        try:
+            page = rule_page(filters, args.after, args.limit)
+        except FileNotFoundError:
+            sys.exit(f"No {RULE_STORE_PATH} found; run process_meebits.py first")
+        except ValueError as e:
+            sys.exit(str(e))
+        json.dump(page, sys.stdout, indent=2)
+        print()
+        return
+
+    table = load_table()
+
+    if args.rank:
+        try:
+            with (sys.stdin if args.rank == "-" else open(args.rank)) as f:
+                profile, prefer_none, _ = parse_rank_request(json.load(f))
+        except (OSError, ValueError) as e:
+            sys.exit(f"Bad profile {args.rank}: {e}")
+        json.dump(QuizRetriever(BitmapIndex.build(table)).rank(profile, prefer_none, args.top), sys.stdout, indent=2)
+        print()
+        return
+
+    query_index = QueryIndex(table)
+    if args.serve:
+        QueryHandler.query_index = query_index
+        QueryHandler.retriever = QuizRetriever(query_index.index)
+        server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+        print(f"Serving {len(query_index.index):,} Meebits on http://{args.host}:{args.port}/query")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    try:
+        terms = parse_cli_terms(args.terms, args.type, args.gender)
+    except ValueError as e:
+        sys.exit(str(e))
+    try:
+        result = query_index.query(terms, args.limit, not args.no_histograms)
+    except KeyError as e:
+        sys.exit(f"Unknown category: {e.args[0]}")
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
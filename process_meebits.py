@@ -11,14 +11,48 @@ near-exclusions, comprehensive all-pairs biases, three-way interactions,
 and deterministic rules.
 """
 
+import argparse
+import ast
+import base64
+import contextlib
+import cProfile
+import io
 import json
 import csv
+import gzip
+import hashlib
+import heapq
+import inspect
+import mmap
 import os
+import pickle
+import pstats
+import re
+import sqlite3
 import sys
-from collections import defaultdict, Counter
-from itertools import combinations
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import defaultdict, namedtuple, Counter
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from datetime import datetime, timezone
+from itertools import combinations, compress, repeat
+from operator import add, eq, itemgetter, mul
 import math
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
 INPUT_DIR = "metadata_raw/meebits_metadata_as_IPFS"
 DATABASE_PATH = "meebits_database.json"
 OUTPUT_DIR = "."
@@ -50,23 +84,119 @@ ELEMENT_COLOR_PAIRS = [
     ("tattoo", "tattoo_motif"),
 ]
 
+# Color categories proper (tattoo motifs are codes, not colors)
+COLOR_CATS = [color for _, color in ELEMENT_COLOR_PAIRS if color != "tattoo_motif"]
+
 ALL_TYPES = ["Human", "Pig", "Elephant", "Robot", "Skeleton", "Visitor", "Dissected"]
 
 
 # ---------------------------------------------------------------------------
-# Utility functions
+# Significance testing (log space, batched per contingency matrix)
 # ---------------------------------------------------------------------------
 
-def chi_squared_pvalue(observed, expected):
-    """Approximate p-value for a single-cell chi-squared test (1 df)."""
-    if expected <= 0:
-        return 1.0
-    chi2 = ((observed - expected) ** 2) / expected
-    # Approximate using the complementary error function (1 df)
-    p = 1.0 - math.erf(math.sqrt(chi2 / 2.0))
-    return max(p, 1e-300)
+LOG_10 = math.log(10)
+
+# Cells whose smallest expected 2x2 count is below this get an exact test
+EXACT_TEST_BELOW = 5
+
+
+def log_chi2_sf(x):
+    """log P(X >= x) for a 1-df chi-square, accurate far past float underflow."""
+    if x <= 0:
+        return 0.0
+    z = math.sqrt(x / 2.0)
+    if z < 25:
+        return math.log(math.erfc(z))
+    # Asymptotic expansion of erfc(z) for large z
+    z2 = z * z
+    return -z2 - math.log(z * math.sqrt(math.pi)) + math.log1p(-0.5 / z2 + 0.75 / (z2 * z2))
+
+
+def _log_comb(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+def log_hypergeom_tail(k, row, col, total, upper=True):
+    """
+    log P(X >= k) (upper) or log P(X <= k) for X ~ Hypergeometric: the
+    one-sided Fisher exact tail of a 2x2 table with cell k and margins
+    row, col out of total.
+    """
+    lo, hi = max(0, row + col - total), min(row, col)
+    if (upper and k <= lo) or (not upper and k >= hi):
+        return 0.0
+    log_pmf = _log_comb(row, k) + _log_comb(total - row, col - k) - _log_comb(total, col)
+
+    # Walk away from k with the pmf ratio; tail terms shrink, so stop once negligible
+    acc = term = 1.0
+    x = k
+    while (x < hi if upper else x > lo):
+        if upper:
+            term *= (row - x) * (col - x) / ((x + 1) * (total - row - col + x + 1))
+            x += 1
+        else:
+            term *= x * (total - row - col + x) / ((row - x + 1) * (col - x + 1))
+            x -= 1
+        acc += term
+        if term < acc * 1e-17:
+            break
+    return min(0.0, log_pmf + math.log(acc))
+
+
+def log_binomial_tail(k, n, p, upper=True):
+    """log P(X >= k) (upper) or log P(X <= k) for X ~ Binomial(n, p), 0 < p < 1."""
+    if (upper and k <= 0) or (not upper and k >= n):
+        return 0.0
+    log_p, log_q = math.log(p), math.log1p(-p)
+    terms = [_log_comb(n, x) + x * log_p + (n - x) * log_q
+             for x in (range(k, n + 1) if upper else range(k + 1))]
+    top = max(terms)
+    return min(0.0, top + math.log(sum(math.exp(t - top) for t in terms)))
+
+
+def contingency_log_pvalues(counts, row_totals, col_totals, total):
+    """
+    Two-sided log p-values for every cell of a contingency matrix, each cell
+    tested as its own 2x2 table (this row/col vs the rest). Pearson chi-square
+    where counts are large, doubled Fisher exact tail where they are small.
+
+    counts is {(row, col): observed}; returns {(row, col): log p}.
+    """
+    log_2 = math.log(2)
+    results = {}
+    for (r, c), a in counts.items():
+        row, col = row_totals[r], col_totals[c]
+        if row in (0, total) or col in (0, total):
+            results[(r, c)] = 0.0
+            continue
+        if min(row, total - row) * min(col, total - col) / total < EXACT_TEST_BELOW:
+            tail = log_hypergeom_tail(a, row, col, total, upper=a * total > row * col)
+            results[(r, c)] = min(0.0, log_2 + tail)
+        else:
+            diff = a * total - row * col  # = ad - bc of the 2x2 table
+            chi2 = total * diff * diff / (row * (total - row) * col * (total - col))
+            results[(r, c)] = log_chi2_sf(chi2)
+    return results
 
 
+def benjamini_hochberg(log_pvalues):
+    """Benjamini-Hochberg FDR-adjusted q-values for a list of log p-values (log space)."""
+    m = len(log_pvalues)
+    log_q = [0.0] * m
+    running = 0.0
+    log_m = math.log(m) if m else 0.0
+    order = sorted(range(m), key=log_pvalues.__getitem__)
+    for rank in range(m, 0, -1):
+        i = order[rank - 1]
+        running = min(running, log_pvalues[i] + log_m - math.log(rank))
+        log_q[i] = running
+    return log_q
+
+
+# ---------------------------------------------------------------------------
+# Utility functions
+# ---------------------------------------------------------------------------
+
 def parse_trait_key(trait_str):
     """Parse 'category=value' into (category, value)."""
     parts = trait_str.split("=", 1)
@@ -74,7 +204,7 @@ def parse_trait_key(trait_str):
 
 
 def parse_meebit(filepath, token_id):
-    """Parse a single meebit JSON file into a flat dict."""
+    """Parse a single meebit JSON file into a MeebitRecord."""
     with open(filepath, 'r') as f:
         data = json.load(f)
 
@@ -117,83 +247,1242 @@ def parse_meebit(filepath, token_id):
     jn = data.get("jerseyNumber")
     record["jersey_number"] = str(jn) if jn is not None else None
 
-    return record
+    return MeebitRecord.from_dict(record)
 
 
-def load_all_meebits():
-    """Load all 20,000 meebit files."""
-    records = []
+def list_meebit_files():
+    """List INPUT_DIR once and return {token_id: filepath} for every meebit file."""
+    found = {}
+    with os.scandir(INPUT_DIR) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith("meebit_") and name.endswith(".json") and name[7:-5].isdigit():
+                found[int(name[7:-5])] = entry.path
+    return found
+
+
+def _parse_chunk(chunk):
+    """Parse a chunk of (filepath, token_id) pairs inside a pool worker."""
+    start = time.perf_counter()
+    records = [parse_meebit(filepath, token_id) for filepath, token_id in chunk]
+    worker = f"{os.getpid()}:{threading.current_thread().name}"
+    return records, worker, time.perf_counter() - start
+
+
+def load_all_meebits(workers=1, executor="thread", chunk_size=500):
+    """
+    Load all 20,000 meebit files.
+
+    The directory is listed once up front. With workers > 1 the files are
+    parsed in chunks on a thread or process pool; chunks are collected in
+    submission order, so records always come back in token order.
+    """
+    available = list_meebit_files()
+    jobs = []
     for i in range(1, 20001):
-        filename = f"meebit_{i:05d}.json"
-        filepath = os.path.join(INPUT_DIR, filename)
-        if not os.path.exists(filepath):
-            print(f"Warning: {filepath} not found, skipping")
+        if i not in available:
+            print(f"Warning: {os.path.join(INPUT_DIR, f'meebit_{i:05d}.json')} not found, skipping")
             continue
-        record = parse_meebit(filepath, i)
-        records.append(record)
-        if i % 5000 == 0:
-            print(f"  Loaded {i}/20000...")
+        jobs.append((available[i], i))
+    chunks = [jobs[k:k + chunk_size] for k in range(0, len(jobs), chunk_size)]
+
+    wall_start = time.perf_counter()
+    if workers > 1:
+        pool_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        pool = pool_cls(max_workers=workers)
+        results = pool.map(_parse_chunk, chunks)
+    else:
+        pool = None
+        results = map(_parse_chunk, chunks)
+
+    records = []
+    worker_stats = defaultdict(lambda: {"files": 0, "seconds": 0.0})
+    try:
+        for chunk, (chunk_records, worker, seconds) in zip(chunks, results):
+            records.extend(chunk_records)
+            worker_stats[worker]["files"] += len(chunk_records)
+            worker_stats[worker]["seconds"] += seconds
+            for _, i in chunk:
+                if i % 5000 == 0:
+                    print(f"  Loaded {i}/20000...")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    wall = time.perf_counter() - wall_start
+
+    if workers > 1:
+        print(f"  Parsed {len(records)} files in {wall:.2f}s on {workers} {executor} workers "
+              f"({len(records) / max(wall, 1e-9):,.0f} files/s)")
+        for worker, st in sorted(worker_stats.items()):
+            rate = st["files"] / max(st["seconds"], 1e-9)
+            print(f"    worker {worker}: {st['files']} files in {st['seconds']:.2f}s ({rate:,.0f} files/s)")
     return records
 
 
 def load_from_database():
-    """Load records from the existing meebits_database.json."""
+    """Load MeebitRecords from the existing meebits_database.json (records or rows layout)."""
     db_path = os.path.join(OUTPUT_DIR, DATABASE_PATH)
     with open(db_path, 'r') as f:
         records = json.load(f)
+    if isinstance(records, dict):
+        columns = records["columns"]
+        positions = [columns.index(f) if f in columns else None for f in RECORD_FIELDS]
+        records = records["rows"]
+        for i, row in enumerate(records):
+            records[i] = MeebitRecord._make(_intern(row[p]) if p is not None else None for p in positions)
+    else:
+        # Convert in place so each parsed dict is freed as soon as it is compacted
+        for i, record in enumerate(records):
+            records[i] = MeebitRecord.from_dict(record)
     return records
 
 
-def infer_gender(records):
+# ---------------------------------------------------------------------------
+# Columnar record store
+# ---------------------------------------------------------------------------
+
+# Field order of an exported record (matches parse_meebit + infer_gender)
+RECORD_FIELDS = ["token_id", "type"] + TRAIT_CATEGORIES + ["gender"]
+_RECORD_POSITIONS = {f: i for i, f in enumerate(RECORD_FIELDS)}
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class MeebitRecord(namedtuple("MeebitRecord", RECORD_FIELDS, defaults=(None,))):
+    """
+    One Meebit as a tuple in RECORD_FIELDS order. Fields read as attributes
+    (record.hat) and, like the flat dicts records used to be, the record is
+    a read-only mapping of field name to value: record["hat"],
+    record.get("hat"), "hat" in record, iteration over field names, keys(),
+    values(), items() and dict(record). Integer indexes still read by
+    position. Values are interned, so every record shares one string per
+    distinct trait value; a record costs about a sixth of the equivalent
+    dict.
     """
-    Infer gender for Human meebits using beard as the anchor trait.
 
-    Strategy:
-    1. Any human with a beard = male (beards are definitively male-only)
-    2. Use beard co-occurrence to classify all other trait values as male-only,
-       female-only, or unisex
-    3. Classify each human based on their trait values voting on gender
-    4. Non-human types get gender=None
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls._make(_intern(d.get(f)) for f in RECORD_FIELDS)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, _RECORD_POSITIONS[key])
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in _RECORD_POSITIONS
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def get(self, key, default=None):
+        i = _RECORD_POSITIONS.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        return self._fields
+
+    def values(self):
+        return tuple(tuple.__iter__(self))
+
+    def items(self):
+        return tuple(zip(self._fields, tuple.__iter__(self)))
+
+    # namedtuple's own helpers iterate the record, which now yields names
+    def _asdict(self):
+        return dict(self.items())
+
+    def _replace(self, **changes):
+        record = self._make([changes.pop(f, v) for f, v in self.items()])
+        if changes:
+            raise ValueError(f"Got unexpected field names: {list(changes)!r}")
+        return record
+
+    def __getnewargs__(self):
+        return self.values()
+
+
+def _typecode(codes):
+    """Typecode of a code column (an array, or a memoryview from the record cache)."""
+    return codes.typecode if isinstance(codes, array) else codes.format
+
+
+def _code_typecode(dictionary_size):
+    """Smallest unsigned array typecode that can hold every code."""
+    if dictionary_size <= 0xFF:
+        return "B"
+    if dictionary_size <= 0xFFFF:
+        return "H"
+    return "I"
+
+
+def encode_column(values):
+    """Dictionary-encode a sequence of values into (codes, dictionary).
+
+    Code 0 is always None; other codes are assigned in first-appearance
+    order, so iterating a Counter of codes visits values in record order.
     """
-    humans = [r for r in records if r["type"] == "Human"]
+    seen = dict.fromkeys(values)
+    seen.pop(None, None)
+    dictionary = [None, *seen]
+    lookup = {v: i for i, v in enumerate(dictionary)}
+    return array(_code_typecode(len(dictionary)), map(lookup.__getitem__, values)), dictionary
 
-    # Step 1: Find all bearded humans (definitively male)
-    bearded_ids = set()
-    for r in humans:
-        if r.get("beard") is not None:
-            bearded_ids.add(r["token_id"])
 
-    # Step 2: For each trait value, compute what fraction appears on bearded humans
-    # vs non-bearded. This tells us male vs female affinity.
-    trait_gender_scores = {}  # {(cat, value): (with_beard_count, without_beard_count)}
+class MeebitTable:
+    """
+    Dictionary-encoded columnar store for Meebit records.
+
+    Each column ("type", "gender" and every trait category) is a compact
+    array of integer codes indexing into that column's value dictionary.
+    Code 0 means the trait is absent, so presence checks are truthiness
+    tests and counting becomes a bincount over code arrays.
+    """
+
+    COLUMNS = ["type", "gender"] + TRAIT_CATEGORIES
+
+    def __init__(self, token_ids, columns, dictionaries):
+        self.token_ids = token_ids
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self._lookups = {col: {v: i for i, v in enumerate(vals)}
+                         for col, vals in dictionaries.items()}
+
+    @classmethod
+    def from_records(cls, records):
+        """Encode a list of MeebitRecords (or flat record dicts)."""
+        records = [r if isinstance(r, MeebitRecord) else MeebitRecord.from_dict(r) for r in records]
+        token_ids = array("I", map(itemgetter(0), records))
+        columns = {}
+        dictionaries = {}
+        for col in cls.COLUMNS:
+            columns[col], dictionaries[col] = encode_column(
+                list(map(itemgetter(_RECORD_POSITIONS[col]), records)))
+        return cls(token_ids, columns, dictionaries)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def __getstate__(self):
+        # Memory-mapped cache columns can't be pickled; ship plain arrays instead
+        state = dict(self.__dict__)
+        state["token_ids"] = array(_typecode(self.token_ids), bytes(self.token_ids))
+        state["columns"] = {col: array(_typecode(codes), bytes(codes))
+                            for col, codes in self.columns.items()}
+        return state
+
+    def content_hash(self):
+        """Hex digest of every code array and value dictionary."""
+        h = hashlib.sha256(bytes(self.token_ids))
+        for col in sorted(self.columns):
+            h.update(col.encode() + b"\0" + bytes(self.columns[col]))
+            h.update(json.dumps(self.dictionaries[col]).encode())
+        return h.hexdigest()
+
+    def column(self, col):
+        """Code array for a column (0 = missing)."""
+        return self.columns[col]
+
+    def values(self, col):
+        """Value dictionary for a column; index with a code to decode it."""
+        return self.dictionaries[col]
+
+    def code(self, col, value):
+        """Code for a value, or None if the value never occurs."""
+        return self._lookups[col].get(value)
+
+    def decode(self, col):
+        """Decoded per-row values for a column."""
+        return list(map(self.dictionaries[col].__getitem__, self.columns[col]))
+
+    def set_column(self, col, values):
+        """Replace (or add) a column from per-row values."""
+        codes, dictionary = encode_column(values)
+        self.columns[col] = codes
+        self.dictionaries[col] = dictionary
+        self._lookups[col] = {v: i for i, v in enumerate(dictionary)}
+
+    def rows(self, fields=RECORD_FIELDS):
+        """Iterate decoded row tuples of the given fields, one record at a time."""
+        names = [self.dictionaries[f] for f in fields if f != "token_id"]
+        columns = [self.columns[f] for f in fields if f != "token_id"]
+        token_pos = fields.index("token_id") if "token_id" in fields else None
+        for token_id, *codes in zip(self.token_ids, *columns):
+            row = [n[c] for n, c in zip(names, codes)]
+            if token_pos is not None:
+                row.insert(token_pos, token_id)
+            yield row
+
+    def slice(self, start, stop):
+        """Rows start to stop as a table sharing this one's dictionaries."""
+        return MeebitTable._from_parts(self.token_ids[start:stop],
+                                       {col: codes[start:stop] for col, codes in self.columns.items()},
+                                       self)
+
+    def to_records(self):
+        """Rebuild flat record dicts in RECORD_FIELDS order."""
+        return [dict(zip(RECORD_FIELDS, row)) for row in self.rows()]
+
+    # -- counting -----------------------------------------------------------
+
+    def code_counts(self, col):
+        """Counter of {code: count}, in first-appearance order."""
+        return Counter(self.columns[col])
+
+    def value_counts(self, col, include_missing=False):
+        """Counter of {value: count}, in first-appearance order."""
+        names = self.dictionaries[col]
+        return Counter({names[c]: n for c, n in self.code_counts(col).items()
+                        if c or include_missing})
+
+    def first_present(self, cols):
+        """The given columns that ever have a value, ordered by the first row that has one."""
+        firsts = {col: next(compress(range(len(self)), self.columns[col]), None) for col in cols}
+        return sorted((col for col in cols if firsts[col] is not None), key=firsts.__getitem__)
+
+    def count_present(self, *cols):
+        """Number of rows where every given column has a value."""
+        combined = self.columns[cols[0]]
+        for col in cols[1:]:
+            combined = map(mul, combined, self.columns[col])
+        return len(self) - list(combined).count(0)
+
+    def joint_counts(self, *cols, include_missing=False):
+        """
+        Counter of {(code, code, ...): count} over the given columns.
+
+        Codes are packed into a single integer per row so the whole count is
+        one bincount-style pass. Keys keep first-appearance order; rows with a
+        missing value in any column are dropped unless include_missing is set.
+        """
+        radices = [len(self.dictionaries[col]) for col in cols]
+        combined = self.columns[cols[0]]
+        for col, radix in zip(cols[1:], radices[1:]):
+            combined = map(add, map(mul, combined, repeat(radix)), self.columns[col])
+
+        result = Counter()
+        for packed, n in Counter(combined).items():
+            key = []
+            for radix in reversed(radices[1:]):
+                packed, c = divmod(packed, radix)
+                key.append(c)
+            key.append(packed)
+            key.reverse()
+            if include_missing or all(key):
+                result[tuple(key)] = n
+        return result
+
+    # -- subsets ------------------------------------------------------------
+
+    def _select(self, mask):
+        mask = bytes(mask)
+        return MeebitTable._from_parts(
+            array(_typecode(self.token_ids), compress(self.token_ids, mask)),
+            {col: array(_typecode(codes), compress(codes, mask))
+             for col, codes in self.columns.items()},
+            self)
+
+    @classmethod
+    def _from_parts(cls, token_ids, columns, parent):
+        table = cls.__new__(cls)
+        table.token_ids = token_ids
+        table.columns = columns
+        table.dictionaries = dict(parent.dictionaries)
+        table._lookups = dict(parent._lookups)
+        return table
+
+    def where(self, col, value):
+        """Rows where a column equals value (None selects missing rows)."""
+        code = self.code(col, value)
+        if code is None:
+            return self._select(bytes(len(self)))
+        return self._select(map(eq, self.columns[col], repeat(code)))
+
+    def present(self, col):
+        """Rows where a column has a value."""
+        return self._select(map(bool, self.columns[col]))
+
+
+def pair_marginals(pair_counts):
+    """Row/column totals of a {(a, b): count} table: (a_counts, b_counts, total)."""
+    a_counts = Counter()
+    b_counts = Counter()
+    for (va, vb), n in pair_counts.items():
+        a_counts[va] += n
+        b_counts[vb] += n
+    return a_counts, b_counts, sum(pair_counts.values())
+
+
+def nest_pair_counts(pair_counts):
+    """Regroup a {(a, b): count} table as {a: Counter({b: count})}."""
+    nested = defaultdict(Counter)
+    for (va, vb), n in pair_counts.items():
+        nested[va][vb] = n
+    return nested
+
+
+# ---------------------------------------------------------------------------
+# Bitmap index
+# ---------------------------------------------------------------------------
+
+class BitmapIndex:
+    """
+    One bitset per value of every table column: a Python int whose bit i is
+    set when row i holds that value (code 0, missing, included).
+
+    Conjunction counts such as Pig AND hat=X AND shirt=Y are popcounts of
+    ANDed bitsets. where()/present() return views that share the bitsets
+    and only carry a row mask, so subsets cost one int instead of new
+    columns. Views expose the same counting API as MeebitTable.
+    """
+
+    def __init__(self, table, bitmaps, mask):
+        self.table = table
+        self.bitmaps = bitmaps
+        self.mask = mask
+
+    @classmethod
+    def build(cls, table):
+        n = len(table)
+        bitmaps = {}
+        for col, codes in table.columns.items():
+            planes = defaultdict(lambda: bytearray((n + 7) // 8))
+            for i, c in enumerate(codes):
+                planes[c][i >> 3] |= 1 << (i & 7)
+            bitmaps[col] = {c: int.from_bytes(plane, "little") for c, plane in planes.items()}
+        return cls(table, bitmaps, (1 << n) - 1)
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def bits(self, col, value):
+        """Bitset of rows in this view where col == value (None = missing)."""
+        code = self.table.code(col, value)
+        return self.bitmaps[col].get(code, 0) & self.mask if code is not None else 0
+
+    def count(self, *terms):
+        """Rows in this view matching every (col, value) term."""
+        bits = self.mask
+        for col, value in terms:
+            bits &= self.bits(col, value)
+        return bits.bit_count()
+
+    def view(self, mask):
+        return BitmapIndex(self.table, self.bitmaps, mask & self.mask)
+
+    def where(self, col, value):
+        """View of rows where a column equals value (None selects missing rows)."""
+        return self.view(self.bits(col, value))
+
+    def present(self, col):
+        """View of rows where a column has a value."""
+        return self.view(~self.bitmaps[col].get(0, 0))
+
+    def value_counts(self, col, include_missing=False):
+        """Counter of {value: count}, in first-appearance order within the view."""
+        names = self.table.dictionaries[col]
+        counts = []
+        for code, bits in self.bitmaps[col].items():
+            bits &= self.mask
+            if bits and (code or include_missing):
+                # Lowest set bit = first row of the view holding this value
+                counts.append(((bits & -bits).bit_length(), names[code], bits.bit_count()))
+        counts.sort()
+        return Counter({value: n for _, value, n in counts})
+
+    def stratify(self, term_a, term_b, col_c):
+        """
+        Three-way counts for the pair (A=a, B=b) within each value of col_c.
+
+        Only rows where A, B and C are all present count. Returns
+        {c_code: (ab, a, b, total)} in first-appearance order of the strata,
+        from four popcounts per stratum instead of a pass over the rows.
+        """
+        (col_a, value_a), (col_b, value_b) = term_a, term_b
+        both = self.mask & ~self.bitmaps[col_a].get(0, 0) & ~self.bitmaps[col_b].get(0, 0)
+        bits_a = self.bits(col_a, value_a) & both
+        bits_b = self.bits(col_b, value_b) & both
+        bits_ab = bits_a & bits_b
+        strata = []
+        for code, bits_c in self.bitmaps[col_c].items():
+            bits_c &= both
+            if code and bits_c:
+                strata.append(((bits_c & -bits_c).bit_length(), code, bits_c))
+        strata.sort()
+        return {code: ((bits_ab & bits_c).bit_count(), (bits_a & bits_c).bit_count(),
+                       (bits_b & bits_c).bit_count(), bits_c.bit_count())
+                for _, code, bits_c in strata}
+
+    def token_ids(self, limit=None):
+        """Token IDs of the rows in this view (the first limit of them, if given)."""
+        ids = self.table.token_ids
+        bits = self.mask
+        out = []
+        while bits and len(out) != limit:
+            low = bits & -bits
+            out.append(ids[low.bit_length() - 1])
+            bits ^= low
+        return out
+
+
+# ---------------------------------------------------------------------------
+# Binary record cache
+# ---------------------------------------------------------------------------
+
+CACHE_PATH = "meebits_records.cache"
+CACHE_MAGIC = b"MEEBTBL1"
+# Bump whenever parse_meebit or the table layout changes
+CACHE_VERSION = 1
+
+
+def source_fingerprint(verify_content=False):
+    """
+    Fingerprint the record source: the raw metadata directory if present,
+    otherwise the exported database file.
+
+    The file listing and (size, mtime) stats are always hashed; file
+    contents are only hashed when verify_content is set, since that means
+    reading every file.
+    """
+    if os.path.isdir(INPUT_DIR):
+        source = "raw"
+        paths = [path for _, path in sorted(list_meebit_files().items())]
+    else:
+        source = "database"
+        paths = [os.path.join(OUTPUT_DIR, DATABASE_PATH)]
+
+    listing = hashlib.sha256()
+    stats = hashlib.sha256()
+    content = hashlib.sha256() if verify_content else None
+    for path in paths:
+        st = os.stat(path)
+        name = os.path.basename(path).encode()
+        listing.update(name + b"\0")
+        stats.update(b"%s\0%d\0%d\0" % (name, st.st_size, st.st_mtime_ns))
+        if content is not None:
+            with open(path, "rb") as f:
+                content.update(hashlib.sha256(f.read()).digest())
+
+    return {
+        "source": source,
+        "files": len(paths),
+        "listing": listing.hexdigest(),
+        "stat": stats.hexdigest(),
+        "content": content.hexdigest() if content is not None else None,
+    }
+
+
+def _fingerprint_matches(cached, current):
+    """Cached fingerprint is still valid for the current source."""
+    keys = ["source", "files", "listing", "stat"]
+    if current["content"] is not None:
+        keys.append("content")
+    return all(cached.get(k) == current[k] for k in keys)
+
+
+def write_table_cache(path, table, fingerprint):
+    """Write the encoded table as a header + 8-byte aligned raw code arrays."""
+    header = {
+        "version": CACHE_VERSION,
+        "byteorder": sys.byteorder,
+        "fingerprint": fingerprint,
+        "rows": len(table),
+        "dictionaries": table.dictionaries,
+        "arrays": {},
+    }
+    blobs = [("token_ids", table.token_ids)] + list(table.columns.items())
+
+    # Offsets are relative to the start of the data section
+    offset = 0
+    for name, codes in blobs:
+        offset += -offset % 8
+        header["arrays"][name] = {"typecode": _typecode(codes), "offset": offset}
+        offset += len(codes) * array(_typecode(codes)).itemsize
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+    data_start = len(CACHE_MAGIC) + 4 + len(header_bytes)
+    data_start += -data_start % 8
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(CACHE_MAGIC)
+        f.write(len(header_bytes).to_bytes(4, "little"))
+        f.write(header_bytes)
+        for name, codes in blobs:
+            f.write(b"\0" * (data_start + header["arrays"][name]["offset"] - f.tell()))
+            f.write(codes if isinstance(codes, array) else codes.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_table_cache(path, fingerprint):
+    """
+    Memory-map a cached table. Returns None if the cache is missing, from an
+    older format, truncated or corrupt, or was built from a different source
+    than fingerprint.
+    """
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    magic_end = len(CACHE_MAGIC)
+    if mm[:magic_end] != CACHE_MAGIC:
+        return None
+    try:
+        header_len = int.from_bytes(mm[magic_end:magic_end + 4], "little")
+        header = json.loads(mm[magic_end + 4:magic_end + 4 + header_len])
+        if (header["version"] != CACHE_VERSION or header["byteorder"] != sys.byteorder
+                or not _fingerprint_matches(header["fingerprint"], fingerprint)):
+            return None
+
+        data_start = magic_end + 4 + header_len
+        data_start += -data_start % 8
+        view = memoryview(mm)
+        rows = header["rows"]
+        arrays = {}
+        for name, spec in header["arrays"].items():
+            start = data_start + spec["offset"]
+            size = rows * array(spec["typecode"]).itemsize
+            if start + size > len(mm):
+                return None  # Truncated: a short slice would cast to fewer rows
+            arrays[name] = view[start:start + size].cast(spec["typecode"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        # Undecodable header or array specs
+        return None
+
+    token_ids = arrays.pop("token_ids")
+    return MeebitTable(token_ids, arrays, header["dictionaries"])
+
+
+# ---------------------------------------------------------------------------
+# Streaming export writers
+# ---------------------------------------------------------------------------
+
+# Maps each exported file to its digest, encoding options and the
+# content-hashed compressed siblings the frontends can cache immutably
+EXPORT_MANIFEST = "meebits_exports.json"
+
+JSON_STYLES = {
+    "pretty": {"indent": 2},
+    "minified": {"separators": (",", ":")},
+}
+
+ExportOptions = namedtuple("ExportOptions", "style layout compress",
+                           defaults=("pretty", "records", ()))
+
+
+def iter_json_array(items, style="pretty"):
+    """Encode an iterable as a JSON array, yielding one element at a time."""
+    encoder = json.JSONEncoder(**JSON_STYLES[style])
+    pretty = style == "pretty"
+    first = True
+    for item in items:
+        text = encoder.encode(item)
+        if pretty:
+            yield ("[\n  " if first else ",\n  ") + text.replace("\n", "\n  ")
+        else:
+            yield ("[" if first else ",") + text
+        first = False
+    yield "[]" if first else ("\n]" if pretty else "]")
+
+
+def iter_json_rows(columns, rows, style="pretty"):
+    """
+    Encode rows under one shared header: {"columns": [...], "rows": [[...], ...]}.
+    Pretty mode keeps each row on a single line.
+    """
+    if style == "pretty":
+        yield '{\n  "columns": ' + json.dumps(columns) + ',\n  "rows": ['
+        first = True
+        for row in rows:
+            yield ("\n    " if first else ",\n    ") + json.dumps(row)
+            first = False
+        yield "]\n}" if first else "\n  ]\n}"
+    else:
+        yield '{"columns":' + json.dumps(columns, separators=(",", ":")) + ',"rows":'
+        yield from iter_json_array(rows, style)
+        yield "}"
+
+
+def file_digest(path):
+    """sha256 of a file's content, or None if it does not exist."""
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def _hashed_name(path, digest, suffix):
+    """meebits_rules.json -> meebits_rules.<hash>.json.<suffix>"""
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return f"{stem}.{digest[:16]}{ext}.{suffix}"
+
+
+def _remove_stale_siblings(path, keep):
+    stem, ext = os.path.splitext(os.path.basename(path))
+    pattern = re.compile(re.escape(stem) + r"\.[0-9a-f]{16}" + re.escape(ext) + r"\.(gz|br)$")
+    directory = os.path.dirname(path) or "."
+    for name in os.listdir(directory):
+        if pattern.match(name) and name not in keep:
+            os.remove(os.path.join(directory, name))
+
+
+def write_stream(path, chunks, compress=()):
+    """
+    Write text (or bytes) chunks to path, hashing and compressing them as they stream
+    past so the full document never sits in memory. The file (and each
+    compressed sibling) is only replaced if its content changed.
+
+    compress may contain "gz" and/or "br" (needs the brotli package);
+    siblings are named after the content hash. Returns a manifest entry.
+    """
+    if "br" in compress and brotli is None:
+        print(f"  brotli not installed, skipping {os.path.basename(path)}.br")
+        compress = tuple(c for c in compress if c != "br")
+
+    h = hashlib.sha256()
+    size = 0
+    tmp_paths = {"raw": path + ".tmp"}
+    tmp_paths.update((suffix, f"{path}.{suffix}.tmp") for suffix in compress)
+    with contextlib.ExitStack() as stack:
+        raw = stack.enter_context(open(tmp_paths["raw"], "wb"))
+        sinks = [raw.write]
+        if "gz" in compress:
+            gz_file = stack.enter_context(open(tmp_paths["gz"], "wb"))
+            gz = stack.enter_context(gzip.GzipFile(filename="", mode="wb", compresslevel=9,
+                                                   mtime=0, fileobj=gz_file))
+            sinks.append(gz.write)
+        if "br" in compress:
+            br_file = stack.enter_context(open(tmp_paths["br"], "wb"))
+            br = brotli.Compressor(quality=11)
+            sinks.append(lambda data: br_file.write(br.process(data)))
+            stack.callback(lambda: br_file.write(br.finish()))
+
+        for chunk in chunks:
+            data = chunk if isinstance(chunk, bytes) else chunk.encode()
+            h.update(data)
+            size += len(data)
+            for sink in sinks:
+                sink(data)
+
+    digest = h.hexdigest()
+    entry = {"sha256": digest, "bytes": size, "changed": digest != file_digest(path)}
+    if entry["changed"]:
+        os.replace(tmp_paths.pop("raw"), path)
+    directory = os.path.dirname(path) or "."
+    for suffix in compress:
+        entry[suffix] = _hashed_name(path, digest, suffix)
+        os.replace(tmp_paths.pop(suffix), os.path.join(directory, entry[suffix]))
+    for tmp in tmp_paths.values():
+        os.remove(tmp)
+    _remove_stale_siblings(path, [entry[suffix] for suffix in compress])
+    return entry
+
+
+def update_export_manifest(name, entry, options):
+    """Record an export's digest, options and hashed siblings in EXPORT_MANIFEST."""
+    path = os.path.join(OUTPUT_DIR, EXPORT_MANIFEST)
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest[name] = {k: v for k, v in entry.items() if k != "changed"}
+    manifest[name]["options"] = _options_dict(options)
+    write_if_changed(path, json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def export_is_current(name, options):
+    """The manifest says name exists and was written with these options."""
+    path = os.path.join(OUTPUT_DIR, EXPORT_MANIFEST)
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f).get(name)
+    except (OSError, ValueError):
+        return False
+    return (entry is not None and os.path.exists(os.path.join(OUTPUT_DIR, name))
+            and entry.get("options") == _options_dict(options))
+
+
+def _options_dict(options):
+    return {"style": options.style, "layout": options.layout, "compress": sorted(options.compress)}
+
+
+def write_if_changed(path, text):
+    """Write text to path unless it already holds exactly that text. Returns True if written."""
+    try:
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'w') as f:
+        f.write(text)
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Shared pairwise contingency tables
+# ---------------------------------------------------------------------------
+
+class PairCounts:
+    """
+    Value co-occurrence counts of two categories (rows where both are present).
+
+    marginals, if given, are (a_counts, b_counts, total) to use instead of
+    the sums of counts.
+    """
+
+    __slots__ = ("cat_a", "cat_b", "counts", "a_counts", "b_counts", "total")
+
+    def __init__(self, cat_a, cat_b, counts, marginals=None):
+        self.cat_a = cat_a
+        self.cat_b = cat_b
+        self.counts = counts
+        self.a_counts, self.b_counts, self.total = marginals or pair_marginals(counts)
+
+    def nested(self):
+        """Counts regrouped as {code_a: Counter({code_b: count})}."""
+        return nest_pair_counts(self.counts)
+
+
+class ContingencyEngine:
+    """
+    Shared sufficient statistics for every pairwise analysis.
+
+    For each category pair a single bincount over packed
+    (type, gender, value_a, value_b) codes yields the stratified contingency
+    tensor; whole-population, per-type, per-gender and per-(type, gender)
+    matrices are all marginals of it. Tensors and derived PairCounts are
+    cached, so each pair is scanned at most once per run no matter how many
+    analyses ask for it.
+    """
+
+    def __init__(self, table, categories=None):
+        self.table = table
+        self.categories = list(categories or TRAIT_CATEGORIES)
+        self._tensors = {}  # (cat_a, cat_b) -> Counter {(t, g, va, vb): count}
+        self._pairs = {}    # (cat_a, cat_b, type_name, gender) -> PairCounts
+
+    def __len__(self):
+        return len(self._tensors)
+
+    def build(self):
+        """Precompute the stratified tensor for every category pair."""
+        for cat_a, cat_b in combinations(self.categories, 2):
+            self.tensor(cat_a, cat_b)
+        return self
+
+    def tensor(self, cat_a, cat_b):
+        """Counter of {(type, gender, code_a, code_b): count}, both values present."""
+        if (cat_a, cat_b) in self._tensors:
+            return self._tensors[(cat_a, cat_b)]
+        if (cat_b, cat_a) in self._tensors:
+            return Counter({(t, g, vb, va): n
+                            for (t, g, va, vb), n in self._tensors[(cat_b, cat_a)].items()})
+        counts = self.table.joint_counts("type", "gender", cat_a, cat_b, include_missing=True)
+        tensor = Counter({key: n for key, n in counts.items() if key[2] and key[3]})
+        self._tensors[(cat_a, cat_b)] = tensor
+        return tensor
+
+    def _stratum_code(self, col, value):
+        if value is None:
+            return None
+        code = self.table.code(col, value)
+        return -1 if code is None else code
+
+    def pair(self, cat_a, cat_b, type_name=None, gender=None):
+        """PairCounts for a category pair, optionally restricted to a type and/or gender."""
+        key = (cat_a, cat_b, type_name, gender)
+        if key not in self._pairs:
+            t_code = self._stratum_code("type", type_name)
+            g_code = self._stratum_code("gender", gender)
+            counts = Counter()
+            for (t, g, va, vb), n in self.tensor(cat_a, cat_b).items():
+                if t_code is not None and t != t_code:
+                    continue
+                if g_code is not None and g != g_code:
+                    continue
+                counts[(va, vb)] += n
+            self._pairs[key] = PairCounts(cat_a, cat_b, counts)
+        return self._pairs[key]
+
+    def error_bound(self, cat_a, cat_b, va, vb):
+        """None: counts are exact (see SketchEngine.error_bound)."""
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Approximate pair counts (sketches)
+# ---------------------------------------------------------------------------
+
+SKETCH_DEPTH = 4
+# Counters per row with a bare --sketch-width: overcounts stay within e/2048
+# (0.13%) of a pair's rows, and every element pair of the collection fits
+SKETCH_WIDTH = 2048
+# Rows counted exactly at a time while streaming an in-memory table into sketches
+SKETCH_CHUNK = 50_000
+
+
+def _sketch_hash(key):
+    """64-bit hash of a key, stable across processes and runs (unlike hash())."""
+    return int.from_bytes(hashlib.blake2b(repr(key).encode(), digest_size=8).digest(), "little")
+
+
+class CountMinSketch:
+    """
+    Count-min sketch: depth rows of width counters, one counter per row
+    per key. An estimate is the smallest of a key's counters: never below
+    the true count and, with probability 1 - exp(-depth), at most
+    e / width * total above it.
+    """
+
+    def __init__(self, width, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("Q", bytes(8 * width)) for _ in range(depth)]
+        self.total = 0
+
+    def _slots(self, key):
+        # Row i hashes to h1 + i * h2 (double hashing off one digest)
+        h = _sketch_hash(key)
+        h1, h2 = h & 0xFFFFFFFF, h >> 32 | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, n=1):
+        for row, slot in zip(self.rows, self._slots(key)):
+            row[slot] += n
+        self.total += n
+
+    def estimate(self, key):
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(key)))
 
+    def error_bound(self):
+        """Overcount bound holding with probability 1 - exp(-depth)."""
+        return math.ceil(math.e / self.width * self.total)
+
+
+class SpaceSaving:
+    """
+    Weighted Space-Saving heavy hitters in at most capacity counters.
+
+    A new value past capacity evicts the smallest counter and inherits its
+    count as error, so every value counted more than total / capacity
+    times is kept and each kept count overestimates by at most its error.
+    Exact (all errors 0) while capacity covers every distinct value.
+
+    The smallest counter is found through a min-heap of (count, sequence,
+    value) entries, pushed again whenever a count grows; entries whose
+    count is no longer current are skipped when popped, and the heap is
+    rebuilt from the counters once stale entries outnumber them.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}  # value -> [count, error]
+        self._heap = []
+        self._pushed = 0  # tie-break: never compare the values themselves
+
+    def _push(self, value):
+        heapq.heappush(self._heap, (self.counts[value][0], self._pushed, value))
+        self._pushed += 1
+        if len(self._heap) > 2 * len(self.counts) + 16:
+            self._heap = [(count, self._pushed + i, v) for i, (v, (count, _)) in enumerate(self.counts.items())]
+            self._pushed += len(self._heap)
+            heapq.heapify(self._heap)
+
+    def _pop_smallest(self):
+        while True:
+            count, _, value = heapq.heappop(self._heap)
+            counter = self.counts.get(value)
+            if counter is not None and counter[0] == count:
+                del self.counts[value]
+                return count
+
+    def add(self, value, n=1):
+        if value in self.counts:
+            self.counts[value][0] += n
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = [n, 0]
+        else:
+            floor = self._pop_smallest()
+            self.counts[value] = [floor + n, floor]
+        self._push(value)
+
+
+def element_pair_cells(table, categories=ELEMENT_CATS):
+    """
+    {(cat_a, cat_b): [((value_a, value_b), n), ...]} of one chunk or shard,
+    both values present, for every pair of categories. Keys are values, not
+    codes, so cells of tables with different dictionaries can be combined.
+    """
+    cells = {}
+    for cat_a, cat_b in combinations(categories, 2):
+        names_a, names_b = table.values(cat_a), table.values(cat_b)
+        cells[cat_a, cat_b] = [((names_a[va], names_b[vb]), n)
+                               for (va, vb), n in table.joint_counts(cat_a, cat_b).items()]
+    return cells
+
+
+class SketchEngine:
+    """
+    Approximate stand-in for ContingencyEngine in fixed memory.
+
+    Per element category pair: a count-min sketch of value-pair cells,
+    Space-Saving heavy hitters of each side's values and the exact number
+    of rows with both present, so memory depends on width and depth, not
+    on how many records or distinct value pairs there are. pair() returns
+    PairCounts of estimates over every pair of kept values; error_bound()
+    gives the matching bounds. Answers table.values() itself.
+
+    Sketches are filled a chunk or shard at a time (add_cells), never from
+    the collection's exact pair counts.
+    """
+
+    def __init__(self, width, depth=SKETCH_DEPTH, categories=None):
+        self.width = width
+        self.depth = depth
+        self.categories = list(categories or ELEMENT_CATS)
+        self.table = self
+        self.dictionaries = {cat: [None] for cat in self.categories}
+        self._lookups = {cat: {None: 0} for cat in self.categories}
+        self._sketches = {}  # (cat_a, cat_b) -> (CountMinSketch, SpaceSaving, SpaceSaving)
+        self._pairs = {}
+
+    @classmethod
+    def build(cls, table, width, depth=SKETCH_DEPTH, chunk=SKETCH_CHUNK):
+        """Sketch every element category pair of a MeebitTable, chunk rows at a time."""
+        engine = cls(width, depth)
+        for start in range(0, len(table), chunk):
+            engine.add_cells(element_pair_cells(table.slice(start, start + chunk), engine.categories))
+        return engine
+
+    def __len__(self):
+        return len(self._sketches)
+
+    def add_cells(self, pair_cells):
+        """Count {(cat_a, cat_b): [((value_a, value_b), n), ...]} from element_pair_cells."""
+        for (cat_a, cat_b), cells in pair_cells.items():
+            self.add(cat_a, cat_b, cells)
+
+    def add(self, cat_a, cat_b, cells):
+        """Count ((value_a, value_b), n) cells, both values present, into a pair's sketches."""
+        if (cat_a, cat_b) not in self._sketches:
+            self._sketches[cat_a, cat_b] = (CountMinSketch(self.width, self.depth),
+                                            SpaceSaving(self.width), SpaceSaving(self.width))
+        cms, side_a, side_b = self._sketches[cat_a, cat_b]
+        for (va, vb), n in cells:
+            cms.add((va, vb), n)
+            side_a.add(va, n)
+            side_b.add(vb, n)
+        self._pairs.pop((cat_a, cat_b), None)
+
+    def values(self, cat):
+        """Every value kept for a category so far; index with a code to decode it."""
+        return self.dictionaries[cat]
+
+    def code(self, cat, value):
+        """Code for a value, assigned the first time it is seen."""
+        if value not in self._lookups[cat]:
+            self._lookups[cat][value] = len(self.dictionaries[cat])
+            self.dictionaries[cat].append(value)
+        return self._lookups[cat][value]
+
+    def pair(self, cat_a, cat_b):
+        """PairCounts of estimated counts: each cell capped by both of its sides' counts."""
+        if (cat_a, cat_b) not in self._pairs:
+            cms, side_a, side_b = self._sketches[cat_a, cat_b]
+            a_counts = Counter({self.code(cat_a, v): n for v, (n, _) in side_a.counts.items()})
+            b_counts = Counter({self.code(cat_b, v): n for v, (n, _) in side_b.counts.items()})
+            counts = Counter()
+            for va, (na, _) in side_a.counts.items():
+                for vb, (nb, _) in side_b.counts.items():
+                    n = min(cms.estimate((va, vb)), na, nb)
+                    if n:
+                        counts[self.code(cat_a, va), self.code(cat_b, vb)] = n
+            self._pairs[cat_a, cat_b] = PairCounts(cat_a, cat_b, counts,
+                                                   marginals=(a_counts, b_counts, cms.total))
+        return self._pairs[cat_a, cat_b]
+
+    def undersized(self):
+        """
+        Pairs the sketches are too small for, as ((cat_a, cat_b), value
+        pairs, evicted, overcount bound): value pairs is the size of the
+        kept values' grid, which collides in the count-min rows once it
+        exceeds width, and evicted is whether Space-Saving had to drop values.
+        """
+        flagged = []
+        for pair, (cms, side_a, side_b) in self._sketches.items():
+            grid = len(side_a.counts) * len(side_b.counts)
+            evicted = any(error for side in (side_a, side_b) for _, error in side.counts.values())
+            if grid > self.width or evicted:
+                flagged.append((pair, grid, evicted, cms.error_bound()))
+        return flagged
+
+    def error_bound(self, cat_a, cat_b, va, vb):
+        """
+        How far a cell's estimates may overstate: the observed count (with
+        the given probability) and each value's own count.
+        """
+        cms, side_a, side_b = self._sketches[cat_a, cat_b]
+        return {
+            "observed": cms.error_bound(),
+            "count_a": side_a.counts[self.dictionaries[cat_a][va]][1],
+            "count_b": side_b.counts[self.dictionaries[cat_b][vb]][1],
+            "probability": round(1 - math.exp(-self.depth), 4),
+        }
+
+
+def report_sketch(sketch):
+    """Print a SketchEngine's size, with a warning if it is too narrow for the data."""
+    print(f"  Sketched {len(sketch)} category pairs ({sketch.depth} x {sketch.width:,} counters each)")
+    flagged = sketch.undersized()
+    if not flagged:
+        return
+    (cat_a, cat_b), grid, _, _ = max(flagged, key=itemgetter(1))
+    bound = max(map(itemgetter(3), flagged))
+    evicted = sum(map(itemgetter(2), flagged))
+    print(f"  Warning: {len(flagged)} of {len(sketch)} category pairs outgrow {sketch.width:,} counters "
+          f"(largest: {cat_a} + {cat_b}, {grid:,} value pairs"
+          f"{f'; {evicted} evicted heavy hitters' if evicted else ''}), so counts may be "
+          f"overstated by up to {bound:,}; use --sketch-width {max(grid, sketch.width * 2):,} or more")
+
+
+# Gender EM: iteration cap, convergence tolerance on the log affinities, and
+# how many joint-code groups the element categories are fused into
+GENDER_EM_MAX_ITER = 100
+GENDER_EM_TOL = 1e-6
+GENDER_EM_GROUPS = 3
+
+# Humans whose gender posterior falls below this are reported as uncertain
+LOW_GENDER_CONFIDENCE = 0.9
+
+
+def _gender_posteriors(humans, anchored, initial):
+    """
+    Semi-supervised naive Bayes EM over the humans' element columns.
+
+    anchored rows (bearded) stay male; the others start from initial (1 =
+    male, 0 = female). Each pass re-estimates every value's male/female
+    log affinity from the current soft labels (add-one smoothed), then
+    rescores the free rows, until no affinity moves more than GENDER_EM_TOL.
+    Categories are fused into GENDER_EM_GROUPS joint codes, so a pass is a
+    few table lookups per row. Returns (P(male) per row, passes).
+    """
+    cats = [cat for cat in ELEMENT_CATS if cat != "beard"]
+    groups = [cats[i::GENDER_EM_GROUPS] for i in range(GENDER_EM_GROUPS)]
+    is_free = [not a for a in anchored]
+    num_free = sum(is_free)
+    num_anchored = len(anchored) - num_free
+    posteriors = [1.0 if a else float(p) for a, p in zip(anchored, initial)]
+    if not num_free:
+        return posteriors, 0
+
+    # Joint codes of each group over the free rows and the free rows holding
+    # each; per category, every key's code and the keys holding each code
+    group_codes, group_rows, key_codes, code_keys = [], [], {}, {}
+    for group in groups:
+        keys = {}
+        codes = [keys.setdefault(key, len(keys))
+                 for key in compress(zip(*(humans.column(cat) for cat in group)), is_free)]
+        rows = [[] for _ in keys]
+        for i, code in enumerate(codes):
+            rows[code].append(i)
+        group_codes.append(codes)
+        group_rows.append(rows)
+        for k, cat in enumerate(group):
+            key_codes[cat] = [key[k] for key in keys]
+            code_keys[cat] = [[] for _ in humans.values(cat)]
+            for i, code in enumerate(key_codes[cat]):
+                code_keys[cat][code].append(i)
+
+    # Value totals never change, nor do the anchored rows' (all male) counts
+    sizes = {cat: len(humans.values(cat)) for cat in cats}
+    totals = {cat: [0] * sizes[cat] for cat in cats}
+    anchored_male = {cat: [0] * sizes[cat] for cat in cats}
+    for cat in cats:
+        for code, a in zip(humans.column(cat), anchored):
+            totals[cat][code] += 1
+            anchored_male[cat][code] += a
+
+    free = list(compress(posteriors, is_free))
+    affinities = {}
+    for passes in range(1, GENDER_EM_MAX_ITER + 1):
+        # M-step: expected male counts per value, from soft label sums per joint code
+        male_total = math.fsum(free) + num_anchored
+        female_total = len(anchored) - male_total
+        if male_total <= 0 or female_total <= 0:
+            break
+        previous, affinities = affinities, {}
+        for group, rows in zip(groups, group_rows):
+            weights = [sum(map(free.__getitem__, r)) for r in rows]
+            for cat in group:
+                male_norm = male_total + sizes[cat]
+                female_norm = female_total + sizes[cat]
+                affinities[cat] = [
+                    math.log((m + 1) / male_norm) - math.log((t - m + 1) / female_norm)
+                    for m, t in zip(map(add, anchored_male[cat],
+                                        (sum(map(weights.__getitem__, ks)) for ks in code_keys[cat])),
+                                    totals[cat])]
+
+        # E-step: female/male odds are the prior's times one joint-code lookup per group
+        prior = math.log(male_total / female_total)
+        odds = None
+        for i, (group, codes) in enumerate(zip(groups, group_codes)):
+            log_odds = [prior] * len(key_codes[group[0]]) if i == 0 else repeat(0.0)
+            for cat in group:
+                log_odds = list(map(add, log_odds, map(affinities[cat].__getitem__, key_codes[cat])))
+            lut = [math.exp(min(-x, 700.0)) for x in log_odds]
+            lookups = map(lut.__getitem__, codes)
+            odds = lookups if odds is None else map(mul, odds, lookups)
+        free = [1 / (1 + x) for x in odds]
+
+        if previous and max(abs(a - b) for cat in cats
+                            for a, b in zip(affinities[cat], previous[cat])) < GENDER_EM_TOL:
+            break
+
+    free = iter(free)
+    return [1.0 if a else next(free) for a in anchored], passes
+
+
+def beard_cooccurrence(humans):
+    """
+    {(cat, value): (with_beard_count, without_beard_count)} over the humans,
+    for every element value but beards. Sums across disjoint row sets, so
+    shards can each count their own humans.
+    """
+    trait_gender_scores = {}
     for cat in ELEMENT_CATS:
         if cat == "beard":
             continue
         val_with_beard = Counter()
         val_without_beard = Counter()
-        for r in humans:
-            v = r.get(cat)
-            if v is None:
+        for (v, b), n in humans.joint_counts(cat, "beard", include_missing=True).items():
+            if not v:
                 continue
-            if r["token_id"] in bearded_ids:
-                val_with_beard[v] += 1
+            if b:
+                val_with_beard[v] += n
             else:
-                val_without_beard[v] += 1
+                val_without_beard[v] += n
 
-        for v in set(list(val_with_beard.keys()) + list(val_without_beard.keys())):
-            wb = val_with_beard.get(v, 0)
-            wob = val_without_beard.get(v, 0)
-            trait_gender_scores[(cat, v)] = (wb, wob)
+        names = humans.values(cat)
+        for v in set(val_with_beard) | set(val_without_beard):
+            trait_gender_scores[(cat, names[v])] = (val_with_beard[v], val_without_beard[v])
+    return trait_gender_scores
 
-    # Step 3: Classify trait values
-    # Beard rate among all humans: bearded / total
-    beard_rate = len(bearded_ids) / len(humans) if humans else 0
-
-    trait_classification = {}  # {(cat, value): "male" | "female" | "unisex"}
-    male_traits = set()
-    female_traits = set()
 
+def classify_gender_traits(trait_gender_scores, beard_rate):
+    """{(cat, value): "male" | "female" | "unisex"} from beard co-occurrence scores."""
+    trait_classification = {}
     for (cat, v), (wb, wob) in trait_gender_scores.items():
         total = wb + wob
         if total < 5:
@@ -208,118 +1497,292 @@ def infer_gender(records):
 
         if wb == 0 and total >= 10:
             trait_classification[(cat, v)] = "female"
-            female_traits.add((cat, v))
         elif beard_affinity > beard_rate * 1.8:
             trait_classification[(cat, v)] = "male"
-            male_traits.add((cat, v))
         elif beard_affinity < beard_rate * 0.2:
             trait_classification[(cat, v)] = "female"
-            female_traits.add((cat, v))
         else:
             trait_classification[(cat, v)] = "unisex"
+    return trait_classification
 
-    # Step 4: Classify each human by voting
-    gender_map = {}  # token_id -> "male" | "female"
 
-    for r in humans:
-        if r["token_id"] in bearded_ids:
-            gender_map[r["token_id"]] = "male"
+def gender_votes(humans, trait_classification):
+    """Net gender vote per human: +1 per male trait value, -1 per female one."""
+    vote_weight = {"male": 1, "female": -1}
+    net_votes = [0] * len(humans)
+    for cat in ELEMENT_CATS:
+        if cat == "beard":
             continue
+        lut = [vote_weight.get(trait_classification.get((cat, v)), 0)
+               for v in humans.values(cat)]
+        net_votes = list(map(add, net_votes, map(lut.__getitem__, humans.column(cat))))
+    return net_votes
 
-        male_votes = 0
-        female_votes = 0
-        for cat in ELEMENT_CATS:
-            if cat == "beard":
-                continue
-            v = r.get(cat)
-            if v is None:
-                continue
-            cls = trait_classification.get((cat, v), "unisex")
-            if cls == "male":
-                male_votes += 1
-            elif cls == "female":
-                female_votes += 1
-
-        if male_votes > female_votes:
-            gender_map[r["token_id"]] = "male"
-        elif female_votes > male_votes:
-            gender_map[r["token_id"]] = "female"
-        else:
-            # Tie-break: use the most distinctive trait
-            # Default to male if beardless but all unisex traits
-            gender_map[r["token_id"]] = "male"
-
-    # Step 5: Apply gender to records
-    for r in records:
-        if r["type"] == "Human":
-            r["gender"] = gender_map.get(r["token_id"])
-        else:
-            r["gender"] = None
 
-    # Build gender stats
-    gender_counts = Counter(r["gender"] for r in records if r["type"] == "Human")
+def gender_stats(table):
+    """(gender counts among humans, per-gender element value counts) of a gendered table."""
+    gender_counts = table.where("type", "Human").value_counts("gender")
 
     # Build per-gender trait value lists
     gender_trait_values = {"male": defaultdict(Counter), "female": defaultdict(Counter)}
-    for r in records:
-        if r["type"] != "Human" or r.get("gender") is None:
-            continue
-        g = r["gender"]
-        for cat in ELEMENT_CATS:
-            v = r.get(cat)
-            if v is not None:
-                gender_trait_values[g][cat][v] += 1
+    for g in gender_trait_values:
+        subset = table.where("gender", g)
+        for cat in subset.first_present(ELEMENT_CATS):
+            gender_trait_values[g][cat] = subset.value_counts(cat)
+    return gender_counts, gender_trait_values
+
+
+def infer_gender(table):
+    """
+    Infer gender for Human meebits using beard as the anchor trait.
+
+    Strategy:
+    1. Any human with a beard = male (beards are definitively male-only)
+    2. Use beard co-occurrence to classify all other trait values as male-only,
+       female-only, or unisex
+    3. Seed each human's gender by their trait values voting on gender
+    4. Refine by EM (see _gender_posteriors) into a posterior per human;
+       gender is the likelier label and confidence its posterior
+    5. Non-human types get gender=None and no confidence
+
+    Returns (table, gender_counts, trait_classification, gender_trait_values,
+    confidence), confidence holding one value per table row.
+    """
+    humans = table.where("type", "Human")
+
+    # Step 1: Find all bearded humans (definitively male)
+    bearded = [c != 0 for c in humans.column("beard")]
+    num_bearded = sum(bearded)
+
+    # Step 2: Beard co-occurrence of every other trait value
+    trait_gender_scores = beard_cooccurrence(humans)
+
+    # Step 3: Classify trait values against the beard rate among all humans
+    beard_rate = num_bearded / len(humans) if len(humans) else 0
+    trait_classification = classify_gender_traits(trait_gender_scores, beard_rate)
+
+    # Step 4: Seed each human by voting; ties default to male if beardless but all unisex traits
+    seeds = [has_beard or votes >= 0
+             for has_beard, votes in zip(bearded, gender_votes(humans, trait_classification))]
+
+    # Step 5: EM refinement; an exact 0.5 posterior stays male
+    posteriors, passes = _gender_posteriors(humans, bearded, seeds)
+    human_genders = iter(["male" if p >= 0.5 else "female" for p in posteriors])
+    human_confidence = iter([max(p, 1 - p) for p in posteriors])
+    print(f"  EM converged in {passes} passes")
+
+    # Step 6: Apply gender to the table
+    human_code = table.code("type", "Human")
+    table.set_column("gender", [next(human_genders) if c == human_code else None
+                                for c in table.column("type")])
+    confidence = [next(human_confidence) if c == human_code else None
+                  for c in table.column("type")]
+
+    gender_counts, gender_trait_values = gender_stats(table)
+    return table, gender_counts, trait_classification, gender_trait_values, confidence
+
+
+def confident_genders(table, confidence, min_confidence):
+    """
+    (table, humans dropped): the table with the gender of every human whose
+    confidence is below min_confidence cleared, so gender-stratified counts
+    leave them out. Population and per-type counts are unchanged.
+    """
+    if not min_confidence or confidence is None:
+        return table, 0
+    keep = [c is None or c >= min_confidence for c in confidence]
+    genders = table.column("gender")
+    dropped = len(keep) - sum(keep)
+    columns = dict(table.columns)
+    columns["gender"] = array(_typecode(genders), map(mul, genders, keep))
+    return MeebitTable._from_parts(table.token_ids, columns, table), dropped
 
-    return records, gender_counts, trait_classification, gender_trait_values
 
+QUIZ_COLUMNS_PATH = "meebits_quiz_columns.json"
+QUIZ_BUFFER_PATH = "meebits_quiz_columns.bin"
+QUIZ_COLUMNS_VERSION = 1
 
-def export_database(records):
-    """Export meebits_database.json and meebits_database.csv."""
-    # JSON
-    json_path = os.path.join(OUTPUT_DIR, "meebits_database.json")
-    with open(json_path, 'w') as f:
-        json.dump(records, f, indent=2)
-    print(f"Wrote {json_path} ({len(records)} records)")
+# JavaScript typed array for each code width
+_JS_ARRAY_TYPES = {1: "Uint8Array", 2: "Uint16Array", 4: "Uint32Array"}
+
+
+def export_quiz_columns(table, options=ExportOptions()):
+    """
+    Export the token database for the quiz as dictionary-encoded columns: one
+    little-endian Uint8/Uint16 code array per field in a single binary file,
+    each 8-byte aligned so the client can view it as a typed array without
+    copying, plus a small JSON file with offsets and value dictionaries.
+    """
+    blobs = [("token_id", array(_code_typecode(max(table.token_ids, default=0)), table.token_ids))]
+    for col in RECORD_FIELDS[1:]:
+        codes = table.column(col)
+        blobs.append((col, array(_typecode(codes), bytes(codes))))
+    if sys.byteorder == "big":
+        for _, codes in blobs:
+            codes.byteswap()
+
+    header = {"version": QUIZ_COLUMNS_VERSION, "rows": len(table), "buffer": QUIZ_BUFFER_PATH,
+              "columns": {}}
+    offset = 0
+    for name, codes in blobs:
+        offset += -offset % 8
+        header["columns"][name] = {"array": _JS_ARRAY_TYPES[codes.itemsize], "offset": offset}
+        if name != "token_id":
+            header["columns"][name]["values"] = table.values(name)
+        offset += len(codes) * codes.itemsize
+
+    def chunks():
+        written = 0
+        for name, codes in blobs:
+            padding = header["columns"][name]["offset"] - written
+            yield b"\0" * padding + codes.tobytes()
+            written += padding + len(codes) * codes.itemsize
+
+    buffer_path = os.path.join(OUTPUT_DIR, QUIZ_BUFFER_PATH)
+    entry = write_stream(buffer_path, chunks(), options.compress)
+    update_export_manifest(QUIZ_BUFFER_PATH, entry, options)
+    header["buffer_sha256"] = entry["sha256"]
+    header["buffer_bytes"] = entry["bytes"]
+
+    json_path = os.path.join(OUTPUT_DIR, QUIZ_COLUMNS_PATH)
+    entry = write_stream(json_path, json.JSONEncoder(**JSON_STYLES[options.style]).iterencode(header),
+                         options.compress)
+    update_export_manifest(QUIZ_COLUMNS_PATH, entry, options)
+    print(f"Wrote {buffer_path} ({header['buffer_bytes']:,} bytes) and {json_path}")
+
+
+QUIZ_POSTINGS_PATH = "meebits_quiz_postings.json"
+QUIZ_POSTINGS_VERSION = 1
+
+# Static weights of scoreMeebit in MeebitQuiz.jsx (CATEGORY_IMPORTANCE,
+# TYPE_RARE_BOOST); keep in sync with the quiz
+QUIZ_CATEGORY_IMPORTANCE = {
+    "type": 3.0, "shirt": 2.5, "shoes": 2.0, "hair_style": 2.0,
+    "glasses": 2.0, "hat": 1.8, "overshirt": 1.8, "pants": 1.5,
+    "shirt_color": 1.5, "hair_color": 1.2, "beard": 1.5,
+    "earring": 1.0, "necklace": 1.0, "tattoo": 1.2,
+    "shoes_color": 1.0, "pants_color": 1.0, "hat_color": 0.8,
+    "beard_color": 0.6, "glasses_color": 0.6, "overshirt_color": 0.6,
+}
+QUIZ_TYPE_RARE_BOOST = {"Human": 1.0, "Pig": 2.0, "Elephant": 3.0, "Robot": 4.0,
+                        "Skeleton": 5.0, "Visitor": 6.0, "Dissected": 8.0}
+
+# Categories in scoreMeebit's summation order: type, then SCORED_TRAITS
+QUIZ_SCORED_CATEGORIES = [
+    "type", "hair_style", "hair_color", "hat", "hat_color",
+    "beard", "beard_color", "glasses", "glasses_color",
+    "earring", "necklace", "shirt", "shirt_color",
+    "overshirt", "overshirt_color", "pants", "pants_color",
+    "shoes", "shoes_color",
+]
+
+
+def export_quiz_postings(table, options=ExportOptions()):
+    """
+    Export per-(category, value) posting lists for top-k quiz ranking: for
+    every scored category and value ("" = none) the ascending token IDs
+    holding it, base64 little-endian words of id_array, alongside the static
+    category importances and type rarity boosts of scoreMeebit.
+    """
+    id_typecode = _code_typecode(max(table.token_ids, default=0))
+    categories = {}
+    for cat in QUIZ_SCORED_CATEGORIES:
+        names = table.values(cat)
+        rows = defaultdict(list)
+        for row, code in enumerate(table.column(cat)):
+            rows[code].append(row)
+        postings = {}
+        for code in sorted(rows):
+            ids = array(id_typecode, map(table.token_ids.__getitem__, rows[code]))
+            if sys.byteorder == "big":
+                ids.byteswap()
+            postings[names[code] or ""] = {"count": len(ids),
+                                           "token_ids": base64.b64encode(ids.tobytes()).decode("ascii")}
+        categories[cat] = {"importance": QUIZ_CATEGORY_IMPORTANCE[cat], "postings": postings}
+
+    document = {
+        "version": QUIZ_POSTINGS_VERSION,
+        "id_array": _JS_ARRAY_TYPES[array(id_typecode).itemsize],
+        "type_rare_boost": QUIZ_TYPE_RARE_BOOST,
+        "categories": categories,
+    }
+    path = os.path.join(OUTPUT_DIR, QUIZ_POSTINGS_PATH)
+    entry = write_stream(path, json.JSONEncoder(**JSON_STYLES[options.style]).iterencode(document),
+                         options.compress)
+    update_export_manifest(QUIZ_POSTINGS_PATH, entry, options)
+    print(f"Wrote {path} ({entry['bytes']:,} bytes)")
+
+
+def export_database(table, options=ExportOptions(), confidence=None):
+    """
+    Export meebits_database.json and meebits_database.csv, streaming row by
+    row. Every record gains a gender_confidence field after the traits: the
+    posterior of its inferred gender (per row, from infer_gender), rounded to
+    four places, or null (an empty CSV cell) for non-humans.
+    """
+    if confidence is None:
+        confidence = [None] * len(table)
+    confidence = [None if c is None else round(c, 4) for c in confidence]
+
+    def with_confidence(rows, after):
+        for row, c in zip(rows, confidence):
+            row.insert(after, c)
+            yield row
+
+    # JSON - a list of record objects, or one shared header plus value rows
+    json_path = os.path.join(OUTPUT_DIR, DATABASE_PATH)
+    fields = RECORD_FIELDS + ["gender_confidence"]
+    rows = with_confidence(table.rows(), len(RECORD_FIELDS))
+    if options.layout == "rows":
+        chunks = iter_json_rows(fields, rows, options.style)
+    else:
+        records = (dict(zip(fields, row)) for row in rows)
+        chunks = iter_json_array(records, options.style)
+    entry = write_stream(json_path, chunks, options.compress)
+    update_export_manifest(DATABASE_PATH, entry, options)
+    print(f"Wrote {json_path} ({len(table)} records, {entry['bytes']:,} bytes)")
 
     # CSV - now includes gender column
     csv_path = os.path.join(OUTPUT_DIR, "meebits_database.csv")
     columns = ["token_id", "type", "gender"] + TRAIT_CATEGORIES
     with open(csv_path, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
-        writer.writeheader()
-        for r in records:
-            writer.writerow(r)
+        writer = csv.writer(f)
+        writer.writerow(columns[:3] + ["gender_confidence"] + columns[3:])
+        writer.writerows(with_confidence(table.rows(columns), 3))
     print(f"Wrote {csv_path}")
 
+    # Typed-array columns and ranking posting lists for the quiz
+    export_quiz_columns(table, options)
+    export_quiz_postings(table, options)
 
-def analyze_type_level_rules(records):
+
+def analyze_type_level_rules(table):
     """Which trait categories can each type have?"""
     type_traits = defaultdict(lambda: defaultdict(int))
-    type_counts = Counter()
+    type_counts = table.value_counts("type")
+    types = table.values("type")
 
-    for r in records:
-        t = r["type"]
-        type_counts[t] += 1
-        for cat in TRAIT_CATEGORIES:
-            if r.get(cat) is not None:
-                type_traits[t][cat] += 1
+    for cat in TRAIT_CATEGORIES:
+        for (t, _), n in table.joint_counts("type", cat).items():
+            type_traits[types[t]][cat] += n
 
     return dict(type_traits), dict(type_counts)
 
 
-def analyze_exclusion_rules(records):
+def analyze_exclusion_rules(table):
     """Find trait category pairs that NEVER co-occur."""
     # For each pair of trait categories, check if they ever both have values
     cooccurrence = defaultdict(int)
     category_counts = defaultdict(int)
 
-    for r in records:
-        present = [cat for cat in TRAIT_CATEGORIES if r.get(cat) is not None]
-        for cat in present:
-            category_counts[cat] += 1
-        for a, b in combinations(present, 2):
-            key = tuple(sorted([a, b]))
-            cooccurrence[key] += 1
+    for cat in TRAIT_CATEGORIES:
+        present = table.count_present(cat)
+        if present:
+            category_counts[cat] = present
+    for a, b in combinations(TRAIT_CATEGORIES, 2):
+        both = table.count_present(a, b)
+        if both:
+            cooccurrence[tuple(sorted([a, b]))] = both
 
     # Find pairs that never co-occur (both categories have instances but never together)
     never_cooccur = []
@@ -337,46 +1800,28 @@ def analyze_exclusion_rules(records):
     return never_cooccur, dict(cooccurrence), dict(category_counts)
 
 
-def analyze_value_exclusions(records):
+def analyze_value_exclusions(engine):
     """Find specific trait VALUE pairs that never co-occur."""
     # Build value-level co-occurrence data
     # Focus on element-level traits (not colors which have too many combos)
     element_cats = ["hair_style", "hat", "beard", "glasses", "earring",
                     "necklace", "shirt", "overshirt", "pants", "shoes", "tattoo"]
 
-    # Collect all values per category
-    cat_values = defaultdict(set)
-    for r in records:
-        for cat in element_cats:
-            v = r.get(cat)
-            if v is not None:
-                cat_values[cat].add(v)
-
     # For each pair of categories that DO co-occur, find specific value pairs that never appear together
     value_exclusions = []
 
     for cat_a, cat_b in combinations(element_cats, 2):
-        if not cat_values[cat_a] or not cat_values[cat_b]:
-            continue
-
         # Build co-occurrence matrix for these two categories
-        pair_counts = defaultdict(int)
-        a_counts = defaultdict(int)
-        b_counts = defaultdict(int)
-        both_present = 0
-
-        for r in records:
-            va = r.get(cat_a)
-            vb = r.get(cat_b)
-            if va is not None and vb is not None:
-                both_present += 1
-                pair_counts[(va, vb)] += 1
-                a_counts[va] += 1
-                b_counts[vb] += 1
+        pair = engine.pair(cat_a, cat_b)
+        pair_counts = pair.counts
+        a_counts, b_counts, both_present = pair.a_counts, pair.b_counts, pair.total
 
         if both_present == 0:
             continue
 
+        names_a = engine.table.values(cat_a)
+        names_b = engine.table.values(cat_b)
+
         # Find value pairs that never co-occur but both appear when the other category is present
         for va in a_counts:
             for vb in b_counts:
@@ -384,8 +1829,8 @@ def analyze_value_exclusions(records):
                     # Only report if both values are reasonably common (>= 10 occurrences)
                     if a_counts[va] >= 10 and b_counts[vb] >= 10:
                         value_exclusions.append({
-                            "trait_a": f"{cat_a}={va}",
-                            "trait_b": f"{cat_b}={vb}",
+                            "trait_a": f"{cat_a}={names_a[va]}",
+                            "trait_b": f"{cat_b}={names_b[vb]}",
                             "count_a_when_b_present": a_counts[va],
                             "count_b_when_a_present": b_counts[vb],
                             "total_both_present": both_present,
@@ -395,13 +1840,14 @@ def analyze_value_exclusions(records):
     return value_exclusions
 
 
-def analyze_dependency_rules(records):
+def analyze_dependency_rules(table):
     """Find traits that always or nearly always co-occur."""
     dependencies = []
 
     element_cats = ["hair_style", "hat", "beard", "glasses", "earring",
                     "necklace", "shirt", "overshirt", "pants", "shoes",
                     "tattoo", "jersey_number"]
+    present = {cat: table.count_present(cat) for cat in element_cats}
 
     # Check if trait A always implies trait B
     for cat_a in element_cats:
@@ -410,21 +1856,10 @@ def analyze_dependency_rules(records):
                 continue
 
             # Count occurrences
-            a_count = 0
-            a_and_b = 0
-            a_values_with_b = defaultdict(lambda: defaultdict(int))
-
-            for r in records:
-                va = r.get(cat_a)
-                vb = r.get(cat_b)
-                if va is not None:
-                    a_count += 1
-                    if vb is not None:
-                        a_and_b += 1
-                        a_values_with_b[va][vb] += 1
-
+            a_count = present[cat_a]
             if a_count == 0:
                 continue
+            a_and_b = table.count_present(cat_a, cat_b)
 
             ratio = a_and_b / a_count
             if ratio >= 0.95:
@@ -439,18 +1874,14 @@ def analyze_dependency_rules(records):
 
     # Also check specific value dependencies (e.g., jersey_number -> shirt=Jersey)
     value_dependencies = []
-    for r in records:
-        pass  # We'll do this differently
 
     # Check jersey_number -> shirt value
     jn_shirt = Counter()
-    jn_count = 0
-    for r in records:
-        if r.get("jersey_number") is not None:
-            jn_count += 1
-            shirt = r.get("shirt")
-            if shirt:
-                jn_shirt[shirt] += 1
+    jn_count = table.count_present("jersey_number")
+    shirts = table.values("shirt")
+    for (_, s), n in table.joint_counts("jersey_number", "shirt").items():
+        if shirts[s]:
+            jn_shirt[shirts[s]] += n
 
     if jn_count > 0:
         for shirt_val, count in jn_shirt.most_common():
@@ -465,7 +1896,7 @@ def analyze_dependency_rules(records):
     return dependencies, value_dependencies
 
 
-def analyze_conditional_probabilities(records):
+def analyze_conditional_probabilities(engine):
     """Find notable biases in trait co-occurrence beyond random chance."""
     results = []
 
@@ -482,23 +1913,16 @@ def analyze_conditional_probabilities(records):
 
     for elem_cat, color_cat in style_pairs:
         # Build distribution
-        elem_color_counts = defaultdict(lambda: defaultdict(int))
-        color_totals = defaultdict(int)
-        elem_totals = defaultdict(int)
-        total = 0
-
-        for r in records:
-            e = r.get(elem_cat)
-            c = r.get(color_cat)
-            if e is not None and c is not None:
-                elem_color_counts[e][c] += 1
-                color_totals[c] += 1
-                elem_totals[e] += 1
-                total += 1
+        pair = engine.pair(elem_cat, color_cat)
+        elem_totals, color_totals, total = pair.a_counts, pair.b_counts, pair.total
+        elem_color_counts = pair.nested()
 
         if total == 0:
             continue
 
+        elems = engine.table.values(elem_cat)
+        colors = engine.table.values(color_cat)
+
         # Calculate expected vs observed for each (elem, color) pair
         biases = []
         for e in elem_color_counts:
@@ -509,8 +1933,8 @@ def analyze_conditional_probabilities(records):
                     ratio = observed / expected
                     if ratio > 2.0 or ratio < 0.3:
                         biases.append({
-                            "element": e,
-                            "color": c,
+                            "element": elems[e],
+                            "color": colors[c],
                             "observed": observed,
                             "expected": round(expected, 1),
                             "ratio": round(ratio, 2),
@@ -522,7 +1946,7 @@ def analyze_conditional_probabilities(records):
             results.append({
                 "category_pair": f"{elem_cat} + {color_cat}",
                 "total_records": total,
-                "biases": biases[:30]  # Top biases
+                "biases": biases,
             })
 
     # Cross-category biases (e.g., hat style vs shirt style)
@@ -535,23 +1959,16 @@ def analyze_conditional_probabilities(records):
     ]
 
     for cat_a, cat_b in cross_pairs:
-        ab_counts = defaultdict(lambda: defaultdict(int))
-        a_totals = defaultdict(int)
-        b_totals = defaultdict(int)
-        total = 0
-
-        for r in records:
-            va = r.get(cat_a)
-            vb = r.get(cat_b)
-            if va is not None and vb is not None:
-                ab_counts[va][vb] += 1
-                a_totals[va] += 1
-                b_totals[vb] += 1
-                total += 1
+        pair = engine.pair(cat_a, cat_b)
+        a_totals, b_totals, total = pair.a_counts, pair.b_counts, pair.total
+        ab_counts = pair.nested()
 
         if total == 0:
             continue
 
+        names_a = engine.table.values(cat_a)
+        names_b = engine.table.values(cat_b)
+
         biases = []
         for va in ab_counts:
             for vb in ab_counts[va]:
@@ -561,8 +1978,8 @@ def analyze_conditional_probabilities(records):
                     ratio = observed / expected
                     if ratio > 2.0 or ratio < 0.3:
                         biases.append({
-                            "trait_a": f"{cat_a}={va}",
-                            "trait_b": f"{cat_b}={vb}",
+                            "trait_a": f"{cat_a}={names_a[va]}",
+                            "trait_b": f"{cat_b}={names_b[vb]}",
                             "observed": observed,
                             "expected": round(expected, 1),
                             "ratio": round(ratio, 2),
@@ -574,13 +1991,13 @@ def analyze_conditional_probabilities(records):
             results.append({
                 "category_pair": f"{cat_a} + {cat_b}",
                 "total_records": total,
-                "biases": biases[:20]
+                "biases": biases,
             })
 
     return results
 
 
-def analyze_gender_exclusions(records):
+def analyze_gender_exclusions(engine):
     """
     Find value-level exclusion rules WITHIN each gender.
     These are real generation constraints, not gender artifacts.
@@ -590,36 +2007,25 @@ def analyze_gender_exclusions(records):
     gender_artifact_exclusions = []
 
     for gender in ["male", "female"]:
-        subset = [r for r in records if r.get("gender") == gender]
-        if not subset:
-            continue
-
         # Build value co-occurrence within this gender
         for cat_a, cat_b in combinations(ELEMENT_CATS, 2):
-            pair_counts = defaultdict(int)
-            a_counts = defaultdict(int)
-            b_counts = defaultdict(int)
-            both_present = 0
-
-            for r in subset:
-                va = r.get(cat_a)
-                vb = r.get(cat_b)
-                if va is not None and vb is not None:
-                    both_present += 1
-                    pair_counts[(va, vb)] += 1
-                    a_counts[va] += 1
-                    b_counts[vb] += 1
+            pair = engine.pair(cat_a, cat_b, gender=gender)
+            pair_counts = pair.counts
+            a_counts, b_counts, both_present = pair.a_counts, pair.b_counts, pair.total
 
             if both_present == 0:
                 continue
 
+            names_a = engine.table.values(cat_a)
+            names_b = engine.table.values(cat_b)
+
             for va in a_counts:
                 for vb in b_counts:
                     if pair_counts[(va, vb)] == 0:
                         if a_counts[va] >= 10 and b_counts[vb] >= 10:
                             real_exclusions.append({
-                                "trait_a": f"{cat_a}={va}",
-                                "trait_b": f"{cat_b}={vb}",
+                                "trait_a": f"{cat_a}={names_a[va]}",
+                                "trait_b": f"{cat_b}={names_b[vb]}",
                                 "gender": gender,
                                 "count_a": a_counts[va],
                                 "count_b": b_counts[vb],
@@ -631,40 +2037,27 @@ def analyze_gender_exclusions(records):
     # Now compare with the all-population exclusions to find gender artifacts
     # An exclusion that exists in the all-population but NOT within either gender
     # is a gender artifact
-    all_pop_exclusions = set()
-    all_pair_counts = defaultdict(int)
-    all_a_counts = defaultdict(lambda: defaultdict(int))
-    all_b_counts = defaultdict(lambda: defaultdict(int))
-    all_both = defaultdict(int)
-
-    humans = [r for r in records if r["type"] == "Human"]
-
-    for cat_a, cat_b in combinations(ELEMENT_CATS, 2):
-        for r in humans:
-            va = r.get(cat_a)
-            vb = r.get(cat_b)
-            if va is not None and vb is not None:
-                key = (cat_a, cat_b)
-                all_pair_counts[(cat_a, cat_b, va, vb)] += 1
-                all_a_counts[key][va] += 1
-                all_b_counts[key][vb] += 1
-                all_both[key] += 1
-
     # Real within-gender exclusion keys
     real_keys = set()
     for ex in real_exclusions:
         real_keys.add((ex["trait_a"], ex["trait_b"], ex["gender"]))
 
     for cat_a, cat_b in combinations(ELEMENT_CATS, 2):
-        key = (cat_a, cat_b)
-        if all_both[key] == 0:
+        pair = engine.pair(cat_a, cat_b, type_name="Human")
+        pair_counts = pair.counts
+        a_counts, b_counts, both_present = pair.a_counts, pair.b_counts, pair.total
+        if both_present == 0:
             continue
-        for va in all_a_counts[key]:
-            for vb in all_b_counts[key]:
-                if all_pair_counts[(cat_a, cat_b, va, vb)] == 0:
-                    if all_a_counts[key][va] >= 10 and all_b_counts[key][vb] >= 10:
-                        ta = f"{cat_a}={va}"
-                        tb = f"{cat_b}={vb}"
+
+        names_a = engine.table.values(cat_a)
+        names_b = engine.table.values(cat_b)
+
+        for va in a_counts:
+            for vb in b_counts:
+                if pair_counts[(va, vb)] == 0:
+                    if a_counts[va] >= 10 and b_counts[vb] >= 10:
+                        ta = f"{cat_a}={names_a[va]}"
+                        tb = f"{cat_b}={names_b[vb]}"
                         # Is this a within-gender exclusion for either gender?
                         is_real = ((ta, tb, "male") in real_keys or
                                    (ta, tb, "female") in real_keys)
@@ -672,8 +2065,8 @@ def analyze_gender_exclusions(records):
                             gender_artifact_exclusions.append({
                                 "trait_a": ta,
                                 "trait_b": tb,
-                                "count_a": all_a_counts[key][va],
-                                "count_b": all_b_counts[key][vb],
+                                "count_a": a_counts[va],
+                                "count_b": b_counts[vb],
                                 "reason": "cross-gender: traits belong to different genders",
                                 "type": "gender_artifact"
                             })
@@ -681,7 +2074,7 @@ def analyze_gender_exclusions(records):
     return real_exclusions, gender_artifact_exclusions
 
 
-def analyze_gender_conditional_probs(records):
+def analyze_gender_conditional_probs(engine):
     """
     Conditional probability analysis controlling for gender.
     Runs the same analysis but within male-only and female-only populations.
@@ -703,28 +2096,17 @@ def analyze_gender_conditional_probs(records):
     ]
 
     for gender in ["male", "female"]:
-        subset = [r for r in records if r.get("gender") == gender]
-        if not subset:
-            continue
-
         for cat_a, cat_b in cross_pairs:
-            ab_counts = defaultdict(lambda: defaultdict(int))
-            a_totals = defaultdict(int)
-            b_totals = defaultdict(int)
-            total = 0
-
-            for r in subset:
-                va = r.get(cat_a)
-                vb = r.get(cat_b)
-                if va is not None and vb is not None:
-                    ab_counts[va][vb] += 1
-                    a_totals[va] += 1
-                    b_totals[vb] += 1
-                    total += 1
+            pair = engine.pair(cat_a, cat_b, gender=gender)
+            a_totals, b_totals, total = pair.a_counts, pair.b_counts, pair.total
+            ab_counts = pair.nested()
 
             if total == 0:
                 continue
 
+            names_a = engine.table.values(cat_a)
+            names_b = engine.table.values(cat_b)
+
             biases = []
             for va in ab_counts:
                 for vb in ab_counts[va]:
@@ -734,8 +2116,8 @@ def analyze_gender_conditional_probs(records):
                         ratio = observed / expected
                         if ratio > 2.0 or ratio < 0.3:
                             biases.append({
-                                "trait_a": f"{cat_a}={va}",
-                                "trait_b": f"{cat_b}={vb}",
+                                "trait_a": f"{cat_a}={names_a[va]}",
+                                "trait_b": f"{cat_b}={names_b[vb]}",
                                 "observed": observed,
                                 "expected": round(expected, 1),
                                 "ratio": round(ratio, 2),
@@ -748,7 +2130,7 @@ def analyze_gender_conditional_probs(records):
                     "category_pair": f"{cat_a} + {cat_b}",
                     "gender": gender,
                     "total_records": total,
-                    "biases": biases[:20]
+                    "biases": biases,
                 })
 
     # Also do style pairs within gender
@@ -761,28 +2143,17 @@ def analyze_gender_conditional_probs(records):
     ]
 
     for gender in ["male", "female"]:
-        subset = [r for r in records if r.get("gender") == gender]
-        if not subset:
-            continue
-
         for elem_cat, color_cat in style_pairs:
-            elem_color_counts = defaultdict(lambda: defaultdict(int))
-            color_totals = defaultdict(int)
-            elem_totals = defaultdict(int)
-            total = 0
-
-            for r in subset:
-                e = r.get(elem_cat)
-                c = r.get(color_cat)
-                if e is not None and c is not None:
-                    elem_color_counts[e][c] += 1
-                    color_totals[c] += 1
-                    elem_totals[e] += 1
-                    total += 1
+            pair = engine.pair(elem_cat, color_cat, gender=gender)
+            elem_totals, color_totals, total = pair.a_counts, pair.b_counts, pair.total
+            elem_color_counts = pair.nested()
 
             if total == 0:
                 continue
 
+            elems = engine.table.values(elem_cat)
+            colors = engine.table.values(color_cat)
+
             biases = []
             for e in elem_color_counts:
                 for c in elem_color_counts[e]:
@@ -792,8 +2163,8 @@ def analyze_gender_conditional_probs(records):
                         ratio = observed / expected
                         if ratio > 2.0 or ratio < 0.3:
                             biases.append({
-                                "element": e,
-                                "color": c,
+                                "element": elems[e],
+                                "color": colors[c],
                                 "observed": observed,
                                 "expected": round(expected, 1),
                                 "ratio": round(ratio, 2),
@@ -806,7 +2177,7 @@ def analyze_gender_conditional_probs(records):
                     "category_pair": f"{elem_cat} + {color_cat}",
                     "gender": gender,
                     "total_records": total,
-                    "biases": biases[:20]
+                    "biases": biases,
                 })
 
     return results
@@ -816,21 +2187,14 @@ def analyze_gender_conditional_probs(records):
 # NEW ANALYSIS MODULES (v3)
 # ===========================================================================
 
-def analyze_per_type_value_pools(records):
+def analyze_per_type_value_pools(table):
     """Module 1: For each type, enumerate every trait value with counts."""
-    type_value_pools = defaultdict(lambda: defaultdict(Counter))
-    for r in records:
-        t = r["type"]
-        for cat in TRAIT_CATEGORIES:
-            v = r.get(cat)
-            if v is not None:
-                type_value_pools[t][cat][v] += 1
-    # Convert to plain dicts for JSON serialization
     result = {}
-    for t in type_value_pools:
-        result[t] = {}
-        for cat in type_value_pools[t]:
-            result[t][cat] = dict(type_value_pools[t][cat].most_common())
+    for t in table.value_counts("type"):
+        subset = table.where("type", t)
+        # Categories in the order the type's records first show them
+        result[t] = {cat: dict(subset.value_counts(cat).most_common())
+                     for cat in subset.first_present(TRAIT_CATEGORIES)}
     return result
 
 
@@ -860,7 +2224,7 @@ def analyze_type_exclusive_values(type_value_pools):
     return exclusive
 
 
-def analyze_color_element_mappings(records):
+def analyze_color_element_mappings(table):
     """Module 3: For each element value, determine if color is always/never/sometimes present."""
     results = {}
 
@@ -868,16 +2232,16 @@ def analyze_color_element_mappings(records):
         elem_stats = defaultdict(lambda: {
             "with_color": 0, "without_color": 0, "color_dist": Counter()
         })
-        for r in records:
-            e = r.get(elem_cat)
-            if e is None:
+        elems = table.values(elem_cat)
+        colors = table.values(color_cat)
+        for (e, c), n in table.joint_counts(elem_cat, color_cat, include_missing=True).items():
+            if not e:
                 continue
-            c = r.get(color_cat)
-            if c is not None:
-                elem_stats[e]["with_color"] += 1
-                elem_stats[e]["color_dist"][c] += 1
+            if c:
+                elem_stats[elems[e]]["with_color"] += n
+                elem_stats[elems[e]]["color_dist"][colors[c]] += n
             else:
-                elem_stats[e]["without_color"] += 1
+                elem_stats[elems[e]]["without_color"] += n
 
         mappings = []
         for val in sorted(elem_stats.keys()):
@@ -907,43 +2271,36 @@ def analyze_color_element_mappings(records):
     return results
 
 
-def analyze_per_type_exclusions(records):
+def analyze_per_type_exclusions(engine):
     """Module 4: Value exclusion analysis within each non-tiny type."""
     results = {}
+    type_counts = engine.table.value_counts("type")
 
     for type_name in ALL_TYPES:
-        subset = [r for r in records if r["type"] == type_name]
-        if len(subset) < 30:
+        if type_counts[type_name] < 30:
             continue
 
-        min_count = max(3, len(subset) // 50)
+        min_count = max(3, type_counts[type_name] // 50)
         exclusions = []
 
         for cat_a, cat_b in combinations(ELEMENT_CATS, 2):
-            pair_counts = defaultdict(int)
-            a_counts = defaultdict(int)
-            b_counts = defaultdict(int)
-            both_present = 0
-
-            for r in subset:
-                va = r.get(cat_a)
-                vb = r.get(cat_b)
-                if va is not None and vb is not None:
-                    both_present += 1
-                    pair_counts[(va, vb)] += 1
-                    a_counts[va] += 1
-                    b_counts[vb] += 1
+            pair = engine.pair(cat_a, cat_b, type_name=type_name)
+            pair_counts = pair.counts
+            a_counts, b_counts, both_present = pair.a_counts, pair.b_counts, pair.total
 
             if both_present == 0:
                 continue
 
+            names_a = engine.table.values(cat_a)
+            names_b = engine.table.values(cat_b)
+
             for va in a_counts:
                 for vb in b_counts:
                     if pair_counts[(va, vb)] == 0:
                         if a_counts[va] >= min_count and b_counts[vb] >= min_count:
                             exclusions.append({
-                                "trait_a": f"{cat_a}={va}",
-                                "trait_b": f"{cat_b}={vb}",
+                                "trait_a": f"{cat_a}={names_a[va]}",
+                                "trait_b": f"{cat_b}={names_b[vb]}",
                                 "count_a": a_counts[va],
                                 "count_b": b_counts[vb],
                                 "total_both_present": both_present,
@@ -955,36 +2312,31 @@ def analyze_per_type_exclusions(records):
     return results
 
 
-def analyze_jersey_number_rules(records):
-    """Module 5: Comprehensive jersey number analysis."""
-    jn_records = [r for r in records if r.get("jersey_number") is not None]
-    non_jn = [r for r in records if r.get("jersey_number") is None]
+def analyze_jersey_number_rules(index):
+    """Module 5: Comprehensive jersey number analysis (over BitmapIndex views)."""
+    jn_table = index.present("jersey_number")
+    non_jn = index.where("jersey_number", None)
 
     # Jersey shirt names (shirts associated with jerseys)
     jersey_shirt_names = {"Jersey", "Classic Jersey", "Basketball Jersey", "Snoutz Jersey"}
 
     # Bidirectional check: shirts with jersey name but no number
-    shirts_no_number = 0
-    for r in non_jn:
-        if r.get("shirt") in jersey_shirt_names:
-            shirts_no_number += 1
+    shirts_no_number = sum(n for shirt, n in non_jn.value_counts("shirt").items()
+                           if shirt in jersey_shirt_names)
 
     # Numbers with non-jersey shirts
-    non_jersey_shirts_with_number = 0
-    for r in jn_records:
-        if r.get("shirt") not in jersey_shirt_names:
-            non_jersey_shirts_with_number += 1
+    jn_shirts = jn_table.value_counts("shirt", include_missing=True)
+    non_jersey_shirts_with_number = sum(n for shirt, n in jn_shirts.items()
+                                        if shirt not in jersey_shirt_names)
 
     analysis = {
-        "total_with_jersey_number": len(jn_records),
+        "total_with_jersey_number": len(jn_table),
         "total_without_jersey_number": len(non_jn),
-        "number_distribution": dict(Counter(r["jersey_number"] for r in jn_records).most_common()),
+        "number_distribution": dict(jn_table.value_counts("jersey_number").most_common()),
         "by_type": {},
         "by_gender": {},
-        "shirt_distribution_with_jn": dict(Counter(r.get("shirt") for r in jn_records).most_common()),
-        "shirt_color_distribution_with_jn": dict(Counter(
-            r.get("shirt_color") for r in jn_records if r.get("shirt_color") is not None
-        ).most_common()),
+        "shirt_distribution_with_jn": dict(jn_shirts.most_common()),
+        "shirt_color_distribution_with_jn": dict(jn_table.value_counts("shirt_color").most_common()),
         "bidirectional_check": {
             "jersey_shirts_without_number": shirts_no_number,
             "non_jersey_shirts_with_number": non_jersey_shirts_with_number,
@@ -994,82 +2346,83 @@ def analyze_jersey_number_rules(records):
 
     # By type
     for t in ALL_TYPES:
-        type_jn = [r for r in jn_records if r["type"] == t]
-        if type_jn:
+        type_jn = jn_table.where("type", t)
+        if len(type_jn):
             analysis["by_type"][t] = {
                 "count": len(type_jn),
-                "numbers": dict(Counter(r["jersey_number"] for r in type_jn).most_common()),
-                "shirts": dict(Counter(r.get("shirt") for r in type_jn).most_common()),
+                "numbers": dict(type_jn.value_counts("jersey_number").most_common()),
+                "shirts": dict(type_jn.value_counts("shirt", include_missing=True).most_common()),
             }
 
     # By gender (humans only)
     for g in ["male", "female"]:
-        g_jn = [r for r in jn_records if r.get("gender") == g]
-        if g_jn:
+        g_jn = jn_table.where("gender", g)
+        if len(g_jn):
             analysis["by_gender"][g] = {
                 "count": len(g_jn),
-                "shirts": dict(Counter(r.get("shirt") for r in g_jn).most_common()),
+                "shirts": dict(g_jn.value_counts("shirt", include_missing=True).most_common()),
             }
 
     return analysis
 
 
-def analyze_tattoo_structure(records):
+def analyze_tattoo_structure(table):
     """Module 6: Decode tattoo encoding scheme and structural rules."""
-    tattoo_records = [r for r in records if r.get("tattoo") is not None]
+    tattooed = table.present("tattoo")
 
-    comma_sep = []
-    single_seg = []
+    # Work over distinct tattoo codes weighted by how many Meebits carry them
+    comma_sep = {}
+    single_seg = {}
 
-    for r in tattoo_records:
-        code = r["tattoo"]
+    for code, n in tattooed.value_counts("tattoo").items():
         if "," in code:
-            comma_sep.append(r)
+            comma_sep[code] = n
         else:
-            single_seg.append(r)
+            single_seg[code] = n
 
     # Comma-separated analysis
     comma_chars = Counter()
     comma_halves_identical = 0
     comma_lengths = Counter()
-    for r in comma_sep:
-        code = r["tattoo"]
+    for code, n in comma_sep.items():
         parts = code.split(",")
         if len(parts) == 2 and parts[0] == parts[1]:
-            comma_halves_identical += 1
+            comma_halves_identical += n
         for ch in code.replace(",", ""):
-            comma_chars[ch] += 1
-        comma_lengths[len(parts[0])] += 1
+            comma_chars[ch] += n
+        comma_lengths[len(parts[0])] += n
 
     # Single-segment analysis
     single_chars = Counter()
     single_palindromic = 0
     single_lengths = Counter()
-    for r in single_seg:
-        code = r["tattoo"]
+    for code, n in single_seg.items():
         if code == code[::-1]:
-            single_palindromic += 1
+            single_palindromic += n
         for ch in code:
-            single_chars[ch] += 1
-        single_lengths[len(code)] += 1
+            single_chars[ch] += n
+        single_lengths[len(code)] += n
+
+    comma_count = sum(comma_sep.values())
+    single_count = sum(single_seg.values())
 
     analysis = {
-        "total_tattooed": len(tattoo_records),
-        "by_type": dict(Counter(r["type"] for r in tattoo_records).most_common()),
-        "by_gender": dict(Counter(r.get("gender") for r in tattoo_records if r.get("gender")).most_common()),
+        "total_tattooed": len(tattooed),
+        "by_type": dict(tattooed.value_counts("type").most_common()),
+        "by_gender": dict(tattooed.value_counts("gender").most_common()),
         "families": {
             "comma_separated": {
-                "count": len(comma_sep),
+                "count": comma_count,
                 "halves_identical": comma_halves_identical,
-                "halves_identical_pct": round(comma_halves_identical / max(1, len(comma_sep)) * 100, 1),
+                "halves_identical_pct": round(comma_halves_identical / max(1, comma_count) * 100, 1),
                 "alphabet": sorted(comma_chars.keys()),
                 "char_counts": dict(comma_chars.most_common()),
                 "half_length_distribution": dict(comma_lengths.most_common()),
             },
             "single_segment": {
-                "count": len(single_seg),
+                "count": single_count,
                 "palindromic": single_palindromic,
-                "palindromic_pct": round(single_palindromic / max(1, len(single_seg)) * 100, 1),
+                "palindromic_pct": round(single_palindromic / max(1, single_count) * 100, 1),
                 "alphabet": sorted(single_chars.keys()),
                 "char_counts": dict(single_chars.most_common()),
                 "length_distribution": dict(single_lengths.most_common()),
@@ -1079,135 +2432,254 @@ def analyze_tattoo_structure(records):
         "by_gender_and_family": {},
     }
 
-    # Per-type family breakdown
-    for r in tattoo_records:
-        t = r["type"]
-        if t not in analysis["by_type_and_family"]:
-            analysis["by_type_and_family"][t] = {"comma_separated": 0, "single_segment": 0}
-        family = "comma_separated" if "," in r["tattoo"] else "single_segment"
-        analysis["by_type_and_family"][t][family] += 1
-
-    # Per-gender family breakdown
-    for r in tattoo_records:
-        g = r.get("gender")
-        if g is None:
-            continue
-        if g not in analysis["by_gender_and_family"]:
-            analysis["by_gender_and_family"][g] = {"comma_separated": 0, "single_segment": 0}
-        family = "comma_separated" if "," in r["tattoo"] else "single_segment"
-        analysis["by_gender_and_family"][g][family] += 1
+    # Per-type and per-gender family breakdowns
+    codes = tattooed.values("tattoo")
+    for col, key in [("type", "by_type_and_family"), ("gender", "by_gender_and_family")]:
+        names = tattooed.values(col)
+        for (v, code), n in tattooed.joint_counts(col, "tattoo").items():
+            if names[v] not in analysis[key]:
+                analysis[key][names[v]] = {"comma_separated": 0, "single_segment": 0}
+            family = "comma_separated" if "," in codes[code] else "single_segment"
+            analysis[key][names[v]][family] += n
 
     return analysis
 
 
-def analyze_near_exclusions(records):
+def analyze_near_exclusions(engine):
     """Module 7: Find near-exclusions (soft rules) - pairs that almost never co-occur."""
     near_exclusions = []
 
     for cat_a, cat_b in combinations(ELEMENT_CATS, 2):
-        pair_counts = defaultdict(int)
-        a_counts = defaultdict(int)
-        b_counts = defaultdict(int)
-        both_present = 0
-
-        for r in records:
-            va = r.get(cat_a)
-            vb = r.get(cat_b)
-            if va is not None and vb is not None:
-                both_present += 1
-                pair_counts[(va, vb)] += 1
-                a_counts[va] += 1
-                b_counts[vb] += 1
+        pair = engine.pair(cat_a, cat_b)
+        pair_counts = pair.counts
+        a_counts, b_counts, both_present = pair.a_counts, pair.b_counts, pair.total
 
         if both_present == 0:
             continue
 
+        names_a = engine.table.values(cat_a)
+        names_b = engine.table.values(cat_b)
+
         for va in a_counts:
             for vb in b_counts:
                 observed = pair_counts[(va, vb)]
                 expected = (a_counts[va] * b_counts[vb]) / both_present
                 # Near-exclusion: observed is 1-5 but expected is much higher
                 if expected >= 5 and 0 < observed <= 5 and observed / expected < 0.1:
-                    near_exclusions.append({
-                        "trait_a": f"{cat_a}={va}",
-                        "trait_b": f"{cat_b}={vb}",
+                    rule = {
+                        "trait_a": f"{cat_a}={names_a[va]}",
+                        "trait_b": f"{cat_b}={names_b[vb]}",
                         "observed": observed,
                         "expected": round(expected, 1),
                         "ratio": round(observed / expected, 4),
-                    })
+                    }
+                    bound = engine.error_bound(cat_a, cat_b, va, vb)
+                    if bound:
+                        rule["error_bound"] = bound
+                    near_exclusions.append(rule)
 
     near_exclusions.sort(key=lambda x: x["ratio"])
     return near_exclusions
 
 
-def analyze_comprehensive_biases(records):
-    """Module 8: All-pairs bias analysis with significance testing."""
+def analyze_comprehensive_biases(engine, fdr=0.001):
+    """
+    Module 8: All-pairs bias analysis with significance testing.
+
+    Every cell with observed >= 3 across all pairs is tested (see
+    contingency_log_pvalues) and the p-values are FDR-corrected together
+    with Benjamini-Hochberg; a bias needs q < fdr and a 1.5x effect.
+    """
     results = []
 
-    all_pairs = list(combinations(ELEMENT_CATS, 2))
+    # Pass 1: test every candidate cell of every pair
+    tests = []
+    for cat_a, cat_b in combinations(ELEMENT_CATS, 2):
+        pair = engine.pair(cat_a, cat_b)
+        if pair.total == 0:
+            continue
+        candidates = {cell: n for cell, n in pair.counts.items() if n >= 3}
+        log_p = contingency_log_pvalues(candidates, pair.a_counts, pair.b_counts, pair.total)
+        tests.extend((pair, cell, lp) for cell, lp in log_p.items())
+    log_q = benjamini_hochberg([lp for _, _, lp in tests])
+
+    # Pass 2: keep cells that survive FDR with a meaningful effect size
+    log_fdr = math.log(fdr)
+    by_pair = defaultdict(list)
+    for (pair, (va, vb), lp), lq in zip(tests, log_q):
+        observed = pair.counts[(va, vb)]
+        expected = (pair.a_counts[va] * pair.b_counts[vb]) / pair.total
+        ratio = observed / expected
+        if lq < log_fdr and (ratio > 1.5 or ratio < 0.67):
+            bias = {
+                "trait_a": f"{pair.cat_a}={engine.table.values(pair.cat_a)[va]}",
+                "trait_b": f"{pair.cat_b}={engine.table.values(pair.cat_b)[vb]}",
+                "observed": observed,
+                "expected": round(expected, 1),
+                "ratio": round(ratio, 2),
+                "direction": "overrepresented" if ratio > 1 else "underrepresented",
+                "log10_p": round(lp / LOG_10, 2),
+                "log10_q": round(lq / LOG_10, 2),
+            }
+            bound = engine.error_bound(pair.cat_a, pair.cat_b, va, vb)
+            if bound:
+                bias["error_bound"] = bound
+            by_pair[pair].append(bias)
+
+    for pair, biases in by_pair.items():
+        biases.sort(key=lambda x: x["ratio"], reverse=True)
+        results.append({
+            "category_pair": f"{pair.cat_a} + {pair.cat_b}",
+            "total_records": pair.total,
+            "num_biases": len(biases),
+            "biases": biases,
+        })
 
-    for cat_a, cat_b in all_pairs:
-        ab_counts = defaultdict(lambda: defaultdict(int))
-        a_totals = defaultdict(int)
-        b_totals = defaultdict(int)
-        total = 0
+    return results
 
-        for r in records:
-            va = r.get(cat_a)
-            vb = r.get(cat_b)
-            if va is not None and vb is not None:
-                ab_counts[va][vb] += 1
-                a_totals[va] += 1
-                b_totals[vb] += 1
-                total += 1
 
-        if total == 0:
-            continue
+# Never-observed value pairs are only tested if independence predicts at least this many
+COLOR_MIN_EXPECTED = 5
 
-        biases = []
-        for va in ab_counts:
-            for vb in ab_counts[va]:
-                observed = ab_counts[va][vb]
-                expected = (a_totals[va] * b_totals[vb]) / total
-                if expected > 0 and observed >= 3:
-                    ratio = observed / expected
-                    p_val = chi_squared_pvalue(observed, expected)
-                    if p_val < 0.001 and (ratio > 1.5 or ratio < 0.67):
-                        biases.append({
-                            "trait_a": f"{cat_a}={va}",
-                            "trait_b": f"{cat_b}={vb}",
-                            "observed": observed,
-                            "expected": round(expected, 1),
-                            "ratio": round(ratio, 2),
-                            "direction": "overrepresented" if ratio > 1 else "underrepresented",
-                        })
 
-        if biases:
-            biases.sort(key=lambda x: x["ratio"], reverse=True)
-            results.append({
-                "category_pair": f"{cat_a} + {cat_b}",
-                "total_records": total,
-                "num_biases": len(biases),
-                "biases": biases[:30],
+def _zero_cell_candidates(pair, min_expected):
+    """
+    {(va, vb): 0} for value pairs never seen together that independence
+    expects at least min_expected times. For each A value only the prefix
+    of B values (most common first) that can reach min_expected is walked,
+    so the work is bounded by total / min_expected cells rather than
+    |A| x |B|.
+    """
+    b_by_count = sorted(pair.b_counts.items(), key=lambda kv: -kv[1])
+    floor = min_expected * pair.total
+    zeros = {}
+    for va, na in pair.a_counts.items():
+        for vb, nb in b_by_count:
+            if na * nb < floor:
+                break
+            if (va, vb) not in pair.counts:
+                zeros[(va, vb)] = 0
+    return zeros
+
+
+def analyze_color_cooccurrence(engine, fdr=0.001, min_expected=COLOR_MIN_EXPECTED):
+    """
+    Module 10: Cross-category color harmony.
+
+    Covers every color x color and color x element category pair (an
+    element against its own color is the color-element mappings' job).
+    Only non-zero cells are stored and scanned: observed cells (>= 3) come
+    straight from the engine's sparse counts, and the only empty cells
+    tested are those expected at least min_expected times. Cells are tested
+    like the comprehensive biases and FDR-corrected together; an empty cell
+    that survives is an exclusion, an observed one a bias (1.5x effect).
+    """
+    pairs = [(a, b) for a, b in combinations(COLOR_CATS, 2)]
+    pairs += [(color, element) for color in COLOR_CATS for element in ELEMENT_CATS
+              if (element, color) not in ELEMENT_COLOR_PAIRS]
+
+    tests = []
+    scanned = []
+    for cat_a, cat_b in pairs:
+        pair = engine.pair(cat_a, cat_b)
+        if pair.total == 0:
+            continue
+        scanned.append(pair)
+        candidates = {cell: n for cell, n in pair.counts.items() if n >= 3}
+        candidates.update(_zero_cell_candidates(pair, min_expected))
+        log_p = contingency_log_pvalues(candidates, pair.a_counts, pair.b_counts, pair.total)
+        tests.extend((pair, cell, lp) for cell, lp in log_p.items())
+    log_q = benjamini_hochberg([lp for _, _, lp in tests])
+
+    log_fdr = math.log(fdr)
+    found = defaultdict(lambda: {"exclusions": [], "biases": []})
+    for (pair, (va, vb), lp), lq in zip(tests, log_q):
+        if lq >= log_fdr:
+            continue
+        observed = pair.counts[(va, vb)]
+        expected = (pair.a_counts[va] * pair.b_counts[vb]) / pair.total
+        ratio = observed / expected
+        trait_a = f"{pair.cat_a}={engine.table.values(pair.cat_a)[va]}"
+        trait_b = f"{pair.cat_b}={engine.table.values(pair.cat_b)[vb]}"
+        if observed == 0:
+            found[pair]["exclusions"].append({
+                "trait_a": trait_a,
+                "trait_b": trait_b,
+                "count_a_when_b_present": pair.a_counts[va],
+                "count_b_when_a_present": pair.b_counts[vb],
+                "expected": round(expected, 1),
+                "log10_q": round(lq / LOG_10, 2),
+            })
+        elif ratio > 1.5 or ratio < 0.67:
+            found[pair]["biases"].append({
+                "trait_a": trait_a,
+                "trait_b": trait_b,
+                "observed": observed,
+                "expected": round(expected, 1),
+                "ratio": round(ratio, 2),
+                "direction": "overrepresented" if ratio > 1 else "underrepresented",
+                "log10_q": round(lq / LOG_10, 2),
             })
 
+    # Every scanned pair is listed, so "no rule" is distinguishable from "not tested"
+    results = []
+    for pair in scanned:
+        f = found.get(pair, {"exclusions": [], "biases": []})
+        f["exclusions"].sort(key=lambda x: x["expected"], reverse=True)
+        f["biases"].sort(key=lambda x: x["ratio"], reverse=True)
+        results.append({
+            "category_pair": f"{pair.cat_a} + {pair.cat_b}",
+            "kind": "color-color" if pair.cat_b in COLOR_CATS else "color-element",
+            "total_records": pair.total,
+            "cells_stored": len(pair.counts),
+            "cells_dense": len(pair.a_counts) * len(pair.b_counts),
+            "num_exclusions": len(f["exclusions"]),
+            "num_biases": len(f["biases"]),
+            "exclusions": f["exclusions"],
+            "biases": f["biases"],
+        })
     return results
 
 
-def analyze_three_way_interactions(records, comprehensive_biases):
-    """Module 9: Detect three-way interactions by stratifying pairwise biases."""
-    # Collect the strongest pairwise biases as seeds
-    seed_biases = []
-    for cp in comprehensive_biases:
-        for b in cp["biases"][:5]:  # Top 5 per pair
-            if b["ratio"] > 3.0 or b["ratio"] < 0.3:
-                seed_biases.append(b)
+# A three-way spread is capped here, so a stratum with no co-occurrences
+# ranks as the strongest possible interaction rather than a sentinel
+THREE_WAY_MAX_SPREAD = 100.0
+
+
+def _log_spread_pvalue(high, low):
+    """
+    Two-sided log p-value that two strata share one observed/expected
+    ratio. Given their n = observed_high + observed_low co-occurrences,
+    equal ratios put observed_low ~ Binomial(n, expected_low / (both
+    expected)).
+    """
+    n = high["ab"] + low["ab"]
+    share = low["expected"] / (high["expected"] + low["expected"])
+    tail = log_binomial_tail(low["ab"], n, share, upper=low["ab"] > n * share)
+    return min(0.0, math.log(2) + tail)
+
+
+def analyze_three_way_interactions(index, comprehensive_biases, max_seeds=None, fdr=0.001):
+    """
+    Module 9: Detect three-way interactions by stratifying pairwise biases.
+
+    Every significant pairwise bias is a seed (optionally capped at
+    max_seeds, strongest first); stratified counts come from the bitmap
+    index, so no seed rescans the records.
 
+    The strata with the highest and lowest ratio must differ significantly
+    (see _log_spread_pvalue, FDR-corrected over the candidate spreads
+    with Benjamini-Hochberg) as well as by 3x, so a few records in a small
+    stratum cannot make an interaction. The spread is capped at
+    THREE_WAY_MAX_SPREAD.
+    """
+    seed_biases = [b for cp in comprehensive_biases for b in cp["biases"]]
     seed_biases.sort(key=lambda x: abs(math.log(max(x["ratio"], 0.01))), reverse=True)
-    seed_biases = seed_biases[:80]  # Cap at 80 seeds
-
-    three_way = []
+    seed_biases = seed_biases[:max_seeds]
 
+    # Pass 1: stratify every seed by every other category and test its extreme strata
+    candidates = []
+    tests = []
     for bias in seed_biases:
         cat_a, val_a = parse_trait_key(bias["trait_a"])
         cat_b, val_b = parse_trait_key(bias["trait_b"])
@@ -1217,20 +2689,10 @@ def analyze_three_way_interactions(records, comprehensive_biases):
                 continue
 
             # Stratify by cat_c values
-            strata = defaultdict(lambda: {"ab": 0, "a": 0, "b": 0, "total": 0})
-            for r in records:
-                va = r.get(cat_a)
-                vb = r.get(cat_b)
-                vc = r.get(cat_c)
-                if va is not None and vb is not None and vc is not None:
-                    s = strata[vc]
-                    s["total"] += 1
-                    if va == val_a:
-                        s["a"] += 1
-                    if vb == val_b:
-                        s["b"] += 1
-                    if va == val_a and vb == val_b:
-                        s["ab"] += 1
+            strata = {vc: dict(zip(("ab", "a", "b", "total"), counts)) for vc, counts
+                      in index.stratify((cat_a, val_a), (cat_b, val_b), cat_c).items()}
+
+            names_c = index.table.values(cat_c)
 
             # Check if the bias varies significantly across strata
             stratum_ratios = []
@@ -1239,44 +2701,67 @@ def analyze_three_way_interactions(records, comprehensive_biases):
                     continue
                 expected = (s["a"] * s["b"]) / s["total"]
                 if expected >= 1:
-                    ratio = s["ab"] / expected
-                    stratum_ratios.append({
-                        "stratum": f"{cat_c}={vc}",
+                    s["expected"] = expected
+                    stratum_ratios.append((s["ab"] / expected, s, {
+                        "stratum": f"{cat_c}={names_c[vc]}",
                         "observed": s["ab"],
                         "expected": round(expected, 1),
-                        "ratio": round(ratio, 2),
+                        "ratio": round(s["ab"] / expected, 2),
                         "n": s["total"],
-                    })
+                    }))
 
             if len(stratum_ratios) < 2:
                 continue
 
             # Is there meaningful variation across strata?
-            ratios = [sr["ratio"] for sr in stratum_ratios]
-            max_ratio = max(ratios)
-            min_ratio = min(ratios)
+            max_ratio, high, _ = max(stratum_ratios, key=itemgetter(0))
+            min_ratio, low, _ = min(stratum_ratios, key=itemgetter(0))
 
-            # Significant if the ratio range spans a 3x difference
+            # Large if the ratio range spans a 3x difference
             # or if some strata flip direction
-            if max_ratio > 0 and min_ratio > 0:
-                spread = max_ratio / max(min_ratio, 0.01)
-            else:
-                spread = 9999.0
-
+            spread = min(max_ratio / min_ratio if min_ratio > 0 else THREE_WAY_MAX_SPREAD,
+                         THREE_WAY_MAX_SPREAD)
             if spread >= 3.0:
-                three_way.append({
-                    "pair": f"{bias['trait_a']} + {bias['trait_b']}",
-                    "overall_ratio": bias["ratio"],
-                    "stratified_by": cat_c,
-                    "spread": round(spread, 2),
-                    "strata": sorted(stratum_ratios, key=lambda x: x["ratio"], reverse=True)[:10],
-                })
+                candidates.append((bias, cat_c, spread, [sr for _, _, sr in stratum_ratios]))
+                tests.append(_log_spread_pvalue(high, low))
+    log_q = benjamini_hochberg(tests)
+
+    # Pass 2: keep spreads that survive FDR
+    log_fdr = math.log(fdr)
+    three_way = []
+    for (bias, cat_c, spread, stratum_ratios), lq in zip(candidates, log_q):
+        if lq < log_fdr:
+            three_way.append({
+                "pair": f"{bias['trait_a']} + {bias['trait_b']}",
+                "overall_ratio": bias["ratio"],
+                "stratified_by": cat_c,
+                "spread": round(spread, 2),
+                "log10_q": round(lq / LOG_10, 2),
+                "strata": sorted(stratum_ratios, key=lambda x: x["ratio"], reverse=True)[:10],
+            })
 
     three_way.sort(key=lambda x: x["spread"], reverse=True)
-    return three_way[:100]
+    return three_way
+
+
+def _dominant_values(pair, min_support, min_confidence):
+    """{va: (vb, count, total)} for values of A that (nearly) fix the value of B."""
+    dominant = {}
+    for va, b_counts in pair.nested().items():
+        total = sum(b_counts.values())
+        if total < min_support:
+            continue
+        top_value, top_count = b_counts.most_common(1)[0]
+        if top_count / total >= min_confidence:
+            dominant[va] = (top_value, top_count, total)
+    return dominant
+
 
+def _rule_type(ratio):
+    return "deterministic" if ratio == 1.0 else "near_deterministic"
 
-def analyze_deterministic_rules(records):
+
+def analyze_deterministic_rules(engine, min_support=10, min_confidence=0.95):
     """Module 10: Find cases where one trait value perfectly determines another."""
     deterministic = []
 
@@ -1285,33 +2770,114 @@ def analyze_deterministic_rules(records):
             if cat_a == cat_b:
                 continue
 
-            a_to_b = defaultdict(Counter)
-            for r in records:
-                va = r.get(cat_a)
-                vb = r.get(cat_b)
-                if va is not None and vb is not None:
-                    a_to_b[va][vb] += 1
+            names_a = engine.table.values(cat_a)
+            names_b = engine.table.values(cat_b)
+            dominant = _dominant_values(engine.pair(cat_a, cat_b), min_support, min_confidence)
 
-            for va, b_counts in a_to_b.items():
-                total = sum(b_counts.values())
-                if total < 10:
-                    continue
-                top_value, top_count = b_counts.most_common(1)[0]
+            for va, (top_value, top_count, total) in dominant.items():
                 ratio = top_count / total
-                if ratio >= 0.95:
-                    deterministic.append({
-                        "if_trait": f"{cat_a}={va}",
-                        "then_trait": f"{cat_b}={top_value}",
-                        "count": top_count,
-                        "total": total,
-                        "ratio": round(ratio, 4),
-                        "type": "deterministic" if ratio == 1.0 else "near_deterministic",
-                    })
+                deterministic.append({
+                    "if_trait": f"{cat_a}={names_a[va]}",
+                    "then_trait": f"{cat_b}={names_b[top_value]}",
+                    "count": top_count,
+                    "total": total,
+                    "ratio": round(ratio, 4),
+                    "type": _rule_type(ratio),
+                })
 
     deterministic.sort(key=lambda x: (-x["ratio"], -x["total"]))
     return deterministic
 
 
+def analyze_multi_attribute_rules(engine, index, min_support=10, min_confidence=0.95):
+    """
+    Module 10b: Two-attribute determinants, e.g. (hat=X, hat_color=Y) => shirt=Z.
+
+    Only minimal rules are reported: B is skipped for a value pair when either
+    value already determines B on its own, or when the cached pairwise tables
+    show too few rows with B. Otherwise one popcount gives the pair's rows
+    with B, and only values whose pairwise counts could reach
+    min_confidence of that are counted exactly.
+    """
+    table = engine.table
+
+    # Per (A, B): B-value counts for each A value, plus which A values determine B
+    dists = {}
+    determined = {}
+    for cat_a in TRAIT_CATEGORIES:
+        for cat_b in TRAIT_CATEGORIES:
+            if cat_a != cat_b:
+                pair = engine.pair(cat_a, cat_b)
+                dists[(cat_a, cat_b)] = {va: (sum(bc.values()), bc, bc.most_common())
+                                         for va, bc in pair.nested().items()}
+                determined[(cat_a, cat_b)] = _dominant_values(pair, min_support, min_confidence)
+    present = {cat: index.mask & ~index.bitmaps[cat].get(0, 0) for cat in TRAIT_CATEGORIES}
+
+    rules = []
+    for cat_1, cat_2 in combinations(TRAIT_CATEGORIES, 2):
+        names_1, names_2 = table.values(cat_1), table.values(cat_2)
+        for (v1, v2), support in engine.pair(cat_1, cat_2).counts.items():
+            if support < min_support:
+                continue
+            group = None
+
+            for cat_b in TRAIT_CATEGORIES:
+                if cat_b in (cat_1, cat_2):
+                    continue
+                if v1 in determined[(cat_1, cat_b)] or v2 in determined[(cat_2, cat_b)]:
+                    continue
+                d1 = dists[(cat_1, cat_b)].get(v1)
+                d2 = dists[(cat_2, cat_b)].get(v2)
+                if d1 is None or d2 is None or min(d1[0], d2[0]) < min_support:
+                    continue
+
+                if group is None:
+                    group = index.bitmaps[cat_1][v1] & index.bitmaps[cat_2][v2]
+                total = (group & present[cat_b]).bit_count()
+                if total < min_support:
+                    continue
+
+                # Hits are bounded by count(v1, vb) and count(v2, vb)
+                need = min_confidence * total
+                b_maps = index.bitmaps[cat_b]
+                for vb, n in d1[2]:
+                    if n < need:
+                        break
+                    if d2[1].get(vb, 0) < need:
+                        continue
+                    count = (group & b_maps[vb]).bit_count()
+                    ratio = count / total
+                    if ratio >= min_confidence:
+                        rules.append({
+                            "if_traits": [f"{cat_1}={names_1[v1]}", f"{cat_2}={names_2[v2]}"],
+                            "then_trait": f"{cat_b}={table.values(cat_b)[vb]}",
+                            "count": count,
+                            "total": total,
+                            "ratio": round(ratio, 4),
+                            "type": _rule_type(ratio),
+                        })
+                        break
+
+    rules.sort(key=lambda x: (-x["ratio"], -x["total"]))
+    return rules
+
+
+# Longest lists (or biases per category pair) kept in meebits_rules.json;
+# the rule store has every rule
+RULES_JSON_LIMITS = {
+    "value_exclusions": 200,
+    "real_exclusions": 300,
+    "gender_artifacts": 200,
+    "near_excl": 200,
+    "three_way": 100,
+    "conditional_probs": 20,
+    "conditional_probs_element": 30,
+    "gender_cond_probs": 20,
+    "comp_biases": 30,
+    "color_cooccurrence": 30,
+}
+
+
 def build_rules_json(type_traits, type_counts, exclusions, value_exclusions,
                      dependencies, value_dependencies, conditional_probs,
                      gender_counts=None, trait_classification=None,
@@ -1322,8 +2888,28 @@ def build_rules_json(type_traits, type_counts, exclusions, value_exclusions,
                      color_mappings=None, per_type_excl=None,
                      jersey_analysis=None, tattoo_analysis=None,
                      near_excl=None, comp_biases=None,
-                     three_way=None, deterministic=None):
-    """Build the machine-readable rules file."""
+                     three_way=None, deterministic=None, multi_attribute=None,
+                     color_cooccurrence=None, min_gender_confidence=None, full=False):
+    """
+    Build the machine-readable rules file.
+
+    Long rule lists are cut to their top entries (see RULES_JSON_LIMITS)
+    unless full is set, as for the rule store.
+    """
+    def top(name, items):
+        return items if full else items[:RULES_JSON_LIMITS[name]]
+
+    def top_biases(name, entries):
+        if full:
+            return entries
+        capped = []
+        for e in entries:
+            # Element-color tables (biases keyed by element) may keep more than trait pairs
+            element = e["biases"] and "element" in e["biases"][0]
+            limit = RULES_JSON_LIMITS.get(f"{name}_element" if element else name, RULES_JSON_LIMITS[name])
+            capped.append({**e, "biases": e["biases"][:limit]})
+        return capped
+
     rules = {
         "metadata": {
             "total_meebits": 20000,
@@ -1333,11 +2919,14 @@ def build_rules_json(type_traits, type_counts, exclusions, value_exclusions,
         },
         "type_level_rules": {},
         "category_exclusion_rules": exclusions,
-        "value_exclusion_rules_all_population": value_exclusions[:200],
+        "value_exclusion_rules_all_population": top("value_exclusions", value_exclusions),
         "dependency_rules": dependencies,
         "value_dependency_rules": value_dependencies,
-        "conditional_probability_biases_all_population": conditional_probs,
+        "conditional_probability_biases_all_population": top_biases("conditional_probs", conditional_probs),
     }
+    if min_gender_confidence:
+        # Within-gender rules count only humans whose gender was inferred at least this confidently
+        rules["metadata"]["min_gender_confidence"] = min_gender_confidence
 
     # Gender-aware rules
     if trait_classification:
@@ -1356,8 +2945,8 @@ def build_rules_json(type_traits, type_counts, exclusions, value_exclusions,
             }
 
     if real_exclusions is not None:
-        rules["value_exclusion_rules_within_gender"] = real_exclusions[:300]
-        rules["value_exclusion_rules_gender_artifacts"] = gender_artifacts[:200]
+        rules["value_exclusion_rules_within_gender"] = top("real_exclusions", real_exclusions)
+        rules["value_exclusion_rules_gender_artifacts"] = top("gender_artifacts", gender_artifacts)
         rules["exclusion_summary"] = {
             "total_all_population": len(value_exclusions),
             "total_real_within_gender": len(real_exclusions),
@@ -1365,7 +2954,7 @@ def build_rules_json(type_traits, type_counts, exclusions, value_exclusions,
         }
 
     if gender_cond_probs is not None:
-        rules["conditional_probability_biases_by_gender"] = gender_cond_probs
+        rules["conditional_probability_biases_by_gender"] = top_biases("gender_cond_probs", gender_cond_probs)
 
     for t in type_counts:
         rules["type_level_rules"][t] = {
@@ -1388,18 +2977,103 @@ def build_rules_json(type_traits, type_counts, exclusions, value_exclusions,
     if tattoo_analysis is not None:
         rules["tattoo_structure_analysis"] = tattoo_analysis
     if near_excl is not None:
-        rules["near_exclusion_rules"] = near_excl[:200]
+        rules["near_exclusion_rules"] = top("near_excl", near_excl)
     if comp_biases is not None:
-        rules["comprehensive_pairwise_biases"] = comp_biases
+        rules["comprehensive_pairwise_biases"] = top_biases("comp_biases", comp_biases)
     if three_way is not None:
-        rules["three_way_interactions"] = three_way
+        rules["three_way_interactions"] = top("three_way", three_way)
     if deterministic is not None:
         rules["deterministic_rules"] = deterministic
+    if multi_attribute is not None:
+        rules["multi_attribute_rules"] = multi_attribute
+    if color_cooccurrence is not None:
+        rules["color_cooccurrence"] = top_biases("color_cooccurrence", color_cooccurrence)
 
     return rules
 
 
-def build_report(records, type_traits, type_counts, exclusions, value_exclusions,
+BUILDER_INDEX_PATH = "meebits_builder_index.json"
+BUILDER_INDEX_VERSION = 2
+
+
+def build_builder_index(rules):
+    """
+    Precompiled availability data for the Builder's RuleEngine.
+
+    For every type each selectable category=value gets an integer ID, its
+    position in "traits". "incompatible" packs one bitset per ID: words
+    uint32 little-endian words, base64 encoded, with bit j set when trait j
+    is excluded by category or value exclusion rules. For Humans this is the
+    "" (no gender) context; the "male" and "female" contexts only list the
+    traits selectable for that gender. A trait is available for a build iff
+    its gender context lists it and its bitset ANDed with the build's bitset
+    is zero.
+    """
+    classification = rules.get("gender_trait_classification", {})
+    gender_only = {}
+    for gender in ("male", "female"):
+        for item in classification.get(f"{gender}_only", []):
+            gender_only[(item["category"], item["value"])] = gender
+
+    cat_excl = defaultdict(set)
+    for ex in rules.get("category_exclusion_rules", []):
+        a, b = ex["categories"]
+        cat_excl[a].add(b)
+        cat_excl[b].add(a)
+    val_excl = defaultdict(set)
+    for ex in rules.get("value_exclusion_rules_all_population", []):
+        a, b = parse_trait_key(ex["trait_a"]), parse_trait_key(ex["trait_b"])
+        val_excl[a].add(b)
+        val_excl[b].add(a)
+
+    types = {}
+    for type_name, pool in rules.get("per_type_value_pools", {}).items():
+        contexts = {}
+        for gender in ["", "male", "female"] if type_name == "Human" else [""]:
+            traits = [(cat, value) for cat, values in pool.items() for value, n in values.items()
+                      if n and (not gender or gender_only.get((cat, value), gender) == gender)]
+            if gender:
+                contexts[gender] = {"traits": [f"{cat}={value}" for cat, value in traits]}
+                continue
+            ids = {trait: i for i, trait in enumerate(traits)}
+            cat_bits = defaultdict(int)
+            for trait, i in ids.items():
+                cat_bits[trait[0]] |= 1 << i
+
+            words = (len(traits) + 31) // 32
+            packed = bytearray()
+            for trait in traits:
+                bits = 0
+                for other_cat in cat_excl[trait[0]]:
+                    bits |= cat_bits[other_cat]
+                for other in val_excl[trait]:
+                    if other in ids:
+                        bits |= 1 << ids[other]
+                packed += bits.to_bytes(words * 4, "little")
+
+            contexts[gender] = {
+                "traits": [f"{cat}={value}" for cat, value in traits],
+                "words": words,
+                "incompatible": base64.b64encode(packed).decode("ascii"),
+            }
+        types[type_name] = contexts
+
+    return {"version": BUILDER_INDEX_VERSION, "types": types}
+
+
+def _sketch_note(bound):
+    return (f"_Approximate: counted with count-min sketches. With probability {bound['probability']:.2%}, "
+            "each observed count overstates the true one by at most the amount shown; "
+            "`error_bound` in meebits_rules.json also bounds each value's count._")
+
+
+def _observed_cell(rule):
+    """Observed count for a report table, with its sketch overcount bound if approximate."""
+    bound = rule.get("error_bound")
+    return f"{rule['observed']:,}" + (f" (-{bound['observed']:,})" if bound else "")
+
+
+def build_report(table, type_traits, type_counts, exclusions, value_exclusions,
                  dependencies, value_dependencies, conditional_probs,
                  cooccurrence, category_counts,
                  gender_counts=None, trait_classification=None,
@@ -1410,12 +3084,13 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
                  color_mappings=None, per_type_excl=None,
                  jersey_analysis=None, tattoo_analysis=None,
                  near_excl=None, comp_biases=None,
-                 three_way=None, deterministic=None):
+                 three_way=None, deterministic=None, multi_attribute=None,
+                 gender_confidence=None, color_cooccurrence=None, rarity=None):
     """Build the human-readable report."""
     lines = []
     lines.append("# Meebits Trait Rules Report (v3 - Comprehensive)")
     lines.append("")
-    lines.append(f"Analysis of {len(records):,} Meebits across {len(type_counts)} types.")
+    lines.append(f"Analysis of {len(table):,} Meebits across {len(type_counts)} types.")
     lines.append("")
     lines.append("> **Key insight**: Humans have an inferred male/female split (~58%/42%). "
                  "Many apparent trait exclusions are simply gender artifacts — traits that "
@@ -1429,7 +3104,7 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
     lines.append("| Type | Count | Percentage |")
     lines.append("|------|-------|------------|")
     for t, c in sorted(type_counts.items(), key=lambda x: -x[1]):
-        lines.append(f"| {t} | {c:,} | {c/len(records)*100:.1f}% |")
+        lines.append(f"| {t} | {c:,} | {c/len(table)*100:.1f}% |")
     lines.append("")
 
     # Type-level rules
@@ -1463,7 +3138,9 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
         lines.append("## Gender Distribution (Inferred)")
         lines.append("")
         lines.append("Gender inferred using beard as anchor (beard = definitively male), "
-                     "then classifying all other trait values by co-occurrence with bearded humans.")
+                     "then classifying all other trait values by co-occurrence with bearded humans. "
+                     "The resulting votes seed an EM classifier that re-estimates trait-gender "
+                     "affinities until convergence; each human's confidence is its posterior.")
         lines.append("")
         lines.append("| Gender | Count | Percentage |")
         lines.append("|--------|-------|------------|")
@@ -1472,6 +3149,12 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
             c = gender_counts.get(g, 0)
             lines.append(f"| {g} | {c:,} | {c/total_humans*100:.1f}% |")
         lines.append("")
+        if gender_confidence:
+            low = sum(1 for c in gender_confidence if c is not None and c < LOW_GENDER_CONFIDENCE)
+            lines.append(f"{low:,} humans ({low/total_humans*100:.1f}%) have confidence below "
+                         f"{LOW_GENDER_CONFIDENCE:.0%}; `gender_confidence` in the database carries "
+                         "the posterior for filtering.")
+            lines.append("")
 
     if trait_classification:
         lines.append("## Trait Gender Classification")
@@ -1656,11 +3339,7 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
     lines.append("## Trait Value Catalogs")
     lines.append("")
     for cat in TRAIT_CATEGORIES:
-        vals = Counter()
-        for r in records:
-            v = r.get(cat)
-            if v is not None:
-                vals[v] += 1
+        vals = table.value_counts(cat)
         if vals:
             lines.append(f"### {cat} ({sum(vals.values()):,} Meebits)")
             lines.append("")
@@ -1772,12 +3451,15 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
         lines.append(f"Found {len(near_excl)} trait pairs that almost never co-occur "
                      "(observed/expected < 0.1, with 1-5 actual occurrences).")
         lines.append("")
+        if "error_bound" in near_excl[0]:
+            lines.append(_sketch_note(near_excl[0]["error_bound"]))
+            lines.append("")
         if near_excl:
             lines.append("| Trait A | Trait B | Observed | Expected | Ratio |")
             lines.append("|---------|---------|----------|----------|-------|")
             for ex in near_excl[:60]:
                 lines.append(f"| {ex['trait_a']} | {ex['trait_b']} | "
-                           f"{ex['observed']} | {ex['expected']} | {ex['ratio']:.4f} |")
+                           f"{_observed_cell(ex)} | {ex['expected']} | {ex['ratio']:.4f} |")
             if len(near_excl) > 60:
                 lines.append(f"| ... | ... | ... | ... | ... |")
                 lines.append(f"| _{len(near_excl) - 60} more_ | | | | |")
@@ -1819,6 +3501,23 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
                 lines.append(f"| _{len(near_perfect) - 40} more_ | | | | |")
             lines.append("")
 
+    # Multi-attribute deterministic rules
+    if multi_attribute:
+        lines.append(f"## Multi-Attribute Deterministic Rules ({len(multi_attribute)} rules)")
+        lines.append("")
+        lines.append("Value pairs that together determine a third trait (95%+) although "
+                     "neither value does on its own.")
+        lines.append("")
+        lines.append("| If Traits | Then Trait | Count | Total | Ratio |")
+        lines.append("|-----------|-----------|-------|-------|-------|")
+        for d in multi_attribute[:60]:
+            lines.append(f"| {' + '.join(d['if_traits'])} | {d['then_trait']} | "
+                       f"{d['count']:,} | {d['total']:,} | {d['ratio']} |")
+        if len(multi_attribute) > 60:
+            lines.append(f"| ... | ... | ... | ... | ... |")
+            lines.append(f"| _{len(multi_attribute) - 60} more_ | | | | |")
+        lines.append("")
+
     # Jersey number analysis
     if jersey_analysis:
         lines.append("## Jersey Number Analysis")
@@ -1909,8 +3608,13 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
         lines.append("## Comprehensive Pairwise Statistical Biases")
         lines.append("")
         lines.append(f"All {len(comp_biases)} element category pairs with statistically "
-                     "significant biases (p < 0.001).")
+                     "significant biases (Benjamini-Hochberg FDR q < 0.001 across all pairs; "
+                     "Fisher exact test for small counts, chi-square otherwise).")
         lines.append("")
+        first = next((b for cp in comp_biases for b in cp["biases"]), {})
+        if "error_bound" in first:
+            lines.append(_sketch_note(first["error_bound"]))
+            lines.append("")
 
         for cp in comp_biases:
             lines.append(f"### {cp['category_pair']} (n={cp['total_records']:,}, "
@@ -1921,24 +3625,55 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
                 lines.append("|---------|---------|----------|----------|-------|-----------|")
                 for b in cp["biases"][:15]:
                     lines.append(f"| {b['trait_a']} | {b['trait_b']} | "
-                               f"{b['observed']:,} | {b['expected']} | "
+                               f"{_observed_cell(b)} | {b['expected']} | "
                                f"{b['ratio']} | {b['direction']} |")
                 if len(cp["biases"]) > 15:
                     lines.append(f"| ... | ... | ... | ... | ... | ... |")
                     lines.append(f"| _{cp['num_biases'] - 15} more_ | | | | | |")
             lines.append("")
 
+    # Cross-category color harmony
+    if color_cooccurrence:
+        flagged = [p for p in color_cooccurrence if p["num_exclusions"] or p["num_biases"]]
+        lines.append("## Color Harmony (Cross-Category Color Co-occurrence)")
+        lines.append("")
+        lines.append(f"{len(color_cooccurrence)} color x color and color x element category pairs "
+                     f"tested ({sum(p['cells_stored'] for p in color_cooccurrence):,} of "
+                     f"{sum(p['cells_dense'] for p in color_cooccurrence):,} value cells non-zero); "
+                     f"{len(flagged)} show exclusions or biases (FDR q < 0.001).")
+        lines.append("")
+        for cp in flagged:
+            lines.append(f"### {cp['category_pair']} (n={cp['total_records']:,}, "
+                        f"{cp['num_exclusions']} exclusions, {cp['num_biases']} biases)")
+            lines.append("")
+            if cp["exclusions"]:
+                lines.append("| Trait A | Trait B | Observed | Expected |")
+                lines.append("|---------|---------|----------|----------|")
+                for ex in cp["exclusions"][:15]:
+                    lines.append(f"| {ex['trait_a']} | {ex['trait_b']} | 0 | {ex['expected']} |")
+                lines.append("")
+            if cp["biases"]:
+                lines.append("| Trait A | Trait B | Observed | Expected | Ratio | Direction |")
+                lines.append("|---------|---------|----------|----------|-------|-----------|")
+                for b in cp["biases"][:15]:
+                    lines.append(f"| {b['trait_a']} | {b['trait_b']} | "
+                               f"{b['observed']:,} | {b['expected']} | "
+                               f"{b['ratio']} | {b['direction']} |")
+                lines.append("")
+
     # Three-way interactions
     if three_way:
         lines.append("## Three-Way Trait Interactions")
         lines.append("")
         lines.append(f"Found {len(three_way)} cases where a pairwise bias changes significantly "
-                     "when stratified by a third trait (spread >= 3x).")
+                     "when stratified by a third trait (spread >= 3x, extreme strata differ "
+                     "at FDR-corrected q < 0.001).")
         lines.append("")
 
         for tw in three_way[:20]:
             lines.append(f"### {tw['pair']} stratified by {tw['stratified_by']} "
-                        f"(overall ratio={tw['overall_ratio']}, spread={tw['spread']}x)")
+                        f"(overall ratio={tw['overall_ratio']}, spread={tw['spread']}x, "
+                        f"log10 q={tw['log10_q']})")
             lines.append("")
             lines.append("| Stratum | Observed | Expected | Ratio | N |")
             lines.append("|---------|----------|----------|-------|---|")
@@ -1947,194 +3682,1684 @@ def build_report(records, type_traits, type_counts, exclusions, value_exclusions
                            f"{s['ratio']} | {s['n']:,} |")
             lines.append("")
 
+    # Rarity leaderboards
+    if rarity is not None:
+        lines.append("## Rarity Leaderboards")
+        lines.append("")
+        lines.append("Information content sums -log2 P(value) over type and every trait category "
+                     "(a missing trait counts as a value); trait-normalized sums 1/P(value) divided "
+                     "by the category's value count, plus the trait count; type-conditional scores "
+                     "each trait within the token's type. Full ranks are in "
+                     f"{RARITY_PATH}.")
+        lines.append("")
+        types = dict(zip(table.token_ids, table.decode("type")))
+        for model in RARITY_MODELS:
+            lines.append(f"### {model.replace('_', '-').capitalize()}")
+            lines.append("")
+            lines.append("| Rank | Token | Type | Score |")
+            lines.append("|------|-------|------|-------|")
+            for e in rarity.leaderboard(model):
+                lines.append(f"| {e['rank']} | #{e['token_id']} | {types[e['token_id']]} | {e['score']} |")
+            lines.append("")
+
     return "\n".join(lines)
 
 
-def main():
-    print("=" * 60)
-    print("Meebits Metadata Aggregation & Rule Derivation (v3 - Comprehensive)")
-    print("=" * 60)
+# ---------------------------------------------------------------------------
+# Rarity scoring
+# ---------------------------------------------------------------------------
 
-    # Step 1: Load records (from raw files or existing database)
-    if os.path.isdir(INPUT_DIR):
-        print("\n[1/18] Loading all 20,000 Meebit files from raw metadata...")
-        records = load_all_meebits()
+RARITY_PATH = "meebits_rarity.json"
+RARITY_VERSION = 1
+
+RARITY_MODELS = ("information", "trait_normalized", "type_conditional")
+# Scored categories (gender is inferred, not a trait) and the pseudo-category
+# counting how many TRAIT_CATEGORIES a token has
+RARITY_CATEGORIES = ["type"] + TRAIT_CATEGORIES
+RARITY_TRAIT_COUNT = "trait_count"
+# Scores equal to this many decimals tie, so reweighting in a different
+# order than a fresh build doesn't reorder equal tokens
+RARITY_RANK_DIGITS = 9
+RARITY_LEADERBOARD = 10
+
+
+class RarityScorer:
+    """
+    Per-token rarity scores and ranks under several models.
+
+    Each model scores every value of a category (a missing trait is a value
+    too); a token's score is the weighted sum of its values' scores:
+
+      information       -log2 P(value), the token's information content
+      trait_normalized  1 / P(value) over the category's number of values,
+                        so many-valued categories don't dominate, plus the
+                        token's trait count scored the same way
+      type_conditional  -log2 P(type) plus -log2 P(value | type)
+
+    Scores are summed a column at a time through per-value lookups. Changing
+    weights re-adds only the categories whose weight changed. state() and
+    from_state() carry a scorer as plain data, e.g. through the stage cache.
+    """
+
+    def __init__(self, table, weights=None):
+        self.table = table
+        n = len(table)
+        trait_count = repeat(0, n)
+        for col in TRAIT_CATEGORIES:
+            trait_count = map(add, trait_count, map(bool, table.column(col)))
+        self.trait_count = array("B", trait_count)
+
+        # Per model and category: score of each lookup key (a code, or a
+        # (type code, code) pair packed like joint_counts for type_conditional)
+        self.lookups = {model: {} for model in RARITY_MODELS}
+        type_sizes = table.code_counts("type")
+        for col in RARITY_CATEGORIES:
+            counts = table.code_counts(col)
+            information = [0.0] * len(table.values(col))
+            normalized = [0.0] * len(table.values(col))
+            for code, k in counts.items():
+                information[code] = -math.log2(k / n)
+                normalized[code] = n / k / len(counts)
+            conditional = information
+            if col != "type":
+                radix = len(table.values(col))
+                conditional = [0.0] * (len(table.values("type")) * radix)
+                for (t, code), k in table.joint_counts("type", col, include_missing=True).items():
+                    conditional[t * radix + code] = -math.log2(k / type_sizes[t])
+            self.lookups["information"][col] = information
+            self.lookups["trait_normalized"][col] = normalized
+            self.lookups["type_conditional"][col] = conditional
+        counts = Counter(self.trait_count)
+        normalized = [0.0] * (max(counts, default=0) + 1)
+        for k_traits, k in counts.items():
+            normalized[k_traits] = n / k / len(counts)
+        self.lookups["trait_normalized"][RARITY_TRAIT_COUNT] = normalized
+
+        self.weights = dict.fromkeys(RARITY_CATEGORIES + [RARITY_TRAIT_COUNT], 0.0)
+        self.scores = {model: array("d", bytes(8 * n)) for model in RARITY_MODELS}
+        self._ranked = {}
+        self.set_weights({**dict.fromkeys(self.weights, 1.0), **(weights or {})})
+
+    def state(self):
+        """Lookups, trait counts, weights, scores and ranks as builtins and arrays."""
+        for model in RARITY_MODELS:
+            self._rank(model)
+        return {"lookups": self.lookups, "trait_count": self.trait_count, "weights": dict(self.weights),
+                "scores": self.scores, "ranked": self._ranked}
+
+    @classmethod
+    def from_state(cls, table, state):
+        """The scorer of table that state() was taken from."""
+        scorer = cls.__new__(cls)
+        scorer.table = table
+        scorer.lookups = state["lookups"]
+        scorer.trait_count = state["trait_count"]
+        scorer.weights = dict(state["weights"])
+        scorer.scores = dict(state["scores"])
+        scorer._ranked = dict(state["ranked"])
+        return scorer
+
+    def _keys(self, col, model):
+        if col == RARITY_TRAIT_COUNT:
+            return self.trait_count
+        codes = self.table.column(col)
+        if model == "type_conditional" and col != "type":
+            radix = len(self.table.values(col))
+            return map(add, map(mul, self.table.column("type"), repeat(radix)), codes)
+        return codes
+
+    def set_weights(self, weights):
+        """Change category weights, rescoring only what changed; returns the changed categories."""
+        unknown = set(weights) - set(self.weights)
+        if unknown:
+            raise ValueError(f"Unknown rarity categories: {', '.join(sorted(unknown))}")
+        changed = [col for col, w in weights.items() if w != self.weights[col]]
+        for col in changed:
+            delta = weights[col] - self.weights[col]
+            for model, lookups in self.lookups.items():
+                if col in lookups:
+                    scaled = [delta * s for s in lookups[col]]
+                    self.scores[model] = array("d", map(add, self.scores[model],
+                                                        map(scaled.__getitem__, self._keys(col, model))))
+            self.weights[col] = weights[col]
+        if changed:
+            self._ranked = {}
+        return changed
+
+    def _rank(self, model):
+        """(rows rarest first, per-row competition ranks): tied scores share a rank."""
+        if model not in self._ranked:
+            scores = [round(s, RARITY_RANK_DIGITS) for s in self.scores[model]]
+            order = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+            ranks = array("I", bytes(4 * len(scores)))
+            previous = rank = None
+            for position, row in enumerate(order, 1):
+                if scores[row] != previous:
+                    previous, rank = scores[row], position
+                ranks[row] = rank
+            self._ranked[model] = order, ranks
+        return self._ranked[model]
+
+    def ranks(self, model):
+        """Rank of each row (1 = rarest), in table order."""
+        return self._rank(model)[1]
+
+    def leaderboard(self, model, k=RARITY_LEADERBOARD):
+        """The k rarest tokens: [{"token_id", "rank", "score"}]."""
+        order, ranks = self._rank(model)
+        return [{"token_id": self.table.token_ids[row], "rank": ranks[row],
+                 "score": round(self.scores[model][row], 4)} for row in order[:k]]
+
+    def value_scores(self, model):
+        """{category: {value: score}} ({type: {value: score}} per category for
+        type_conditional); "" is a missing trait."""
+        result = {}
+        for col, lookup in self.lookups[model].items():
+            if col == RARITY_TRAIT_COUNT:
+                result[col] = {str(k): round(s, 6) for k, s in enumerate(lookup) if s}
+                continue
+            names = self.table.values(col)
+            if model == "type_conditional" and col != "type":
+                radix = len(names)
+                result[col] = {t: {names[code] or "": round(lookup[type_code * radix + code], 6)
+                                   for code in range(radix) if lookup[type_code * radix + code]}
+                               for type_code, t in enumerate(self.table.values("type")) if t}
+            else:
+                result[col] = {names[code] or "": round(s, 6) for code, s in enumerate(lookup) if s}
+        return result
+
+
+def analyze_rarity(table):
+    """
+    Score and rank every token under each of RARITY_MODELS; returns the
+    scorer's state(), so the stage cache holds no RarityScorer instance.
+    """
+    return RarityScorer(table).state()
+
+
+def export_rarity(scorer, options=ExportOptions()):
+    """
+    Export meebits_rarity.json: every token's score and rank per model, plus
+    the per-value scores and weights behind them, so a client can re-add a
+    reweighted category (score += delta * value score) without a rebuild.
+    """
+    document = {
+        "version": RARITY_VERSION,
+        "models": list(RARITY_MODELS),
+        "weights": scorer.weights,
+        "value_scores": {model: scorer.value_scores(model) for model in RARITY_MODELS},
+        "token_ids": scorer.table.token_ids.tolist(),
+        "scores": {model: [round(s, 4) for s in scorer.scores[model]] for model in RARITY_MODELS},
+        "ranks": {model: scorer.ranks(model).tolist() for model in RARITY_MODELS},
+    }
+    path = os.path.join(OUTPUT_DIR, RARITY_PATH)
+    entry = write_stream(path, json.JSONEncoder(**JSON_STYLES[options.style]).iterencode(document),
+                         options.compress)
+    update_export_manifest(RARITY_PATH, entry, options)
+    return entry
+
+
+# ---------------------------------------------------------------------------
+# Rule store
+# ---------------------------------------------------------------------------
+
+RULE_STORE_PATH = "meebits_rules.sqlite"
+RULE_STORE_VERSION = 1
+RULE_PAGE_SIZE = 100
+
+# Rule lists of the rules dict stored one row per rule, and their kind.
+# Per-pair entries are flattened into one row per bias (color pairs also
+# give one "color_exclusion" row per exclusion); every other section is
+# stored whole.
+RULE_STORE_KINDS = {
+    "category_exclusion_rules": "category_exclusion",
+    "value_exclusion_rules_all_population": "value_exclusion",
+    "value_exclusion_rules_within_gender": "gender_exclusion",
+    "value_exclusion_rules_gender_artifacts": "gender_artifact",
+    "per_type_exclusion_rules": "type_exclusion",
+    "type_exclusive_values": "type_exclusive",
+    "near_exclusion_rules": "near_exclusion",
+    "dependency_rules": "dependency",
+    "value_dependency_rules": "value_dependency",
+    "deterministic_rules": "deterministic",
+    "multi_attribute_rules": "multi_attribute",
+    "conditional_probability_biases_all_population": "conditional_bias",
+    "conditional_probability_biases_by_gender": "gender_conditional_bias",
+    "comprehensive_pairwise_biases": "pairwise_bias",
+    "color_cooccurrence": "color_bias",
+    "three_way_interactions": "three_way",
+}
+
+RULE_STORE_SCHEMA = """
+CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE sections (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE rules (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    category_pair TEXT,
+    type TEXT,
+    gender TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE rule_traits (rule_id INTEGER NOT NULL REFERENCES rules (id), trait TEXT NOT NULL);
+"""
+
+RULE_STORE_INDEXES = """
+CREATE INDEX rules_kind ON rules (kind);
+CREATE INDEX rules_category_pair ON rules (category_pair, kind);
+CREATE INDEX rules_type ON rules (type, kind);
+CREATE INDEX rules_gender ON rules (gender, kind);
+CREATE INDEX rule_traits_trait ON rule_traits (trait, rule_id);
+"""
+
+
+def iter_stored_rules(rules):
+    """(kind, type, rule) for every rule of a rules dict, in file order."""
+    for key, kind in RULE_STORE_KINDS.items():
+        items = rules.get(key) or []
+        if isinstance(items, dict):
+            for type_name, type_rules in items.items():
+                for rule in type_rules:
+                    yield kind, type_name, rule
+            continue
+        for item in items:
+            if "biases" not in item:
+                single_type = item["available_types"][0] if item.get("num_types") == 1 else None
+                yield kind, single_type, item
+                continue
+            context = {k: v for k, v in item.items() if not isinstance(v, list)}
+            for rule in item.get("exclusions", []):
+                yield "color_exclusion", None, {**context, **rule}
+            for rule in item["biases"]:
+                yield kind, None, {**context, **rule}
+
+
+def _rule_keys(rule):
+    """(trait keys, category pair) a stored rule is indexed under."""
+    traits = [rule[k] for k in ("trait_a", "trait_b", "if_trait", "then_trait") if k in rule]
+    traits += rule.get("if_traits", [])
+    if "pair" in rule:
+        traits += rule["pair"].split(" + ")
+    if "element" in rule:
+        cat_a, cat_b = rule["category_pair"].split(" + ")
+        traits += [f"{cat_a}={rule['element']}", f"{cat_b}={rule['color']}"]
+    if "category" in rule and "value" in rule:
+        traits.append(f"{rule['category']}={rule['value']}")
+    traits = list(dict.fromkeys(t for t in traits if "=" in t))
+
+    if "category_pair" in rule:
+        pair = rule["category_pair"]
+    elif "categories" in rule:
+        pair = " + ".join(rule["categories"])
+    elif "if_present" in rule:
+        pair = f"{rule['if_present']} + {rule['then_present']}"
+    elif len(traits) == 2:
+        pair = " + ".join(parse_trait_key(t)[0] for t in traits)
     else:
-        print(f"\n[1/18] Raw metadata not found. Loading from {DATABASE_PATH}...")
-        records = load_from_database()
-    print(f"  Loaded {len(records)} records")
+        pair = None
+    return traits, pair
 
-    # Step 2: Infer gender
-    print("\n[2/18] Inferring gender for Human meebits...")
-    records, gender_counts, trait_classification, gender_trait_values = infer_gender(records)
-    for g in ["male", "female"]:
-        print(f"  {g}: {gender_counts.get(g, 0):,}")
-    male_traits = sum(1 for v in trait_classification.values() if v == "male")
-    female_traits = sum(1 for v in trait_classification.values() if v == "female")
-    unisex_traits = sum(1 for v in trait_classification.values() if v == "unisex")
-    print(f"  Trait values: {male_traits} male-only, {female_traits} female-only, {unisex_traits} unisex")
 
-    # Step 3: Export database (now with gender)
-    print("\n[3/18] Exporting unified database with gender...")
-    export_database(records)
+def export_rule_store(rules, table=None, confidence=None):
+    """
+    Write RULE_STORE_PATH, an SQLite database of a full (untruncated)
+    rules dict: one row per rule, indexed by kind, trait key, category
+    pair, type and gender, the other sections as JSON and, given a
+    MeebitTable, one row per Meebit. Like write_stream, the file is only
+    replaced if its content changed; returns a manifest entry.
+    """
+    path = os.path.join(OUTPUT_DIR, RULE_STORE_PATH)
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(RULE_STORE_SCHEMA)
+        conn.execute("INSERT INTO info VALUES ('version', ?)", (str(RULE_STORE_VERSION),))
+        conn.executemany("INSERT INTO sections VALUES (?, ?)",
+                         ((name, json.dumps(data)) for name, data in rules.items()
+                          if name not in RULE_STORE_KINDS))
+        for kind, type_name, rule in iter_stored_rules(rules):
+            traits, pair = _rule_keys(rule)
+            rule_id = conn.execute(
+                "INSERT INTO rules (kind, category_pair, type, gender, data) VALUES (?, ?, ?, ?, ?)",
+                (kind, pair, type_name, rule.get("gender"), json.dumps(rule))).lastrowid
+            conn.executemany("INSERT INTO rule_traits VALUES (?, ?)", ((rule_id, t) for t in traits))
+
+        if table is not None:
+            columns = ["token_id", "type", "gender"] + TRAIT_CATEGORIES
+            conn.execute("CREATE TABLE meebits (token_id INTEGER PRIMARY KEY, type TEXT, gender TEXT, "
+                         f"gender_confidence REAL, {', '.join(f'{cat} TEXT' for cat in TRAIT_CATEGORIES)})")
+            confidence = repeat(None) if confidence is None else (
+                None if c is None else round(c, 4) for c in confidence)
+            conn.executemany(f"INSERT INTO meebits VALUES ({', '.join('?' * (len(columns) + 1))})",
+                             (row[:3] + [c] + row[3:] for row, c in zip(table.rows(columns), confidence)))
+            conn.executescript("CREATE INDEX meebits_type ON meebits (type, gender);"
+                               "CREATE INDEX meebits_gender ON meebits (gender);")
+        conn.executescript(RULE_STORE_INDEXES)
+        conn.commit()
+    finally:
+        conn.close()
+
+    digest = file_digest(tmp)
+    entry = {"sha256": digest, "bytes": os.path.getsize(tmp), "changed": digest != file_digest(path)}
+    if entry["changed"]:
+        os.replace(tmp, path)
+    else:
+        os.remove(tmp)
+    return entry
 
-    # Step 4: Type-level rules
-    print("\n[4/18] Analyzing type-level rules...")
-    type_traits, type_counts = analyze_type_level_rules(records)
-    for t in sorted(type_counts.keys()):
-        cats = [c for c in TRAIT_CATEGORIES if type_traits[t].get(c, 0) > 0]
-        print(f"  {t}: {type_counts[t]} Meebits, {len(cats)} trait categories")
-
-    # Step 5: Per-type value pools (NEW)
-    print("\n[5/18] Analyzing per-type trait value pools...")
-    per_type_pools = analyze_per_type_value_pools(records)
-    for t in sorted(per_type_pools.keys()):
-        n_cats = len(per_type_pools[t])
-        n_vals = sum(len(v) for v in per_type_pools[t].values())
+
+def query_rules(conn, kind=None, trait=None, category_pair=None, type_name=None, gender=None,
+                after=0, limit=RULE_PAGE_SIZE):
+    """
+    One page of stored rules matching every given filter, in file order.
+
+    category_pair matches either order ("hat + shirt" or "shirt + hat").
+    Pages are keyed by rule ID: pass the returned "next" as after to get
+    the following page ("next" is None on the last one).
+    """
+    where, params = ["rules.id > ?"], [after]
+    if kind:
+        where.append("rules.kind = ?")
+        params.append(kind)
+    if trait:
+        where.append("rules.id IN (SELECT rule_id FROM rule_traits WHERE trait = ?)")
+        params.append(trait)
+    if category_pair:
+        a, _, b = category_pair.partition(" + ")
+        where.append("rules.category_pair IN (?, ?)")
+        params += [category_pair, f"{b} + {a}"]
+    if type_name:
+        where.append("rules.type = ?")
+        params.append(type_name)
+    if gender:
+        where.append("rules.gender = ?")
+        params.append(gender)
+    rows = conn.execute(f"SELECT id, kind, data FROM rules WHERE {' AND '.join(where)} "
+                        "ORDER BY id LIMIT ?", params + [limit + 1]).fetchall()
+    page = [{"id": rule_id, "kind": kind, "rule": json.loads(data)} for rule_id, kind, data in rows[:limit]]
+    return {"rules": page, "next": page[-1]["id"] if len(rows) > limit else None}
+
+
+# ---------------------------------------------------------------------------
+# Sharded map-reduce
+# ---------------------------------------------------------------------------
+
+# Stages that need the rows themselves (record exports, bitmap conjunctions
+# of three or more traits, per-token scores) and are skipped when only merged counts exist
+SHARDED_SKIP = {"export_database", "analyze_multi_attribute_rules", "analyze_three_way_interactions",
+                "analyze_rarity"}
+
+
+def file_shards(shard_size):
+    """Raw metadata files split into token-ordered shards of at most shard_size."""
+    available = sorted(list_meebit_files().items())
+    return [("files", [(path, token_id) for token_id, path in available[k:k + shard_size]])
+            for k in range(0, len(available), shard_size)]
+
+
+def jsonl_shards(path, shard_size):
+    """A JSON lines file split into byte ranges of at most shard_size records each."""
+    shards = []
+    with open(path, "rb") as f:
+        start = offset = lines = 0
+        for line in f:
+            offset += len(line)
+            lines += bool(line.strip())
+            if lines == shard_size:
+                shards.append(("jsonl", path, start, offset))
+                start, lines = offset, 0
+    if lines:
+        shards.append(("jsonl", path, start, offset))
+    return shards
+
+
+def read_shard(shard):
+    """MeebitTable of one shard from file_shards or jsonl_shards."""
+    if shard[0] == "files":
+        records = [parse_meebit(path, token_id) for path, token_id in shard[1]]
+    else:
+        _, path, start, end = shard
+        with open(path, "rb") as f:
+            f.seek(start)
+            lines = f.read(end - start).splitlines()
+        records = [MeebitRecord.from_dict(json.loads(line)) for line in lines if line.strip()]
+    return MeebitTable.from_records(records)
+
+
+def map_gender_scores(shard, spill_path):
+    """
+    First map pass: (humans, bearded humans, beard co-occurrence scores) of a
+    shard. The parsed shard is pickled to spill_path for the second pass, so
+    its source is read and decoded only once.
+    """
+    table = read_shard(shard)
+    with open(spill_path, "wb") as f:
+        pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+    humans = table.where("type", "Human")
+    return len(humans), humans.count_present("beard"), beard_cooccurrence(humans)
+
+
+def map_shard_counts(spill_path, trait_classification, sketch=False):
+    """
+    Second map pass: gender each human of a shard by its seed vote, then
+    return (pair counts, first rows, rows, sketch cells). Pair counts are
+    {(cat_a, cat_b): Counter({(type, gender, value_a, value_b): count})} for
+    every trait category pair, missing values included; first rows maps
+    ("type" or "gender", value, cat) to the shard row where that stratum
+    first has cat. Keys are values, not codes, since every shard has its
+    own dictionaries. The shard is loaded from (and then removes) the
+    spill file map_gender_scores wrote.
+
+    With sketch set, element category pairs are returned as
+    element_pair_cells for the sketches instead, and their pair counts
+    keep only presence (True/False for value_a and value_b).
+    """
+    with open(spill_path, "rb") as f:
+        table = pickle.load(f)
+    os.remove(spill_path)
+    humans = table.where("type", "Human")
+    seeds = iter(["male" if has_beard or votes >= 0 else "female"
+                  for has_beard, votes in zip(humans.column("beard"),
+                                              gender_votes(humans, trait_classification))])
+    human_code = table.code("type", "Human")
+    table.set_column("gender", [next(seeds) if c == human_code else None for c in table.column("type")])
+
+    cells = element_pair_cells(table) if sketch else {}
+    partial = {}
+    for cat_a, cat_b in combinations(TRAIT_CATEGORIES, 2):
+        names = [table.values(col) for col in ("type", "gender", cat_a, cat_b)]
+        counts = table.joint_counts("type", "gender", cat_a, cat_b, include_missing=True)
+        if (cat_a, cat_b) in cells:
+            partial[cat_a, cat_b] = Counter()
+            for (t, g, va, vb), count in counts.items():
+                partial[cat_a, cat_b][names[0][t], names[1][g], va > 0, vb > 0] += count
+        else:
+            partial[cat_a, cat_b] = Counter({tuple(n[c] for n, c in zip(names, key)): count
+                                             for key, count in counts.items()})
+
+    # Built from the end so each key keeps its earliest row
+    n = len(table)
+    first_rows = {}
+    for col in ("type", "gender"):
+        names = table.values(col)
+        for cat in TRAIT_CATEGORIES:
+            keys = list(map(mul, table.column(col), map(bool, table.column(cat))))
+            for code, row in dict(zip(reversed(keys), range(n - 1, -1, -1))).items():
+                if code:
+                    first_rows[col, names[code], cat] = row
+    return partial, first_rows, n, cells
+
+
+class MergedCounts:
+    """
+    Row-free stand-in for a MeebitTable (and BitmapIndex), built from the
+    merged pair tensors of every shard.
+
+    Each count the table-level analyses ask for involves type, gender and at
+    most two trait categories, so it is a marginal of one stratified
+    (type, gender, cat_a, cat_b) tensor. Tensors are merged in token order,
+    so dictionaries and count keys keep the collection's first-appearance
+    order, as MeebitTable's do. where()/present() return views carrying
+    their filters, like BitmapIndex views carry a row mask.
+
+    Pairs whose values went to sketches (presence_pairs) hold presence
+    codes (1 = present) and only answer count_present().
+    """
+
+    def __init__(self, tensors, dictionaries, first_rows, presence_pairs=frozenset()):
+        self.tensors = tensors  # (cat_a, cat_b) -> Counter {(t, g, code_a, code_b): count}
+        self.presence_pairs = presence_pairs
+        self.first_rows = first_rows  # ("type" or "gender", code, cat) -> first record having cat
+        self.dictionaries = dictionaries
+        self._lookups = {col: {v: i for i, v in enumerate(vals)}
+                         for col, vals in dictionaries.items()}
+        self.filters = ()  # ((col, codes), ...) every counted cell must match
+
+    @classmethod
+    def merge(cls, partials, sketch=None):
+        """
+        Merge map_shard_counts partials, given in token order; their sketch
+        cells are counted into sketch as each shard arrives.
+        """
+        merged = defaultdict(Counter)
+        first_rows = {}
+        presence_pairs = set()
+        offset = 0
+        for partial, shard_first_rows, rows, cells in partials:
+            for pair, counts in partial.items():
+                merged[pair].update(counts)
+            for key, row in shard_first_rows.items():
+                first_rows.setdefault(key, offset + row)
+            offset += rows
+            if cells:
+                sketch.add_cells(cells)
+                presence_pairs.update(cells)
+
+        seen = {col: {} for col in MeebitTable.COLUMNS}
+        for (cat_a, cat_b), counts in merged.items():
+            cols = ("type", "gender") if (cat_a, cat_b) in presence_pairs else ("type", "gender", cat_a, cat_b)
+            for key in counts:
+                for col, v in zip(cols, key):
+                    seen[col].setdefault(v)
+        dictionaries = {col: [None, *(v for v in values if v is not None)]
+                        for col, values in seen.items()}
+        lookups = {col: {v: i for i, v in enumerate(vals)} for col, vals in dictionaries.items()}
+
+        tensors = {}
+        for (cat_a, cat_b), counts in merged.items():
+            if (cat_a, cat_b) in presence_pairs:
+                tensors[cat_a, cat_b] = Counter({(lookups["type"][t], lookups["gender"][g], int(a), int(b)): n
+                                                 for (t, g, a, b), n in counts.items()})
+                continue
+            columns = [lookups[col] for col in ("type", "gender", cat_a, cat_b)]
+            tensors[cat_a, cat_b] = Counter({tuple(lookup[v] for lookup, v in zip(columns, key)): n
+                                             for key, n in counts.items()})
+        return cls(tensors, dictionaries,
+                   {(col, lookups[col][v], cat): row for (col, v, cat), row in first_rows.items()},
+                   frozenset(presence_pairs))
+
+    def __len__(self):
+        return sum(self.joint_counts("type", include_missing=True).values())
+
+    def values(self, col):
+        """Value dictionary for a column; index with a code to decode it."""
+        return self.dictionaries[col]
+
+    def code(self, col, value):
+        """Code for a value, or None if the value never occurs."""
+        return self._lookups[col].get(value)
+
+    def _tensor(self, cols, presence=False):
+        """
+        The tensor covering every column, and each column's position in its
+        keys; presence-only tensors qualify only if presence is set.
+        """
+        cats = list(dict.fromkeys(col for col in cols if col not in ("type", "gender")))
+        if len(cats) > 2:
+            raise ValueError(f"Merged shard counts cover trait pairs only, not {', '.join(cats)}")
+        pair = next((pair for pair in self.tensors if all(cat in pair for cat in cats)
+                     and (presence or pair not in self.presence_pairs)), None)
+        if pair is None:
+            raise ValueError(f"Values of {' and '.join(cats)} were sketched; only presence was counted")
+        return self.tensors[pair], {"type": 0, "gender": 1, pair[0]: 2, pair[1]: 3}, pair in self.presence_pairs
+
+    def joint_counts(self, *cols, include_missing=False, presence=False):
+        """Counter of {(code, code, ...): count}, as MeebitTable.joint_counts."""
+        tensor, positions, sketched = self._tensor(cols + tuple(col for col, _ in self.filters), presence)
+        picks = [positions[col] for col in cols]
+        filters = [(positions[col], codes) for col, codes in self.filters]
+        if sketched:
+            # Presence codes: a trait filter must be present(), which becomes code 1
+            for col, codes in self.filters:
+                if positions[col] > 1 and codes != range(1, len(self.dictionaries[col])):
+                    raise ValueError(f"Values of {col} were sketched; only presence was counted")
+            filters = [(p, codes if p < 2 else (1,)) for p, codes in filters]
+        result = Counter()
+        for key, n in tensor.items():
+            if all(key[p] in codes for p, codes in filters):
+                picked = tuple(key[p] for p in picks)
+                if include_missing or all(picked):
+                    result[picked] += n
+        return result
+
+    def value_counts(self, col, include_missing=False):
+        """Counter of {value: count}, in first-appearance order."""
+        names = self.dictionaries[col]
+        return Counter({names[c]: n for (c,), n in self.joint_counts(col, include_missing=True).items()
+                        if c or include_missing})
+
+    def count_present(self, *cols):
+        """Number of records where every given column has a value."""
+        return sum(self.joint_counts(*cols, presence=True).values())
+
+    def first_present(self, cols):
+        """As MeebitTable.first_present, for the whole collection or one type or gender."""
+        if not self.filters:
+            strata = [("type", code) for code in range(1, len(self.dictionaries["type"]))]
+        elif len(self.filters) == 1 and self.filters[0][0] in ("type", "gender"):
+            col, codes = self.filters[0]
+            strata = [(col, code) for code in codes]
+        else:
+            raise ValueError("Merged shard counts keep first records per type or gender only")
+        firsts = {}
+        for col in cols:
+            rows = [self.first_rows[key + (col,)] for key in strata if key + (col,) in self.first_rows]
+            if rows:
+                firsts[col] = min(rows)
+        return sorted(firsts, key=firsts.__getitem__)
+
+    def _view(self, col, codes):
+        view = MergedCounts.__new__(MergedCounts)
+        view.__dict__.update(self.__dict__)
+        view.filters = self.filters + ((col, codes),)
+        return view
+
+    def where(self, col, value):
+        """Records where a column equals value (None selects missing ones)."""
+        code = self.code(col, value)
+        return self._view(col, () if code is None else (code,))
+
+    def present(self, col):
+        """Records where a column has a value."""
+        return self._view(col, range(1, len(self.dictionaries[col])))
+
+
+def run_sharded(shards, jobs=1, sketch=None):
+    """
+    Gender inference and merged counts for a collection read shard by shard.
+
+    Each shard is parsed, counted and dropped inside a worker process, so
+    peak memory follows the shard size rather than the collection's. A
+    first map pass sums beard co-occurrence into the trait classification
+    and spills each parsed shard to a scratch file; a second reloads it,
+    genders every human by its seed vote (EM needs all humans at once, so
+    it is not run) and returns the shard's pair tensors, which are merged
+    as they arrive. Given a SketchEngine, element pair values are counted
+    into it shard by shard and merged as presence only (see MergedCounts).
+    Returns (MergedCounts, trait_classification).
+    """
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    mapper = pool.map if pool else map
+    scratch = tempfile.TemporaryDirectory(prefix="meebits_shards_")
+    spills = [os.path.join(scratch.name, f"shard{k}.pkl") for k in range(len(shards))]
+    try:
+        humans = bearded = 0
+        scores = defaultdict(lambda: (0, 0))
+        for shard_humans, shard_bearded, shard_scores in mapper(map_gender_scores, shards, spills):
+            humans += shard_humans
+            bearded += shard_bearded
+            for key, (wb, wob) in shard_scores.items():
+                scores[key] = (scores[key][0] + wb, scores[key][1] + wob)
+        trait_classification = classify_gender_traits(scores, bearded / humans if humans else 0)
+
+        counts = MergedCounts.merge(mapper(map_shard_counts, spills, repeat(trait_classification, len(shards)),
+                                           repeat(sketch is not None, len(shards))), sketch)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        scratch.cleanup()
+    return counts, trait_classification
+
+
+# ---------------------------------------------------------------------------
+# Profiling
+# ---------------------------------------------------------------------------
+
+PROFILE_PATH = "meebits_profile.json"
+PROFILE_TRACE_PATH = "meebits_profile.trace.json"
+PROFILE_STATS_DIR = "meebits_profile_stats"
+PROFILE_VERSION = 1
+PROFILE_TOP_ALLOCATIONS = 10
+PROFILE_TOP_FUNCTIONS = 20
+PROFILE_SUMMARY_ROWS = 10
+
+# trace_memory: tracemalloc each span (slows allocation-heavy code several-fold);
+# stats_dir: where per-span cProfile dumps go, or None to skip cProfile
+ProfileOptions = namedtuple("ProfileOptions", "trace_memory stats_dir", defaults=(False, None))
+
+
+def _peak_rss():
+    """High-water resident set size of this process in bytes, or None where unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextlib.contextmanager
+def measure_span(name, options):
+    """
+    Measure the enclosed block, yielding a record filled in on exit: wall and
+    CPU seconds and the process's peak RSS; with options.trace_memory, the
+    traced memory peak above the starting level and the lines whose
+    allocations grew the most; with options.stats_dir, the functions
+    cProfile spent the most time in. Time spent taking and comparing
+    snapshots or dumping stats is kept out of wall_seconds and recorded as
+    overhead_seconds.
+    """
+    record = {"name": name, "pid": os.getpid(), "tid": threading.get_ident()}
+    setup = time.perf_counter()
+    if options.trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile() if options.stats_dir else None
+    record["start"] = time.time()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    record["overhead_seconds"] = start - setup
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+        record["wall_seconds"] = time.perf_counter() - start
+        record["cpu_seconds"] = time.process_time() - start_cpu
+        record["peak_rss_bytes"] = _peak_rss()
+        teardown = time.perf_counter()
+        if options.trace_memory:
+            record["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+            growth = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(before, "lineno")
+            record["top_allocations"] = [
+                {"where": f"{d.traceback[0].filename}:{d.traceback[0].lineno}",
+                 "bytes": d.size_diff, "blocks": d.count_diff}
+                for d in growth[:PROFILE_TOP_ALLOCATIONS] if d.size_diff > 0]
+        if profiler:
+            os.makedirs(options.stats_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(options.stats_dir, f"{name}.prof"))
+            stats = sorted(pstats.Stats(profiler).stats.items(), key=lambda kv: -kv[1][2])
+            record["top_functions"] = [
+                {"function": f"{file}:{line}({func})", "calls": nc,
+                 "self_seconds": round(tt, 6), "cumulative_seconds": round(ct, 6)}
+                for (file, line, func), (_, nc, tt, ct, _) in stats[:PROFILE_TOP_FUNCTIONS]]
+        record["overhead_seconds"] += time.perf_counter() - teardown
+
+
+class PipelineProfile:
+    """
+    Span records for one run (see measure_span), written out as a JSON
+    timeline and as a Chrome trace (chrome://tracing, Perfetto). Stages run
+    in pool workers measure themselves and hand their records back.
+    """
+
+    def __init__(self, options=ProfileOptions()):
+        self.options = options
+        self.start = time.time()
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        with measure_span(name, self.options) as record:
+            yield record
+        self.spans.append(record)
+
+    def add(self, record):
+        self.spans.append(record)
+
+    def timeline(self):
+        """
+        The run's spans in start order. Shares are of the wall time less the
+        main process's instrumentation overhead (snapshots, stats dumps), which
+        is reported on its own; worker overhead overlaps the main process.
+        """
+        total = time.time() - self.start
+        main_pid = os.getpid()
+        overhead = sum(r.get("overhead_seconds", 0.0) for r in self.spans if r.get("pid") == main_pid)
+        measured = total - overhead
+        spans = []
+        for record in sorted(self.spans, key=lambda r: r.get("start", self.start)):
+            span = dict(record)
+            if "start" in span:
+                span["start"] = round(span["start"] - self.start, 6)
+                span["share"] = round(span["wall_seconds"] / measured, 4) if measured > 0 else 0.0
+                span["wall_seconds"] = round(span["wall_seconds"], 6)
+                span["cpu_seconds"] = round(span["cpu_seconds"], 6)
+                span["overhead_seconds"] = round(span["overhead_seconds"], 6)
+            spans.append(span)
+        return {
+            "version": PROFILE_VERSION,
+            "created": datetime.fromtimestamp(self.start, timezone.utc).isoformat(timespec="seconds"),
+            "wall_seconds": round(total, 6),
+            "overhead_seconds": round(overhead, 6),
+            "unmeasured_seconds": round(max(measured - sum(r["wall_seconds"] for r in self.spans
+                                                           if r.get("pid") == main_pid and "start" in r), 0.0), 6),
+            "main_cpu_seconds": round(time.process_time(), 6),
+            "peak_rss_bytes": _peak_rss(),
+            "traced_memory": self.options.trace_memory,
+            "cprofile_dir": self.options.stats_dir,
+            "spans": spans,
+        }
+
+    def chrome_trace(self):
+        main_pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid,
+                   "args": {"name": "main" if pid == main_pid else f"stage worker {pid}"}}
+                  for pid in sorted({r["pid"] for r in self.spans if "pid" in r})]
+        for r in self.spans:
+            if "start" not in r:
+                continue
+            events.append({
+                "name": r["name"], "cat": "stage", "ph": "X", "pid": r["pid"], "tid": r["tid"],
+                "ts": round((r["start"] - self.start) * 1e6), "dur": round(r["wall_seconds"] * 1e6),
+                "args": {"cpu_seconds": round(r["cpu_seconds"], 6), "peak_rss_bytes": r["peak_rss_bytes"],
+                         "overhead_seconds": round(r["overhead_seconds"], 6),
+                         **({"traced_peak_bytes": r["traced_peak_bytes"]} if "traced_peak_bytes" in r else {})},
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path, trace_path):
+        timeline = self.timeline()
+        with open(path, "w") as f:
+            json.dump(timeline, f, indent=2)
+        with open(trace_path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+        return timeline
+
+
+# ---------------------------------------------------------------------------
+# Pipeline stage graph
+# ---------------------------------------------------------------------------
+
+# step: banner number; label: banner text (None = continues the previous step);
+# func(*inputs) returns one value per name in outputs; summary(results)
+# prints the step's console lines once its outputs are available.
+Stage = namedtuple("Stage", "step label func inputs outputs summary")
+
+
+def _summarize_type_rules(r):
+    for t in sorted(r["type_counts"].keys()):
+        cats = [c for c in TRAIT_CATEGORIES if r["type_traits"][t].get(c, 0) > 0]
+        print(f"  {t}: {r['type_counts'][t]} Meebits, {len(cats)} trait categories")
+
+
+def _summarize_value_pools(r):
+    for t in sorted(r["per_type_pools"].keys()):
+        n_cats = len(r["per_type_pools"][t])
+        n_vals = sum(len(v) for v in r["per_type_pools"][t].values())
         print(f"  {t}: {n_cats} categories, {n_vals} unique values")
 
-    # Step 6: Type-exclusive values (NEW)
-    print("\n[6/18] Analyzing type-exclusive trait values...")
-    type_exclusive = analyze_type_exclusive_values(per_type_pools)
-    single_type = sum(1 for x in type_exclusive if x["num_types"] == 1)
-    print(f"  Found {len(type_exclusive)} non-universal values, {single_type} exclusive to 1 type")
 
-    # Step 7: Color-element mappings (NEW)
-    print("\n[7/18] Analyzing color-element mandatory mappings...")
-    color_mappings = analyze_color_element_mappings(records)
-    for pair_key, mappings in color_mappings.items():
+def _summarize_type_exclusive(r):
+    single_type = sum(1 for x in r["type_exclusive"] if x["num_types"] == 1)
+    print(f"  Found {len(r['type_exclusive'])} non-universal values, {single_type} exclusive to 1 type")
+
+
+def _summarize_color_mappings(r):
+    for pair_key, mappings in r["color_mappings"].items():
         always = sum(1 for m in mappings if m["classification"] == "always_has_color")
         never = sum(1 for m in mappings if m["classification"] == "never_has_color")
         sometimes = sum(1 for m in mappings if m["classification"] == "sometimes_has_color")
         print(f"  {pair_key}: {always} always, {never} never, {sometimes} sometimes")
 
-    # Step 8: Exclusion rules (all-population)
-    print("\n[8/18] Analyzing exclusion rules (all population)...")
-    exclusions, cooccurrence, category_counts = analyze_exclusion_rules(records)
-    print(f"  Found {len(exclusions)} category-level exclusion rules")
 
-    value_exclusions = analyze_value_exclusions(records)
-    print(f"  Found {len(value_exclusions)} value-level exclusion rules (all population)")
+def _summarize_gender_exclusions(r):
+    print(f"  Found {len(r['real_exclusions'])} real within-gender exclusions")
+    print(f"  Found {len(r['gender_artifacts'])} gender artifact exclusions")
 
-    # Step 9: Gender-aware exclusion rules
-    print("\n[9/18] Analyzing gender-aware exclusion rules...")
-    real_exclusions, gender_artifacts = analyze_gender_exclusions(records)
-    print(f"  Found {len(real_exclusions)} real within-gender exclusions")
-    print(f"  Found {len(gender_artifacts)} gender artifact exclusions")
 
-    # Step 10: Per-type exclusion rules (NEW)
-    print("\n[10/18] Analyzing per-type value exclusion rules...")
-    per_type_excl = analyze_per_type_exclusions(records)
-    for t, excls in per_type_excl.items():
+def _summarize_per_type_exclusions(r):
+    for t, excls in r["per_type_excl"].items():
         print(f"  {t}: {len(excls)} exclusions")
 
-    # Step 11: Near-exclusion rules (NEW)
-    print("\n[11/18] Analyzing near-exclusion rules (soft constraints)...")
-    near_excl = analyze_near_exclusions(records)
-    print(f"  Found {len(near_excl)} near-exclusion rules")
-
-    # Step 12: Dependency rules
-    print("\n[12/18] Analyzing dependency rules...")
-    dependencies, value_dependencies = analyze_dependency_rules(records)
-    print(f"  Found {len(dependencies)} category dependency rules")
-    print(f"  Found {len(value_dependencies)} value dependency rules")
-
-    # Step 13: Deterministic rules (NEW)
-    print("\n[13/18] Analyzing deterministic rules (perfect correlations)...")
-    deterministic = analyze_deterministic_rules(records)
-    perfect = sum(1 for d in deterministic if d["type"] == "deterministic")
-    near = sum(1 for d in deterministic if d["type"] == "near_deterministic")
+
+def _summarize_dependencies(r):
+    print(f"  Found {len(r['dependencies'])} category dependency rules")
+    print(f"  Found {len(r['value_dependencies'])} value dependency rules")
+
+
+def _summarize_deterministic(r):
+    perfect = sum(1 for d in r["deterministic"] if d["type"] == "deterministic")
+    near = sum(1 for d in r["deterministic"] if d["type"] == "near_deterministic")
     print(f"  Found {perfect} deterministic + {near} near-deterministic rules")
 
-    # Step 14: Jersey number analysis (NEW)
-    print("\n[14/18] Analyzing jersey number patterns...")
-    jersey_analysis = analyze_jersey_number_rules(records)
+
+def _summarize_jersey(r):
+    jersey_analysis = r["jersey_analysis"]
     bid = jersey_analysis["bidirectional_check"]
     print(f"  Total with jersey number: {jersey_analysis['total_with_jersey_number']}")
     print(f"  Bidirectional mapping: {bid['is_bidirectional']}")
 
-    # Step 15: Tattoo structure analysis (NEW)
-    print("\n[15/18] Analyzing tattoo code structure...")
-    tattoo_analysis = analyze_tattoo_structure(records)
-    fam = tattoo_analysis["families"]
+
+def _summarize_tattoo(r):
+    fam = r["tattoo_analysis"]["families"]
     print(f"  Comma-separated: {fam['comma_separated']['count']}, "
           f"Single-segment: {fam['single_segment']['count']}")
     print(f"  Comma alphabet: {fam['comma_separated']['alphabet']}")
     print(f"  Single alphabet: {fam['single_segment']['alphabet']}")
 
-    # Step 16: Conditional probabilities (existing)
-    print("\n[16/18] Analyzing conditional probability patterns...")
-    conditional_probs = analyze_conditional_probabilities(records)
-    total_biases = sum(len(cp["biases"]) for cp in conditional_probs)
+
+def _summarize_conditional(r):
+    total_biases = sum(len(cp["biases"]) for cp in r["conditional_probs"])
     print(f"  Found {total_biases} all-population biases")
 
-    gender_cond_probs = analyze_gender_conditional_probs(records)
+
+def _summarize_gender_conditional(r):
+    gender_cond_probs = r["gender_cond_probs"]
     gender_biases = sum(len(cp["biases"]) for cp in gender_cond_probs)
     print(f"  Found {gender_biases} within-gender biases across {len(gender_cond_probs)} category pairs")
 
-    # Step 17: Comprehensive all-pairs biases (NEW)
-    print("\n[17/18] Analyzing comprehensive pairwise biases (all 55 pairs)...")
-    comp_biases = analyze_comprehensive_biases(records)
-    total_comp = sum(cp["num_biases"] for cp in comp_biases)
-    print(f"  Found {total_comp} significant biases across {len(comp_biases)} category pairs")
 
-    # Step 18: Three-way interactions (NEW)
-    print("\n[18/18] Analyzing three-way trait interactions...")
-    three_way = analyze_three_way_interactions(records, comp_biases)
-    print(f"  Found {len(three_way)} three-way interactions")
+def _summarize_comprehensive(r):
+    total_comp = sum(cp["num_biases"] for cp in r["comp_biases"])
+    print(f"  Found {total_comp} significant biases across {len(r['comp_biases'])} category pairs")
+
+
+def _summarize_rarity(r):
+    scorer = RarityScorer.from_state(r["table"], r["rarity"])
+    for model in RARITY_MODELS:
+        leaders = ", ".join(f"#{e['token_id']} ({e['score']})" for e in scorer.leaderboard(model, 3))
+        print(f"  {model}: {leaders}")
+
+
+def _summarize_color_cooccurrence(r):
+    pairs = r["color_cooccurrence"]
+    stored = sum(p["cells_stored"] for p in pairs)
+    dense = sum(p["cells_dense"] for p in pairs)
+    print(f"  Found {sum(p['num_exclusions'] for p in pairs)} color exclusions and "
+          f"{sum(p['num_biases'] for p in pairs)} color biases across {len(pairs)} color pairs "
+          f"({stored:,} of {dense:,} cells non-zero)")
+
+
+PIPELINE_STAGES = [
+    Stage(3, "Exporting unified database with gender...",
+          export_database, ("table", "export_options", "gender_confidence"), (), None),
+    Stage(4, "Analyzing type-level rules...",
+          analyze_type_level_rules, ("table",), ("type_traits", "type_counts"),
+          _summarize_type_rules),
+    Stage(5, "Analyzing per-type trait value pools...",
+          analyze_per_type_value_pools, ("table",), ("per_type_pools",),
+          _summarize_value_pools),
+    Stage(6, "Analyzing type-exclusive trait values...",
+          analyze_type_exclusive_values, ("per_type_pools",), ("type_exclusive",),
+          _summarize_type_exclusive),
+    Stage(7, "Analyzing color-element mandatory mappings...",
+          analyze_color_element_mappings, ("table",), ("color_mappings",),
+          _summarize_color_mappings),
+    Stage(8, "Analyzing exclusion rules (all population)...",
+          analyze_exclusion_rules, ("table",), ("exclusions", "cooccurrence", "category_counts"),
+          lambda r: print(f"  Found {len(r['exclusions'])} category-level exclusion rules")),
+    Stage(8, None,
+          analyze_value_exclusions, ("engine",), ("value_exclusions",),
+          lambda r: print(f"  Found {len(r['value_exclusions'])} value-level exclusion rules (all population)")),
+    Stage(9, "Analyzing gender-aware exclusion rules...",
+          analyze_gender_exclusions, ("engine",), ("real_exclusions", "gender_artifacts"),
+          _summarize_gender_exclusions),
+    Stage(10, "Analyzing per-type value exclusion rules...",
+          analyze_per_type_exclusions, ("engine",), ("per_type_excl",),
+          _summarize_per_type_exclusions),
+    Stage(11, "Analyzing near-exclusion rules (soft constraints)...",
+          analyze_near_exclusions, ("engine",), ("near_excl",),
+          lambda r: print(f"  Found {len(r['near_excl'])} near-exclusion rules")),
+    Stage(12, "Analyzing dependency rules...",
+          analyze_dependency_rules, ("table",), ("dependencies", "value_dependencies"),
+          _summarize_dependencies),
+    Stage(13, "Analyzing deterministic rules (perfect correlations)...",
+          analyze_deterministic_rules, ("engine",), ("deterministic",),
+          _summarize_deterministic),
+    Stage(13, None,
+          analyze_multi_attribute_rules, ("engine", "bitmaps"), ("multi_attribute",),
+          lambda r: print(f"  Found {len(r['multi_attribute'])} two-attribute determinant rules")),
+    Stage(14, "Analyzing jersey number patterns...",
+          analyze_jersey_number_rules, ("bitmaps",), ("jersey_analysis",),
+          _summarize_jersey),
+    Stage(15, "Analyzing tattoo code structure...",
+          analyze_tattoo_structure, ("table",), ("tattoo_analysis",),
+          _summarize_tattoo),
+    Stage(16, "Analyzing conditional probability patterns...",
+          analyze_conditional_probabilities, ("engine",), ("conditional_probs",),
+          _summarize_conditional),
+    Stage(16, None,
+          analyze_gender_conditional_probs, ("engine",), ("gender_cond_probs",),
+          _summarize_gender_conditional),
+    Stage(17, "Analyzing comprehensive pairwise biases (all 55 pairs)...",
+          analyze_comprehensive_biases, ("engine",), ("comp_biases",),
+          _summarize_comprehensive),
+    Stage(17, None,
+          analyze_color_cooccurrence, ("engine",), ("color_cooccurrence",),
+          _summarize_color_cooccurrence),
+    Stage(18, "Analyzing three-way trait interactions...",
+          analyze_three_way_interactions, ("bitmaps", "comp_biases"), ("three_way",),
+          lambda r: print(f"  Found {len(r['three_way'])} three-way interactions")),
+    Stage(19, "Scoring token rarity...",
+          analyze_rarity, ("table",), ("rarity",),
+          _summarize_rarity),
+]
+
+def infer_gender_column(table):
+    """infer_gender, returning the gender column's values in place of the table."""
+    table, *stats = infer_gender(table)
+    return (table.decode("gender"), *stats)
+
+
+# Step 2 is memoized like a pipeline stage: on a warm rerun the EM would
+# otherwise be the slowest step. It caches the gender column, not the table,
+# so no instance of this module's classes is pickled (a cache written by
+# "python process_meebits.py" would name them __main__.*). main applies the
+# column and prints the banner and summary.
+GENDER_STAGE = Stage(2, None, infer_gender_column, ("table",),
+                     ("genders", "gender_counts", "trait_classification",
+                      "gender_trait_values", "gender_confidence"), None)
+
+# Banner total: loading (step 1) and gender (step 2), then one step per stage number
+PIPELINE_STEPS = 2 + len({st.step for st in PIPELINE_STAGES})
+
+# Stages that read SketchEngine instead of ContingencyEngine with --sketch-width
+SKETCH_STAGES = {"analyze_near_exclusions", "analyze_comprehensive_biases"}
+# The other pairwise stages need exact value-pair counts, which sketch mode
+# never builds; they are skipped and these stand in for their outputs
+SKETCH_SKIPPED_OUTPUTS = {
+    "value_exclusions": [], "real_exclusions": [], "gender_artifacts": [], "per_type_excl": {},
+    "deterministic": [], "multi_attribute": [], "conditional_probs": [], "gender_cond_probs": [],
+    "color_cooccurrence": [],
+}
+SKETCH_SKIP = {st.func.__name__ for st in PIPELINE_STAGES if set(st.outputs) & set(SKETCH_SKIPPED_OUTPUTS)}
+
+STAGE_CACHE_DIR = ".stage_cache"
+
+# Shared inputs (table, engine, bitmaps) handed to each pool worker once at start-up
+_WORKER_CONTEXT = {}
+
+
+def _init_stage_worker(context):
+    _WORKER_CONTEXT.update(context)
+
+
+def _run_stage(func, inputs, values, profile=None):
+    """Run one stage in a worker, capturing its console output (and, given
+    ProfileOptions, its measure_span record)."""
+    args = [values[name] if name in values else _WORKER_CONTEXT[name] for name in inputs]
+    buf = io.StringIO()
+    measure = measure_span(func.__name__, profile) if profile else contextlib.nullcontext()
+    with contextlib.redirect_stdout(buf), measure as record:
+        result = func(*args)
+    return result, buf.getvalue(), record
+
+
+def _stage_outputs(stage, result):
+    if len(stage.outputs) == 1:
+        return {stage.outputs[0]: result}
+    return dict(zip(stage.outputs, result or ()))
+
+
+def _referenced_names(obj):
+    """Global names used by a function, or by every method of a class."""
+    codes = [obj.__code__] if inspect.isfunction(obj) else [
+        member.__code__ for member in vars(obj).values() if inspect.isfunction(member)]
+    names = []
+    while codes:
+        code = codes.pop()
+        names.extend(code.co_names)
+        codes.extend(c for c in code.co_consts if inspect.iscode(c))
+    return names
+
+
+def _code_bytes(code):
+    """Bytecode, names and constants of a code object and the code nested in it."""
+    parts = [code.co_code, repr(code.co_names).encode()]
+    for const in code.co_consts:
+        parts.append(_code_bytes(const) if inspect.iscode(const) else repr(const).encode())
+    return b"\0".join(parts)
+
+
+def _compiled_source(obj):
+    """
+    Stand-in for inspect.getsource where the source cannot be found, as for
+    classes under python -m cProfile: the compiled code of a function, or of
+    every method of a class, plus defaults and plain class attributes.
+    """
+    if inspect.isfunction(obj):
+        return _code_bytes(obj.__code__) + repr((obj.__defaults__, obj.__kwdefaults__)).encode()
+    parts = []
+    for name, value in vars(obj).items():
+        value = getattr(value, "__func__", getattr(value, "fget", value))
+        if inspect.isfunction(value):
+            parts.append(name.encode() + b"\0" + _compiled_source(value))
+        elif isinstance(value, (int, float, str, bytes, tuple, frozenset, type(None))):
+            parts.append(f"{name}={value!r}".encode())
+    return b"\0".join(parts)
+
+
+# Per-process digest caches. Sources cannot change within a process, so
+# this file is parsed once (inspect.getsource rescans it on every call) and
+# each function or class is hashed once however many stages use it.
+_TOP_LEVEL_SOURCES = {}
+_OBJECT_DIGESTS = {}
+
+
+def _top_level_sources():
+    """{name: source} of every top-level function and class in this file."""
+    if not _TOP_LEVEL_SOURCES:
+        try:
+            with open(__file__, encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return _TOP_LEVEL_SOURCES
+        lines = text.splitlines(keepends=True)
+        for node in ast.parse(text).body:
+            if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+                _TOP_LEVEL_SOURCES[node.name] = "".join(lines[start - 1:node.end_lineno])
+    return _TOP_LEVEL_SOURCES
+
+
+def _object_digest(obj):
+    digest = _OBJECT_DIGESTS.get(obj)
+    if digest is None:
+        source = _top_level_sources().get(obj.__qualname__) if obj.__module__ == __name__ else None
+        if source is None:
+            try:
+                source = inspect.getsource(obj)
+            except (OSError, TypeError):
+                source = None
+        digest = _OBJECT_DIGESTS[obj] = hashlib.sha256(
+            _compiled_source(obj) if source is None else source.encode()).digest()
+    return digest
+
+
+def source_digest(*objs):
+    """
+    Hash the source of functions/classes plus every module-level function,
+    class and constant they reference, transitively. Editing a threshold in
+    a stage or in any helper it calls therefore changes the digest. Where
+    no source is available the compiled code is hashed instead.
+    """
+    namespace = globals()  # not sys.modules[__name__], which is cProfile's under -m cProfile
+    h = hashlib.sha256()
+    seen = set()
+    stack = list(reversed(objs))
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        h.update(_object_digest(obj))
+        for name in _referenced_names(obj):
+            if name not in namespace or name in seen:
+                continue
+            value = namespace[name]
+            if inspect.isfunction(value) or inspect.isclass(value):
+                if value.__module__ == __name__:
+                    stack.append(value)
+            elif not inspect.ismodule(value):
+                seen.add(name)
+                h.update(f"{name}={value!r}".encode())
+    return h.hexdigest()
+
+
+def stage_keys(stages, digests):
+    """
+    Content address of every stage: hash(function source, input digests).
+
+    An output's digest is derived from the key of the stage that produced
+    it, so keys for the whole graph are known before anything runs.
+    """
+    digests = dict(digests)
+    keys = {}
+    remaining = list(stages)
+    while remaining:
+        ready = [st for st in remaining if all(name in digests for name in st.inputs)]
+        if not ready:
+            missing = sorted({n for st in remaining for n in st.inputs} - set(digests))
+            raise RuntimeError(f"Unsatisfiable stage inputs: {missing}")
+        for st in ready:
+            h = hashlib.sha256(st.func.__name__.encode())
+            h.update(source_digest(st.func).encode())
+            for name in st.inputs:
+                h.update(f"{name}:{digests[name]}".encode())
+            keys[id(st)] = h.hexdigest()[:32]
+            for name in st.outputs:
+                digests[name] = hashlib.sha256(f"{keys[id(st)]}:{name}".encode()).hexdigest()
+            remaining.remove(st)
+    return keys
+
+
+def _stage_cache_path(cache_dir, stage, key):
+    return os.path.join(cache_dir, f"{stage.func.__name__}-{key}.pkl")
+
+
+def _load_stage(cache_dir, stage, key):
+    try:
+        with open(_stage_cache_path(cache_dir, stage, key), "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+        # Unreadable, truncated, or pickled against classes this process lacks
+        return None
+
+
+def _store_stage(cache_dir, stage, key, entry):
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = f"{stage.func.__name__}-"
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith(".pkl"):
+            os.remove(os.path.join(cache_dir, name))
+    path = _stage_cache_path(cache_dir, stage, key)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def run_stages(stages, context, jobs=1, skip=(), cache_dir=None, digests=None, profile=None):
+    """
+    Run pipeline stages as a dependency graph.
+
+    A stage becomes ready once every name in its inputs has been produced
+    (or is in context). With jobs > 1 ready stages are submitted to a
+    process pool as soon as their inputs exist; otherwise they run in
+    declaration order. Console output is replayed in step order either way.
+
+    With cache_dir set, each stage's (outputs, console log) is memoized under
+    its content address (see stage_keys; digests gives the content hash of
+    each context input) and unchanged stages are loaded instead of rerun.
+    Callable context values are factories, invoked only if a stage that
+    needs them actually has to run.
+
+    With a PipelineProfile, every stage that runs is measured and its
+    timings are printed after its summary; cached stages are recorded as such.
+
+    Returns context plus every stage output.
+    """
+    stages = [st for st in stages if st.func.__name__ not in skip]
+    results = {}
+    logs = {}
+    keys = stage_keys(stages, digests) if cache_dir else {}
+    hits = {}
+    if cache_dir:
+        # Stages without outputs exist for their side effects (files), always run them
+        for st in (st for st in stages if st.outputs):
+            entry = _load_stage(cache_dir, st, keys[id(st)])
+            if entry is not None:
+                hits[id(st)] = entry
+    misses = [st for st in stages if id(st) not in hits]
+
+    # Resolve lazy context inputs only if a stage that runs needs them
+    needed = {name for st in misses for name in st.inputs}
+    context = {name: (value() if callable(value) and name in needed else value)
+               for name, value in context.items()}
+    results.update(context)
+
+    def replay():
+        # Print banners and summaries for finished stages, in declared order
+        while replay.next < len(stages) and id(stages[replay.next]) in logs:
+            st = stages[replay.next]
+            if st.label:
+                print(f"\n[{st.step}/{PIPELINE_STEPS}] {st.label}")
+            sys.stdout.write(logs.pop(id(st)))
+            if st.summary:
+                st.summary(results)
+            if id(st) in records:
+                r = records.pop(id(st))
+                traced = f", {r['traced_peak_bytes'] / 2**20:.1f} MiB traced peak" if "traced_peak_bytes" in r else ""
+                print(f"  ({st.func.__name__}: {r['wall_seconds']:.3f}s wall, {r['cpu_seconds']:.3f}s CPU{traced})")
+            replay.next += 1
+    replay.next = 0
+    records = {}
+    options = profile.options if profile else None
+
+    def finish(st, result, log, record, cached):
+        if cache_dir and st.outputs and not cached:
+            _store_stage(cache_dir, st, keys[id(st)], (result, log))
+        results.update(_stage_outputs(st, result))
+        logs[id(st)] = log
+        if profile:
+            profile.add(record or {"name": st.func.__name__, "cached": True})
+            if record:
+                records[id(st)] = record
+        replay()
+
+    if jobs <= 1 or len(misses) <= 1:
+        for st in stages:
+            if id(st) in hits:
+                finish(st, *hits[id(st)], None, cached=True)
+            else:
+                finish(st, *_run_stage(st.func, st.inputs, results, options), cached=False)
+        return results
+
+    for st in stages:
+        if id(st) in hits:
+            result, log = hits[id(st)]
+            results.update(_stage_outputs(st, result))
+            logs[id(st)] = log
+            if profile:
+                profile.add({"name": st.func.__name__, "cached": True})
+    pending = misses
+    running = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_stage_worker,
+                             initargs=(context,)) as pool:
+        while pending or running:
+            for st in [st for st in pending if all(name in results for name in st.inputs)]:
+                values = {name: results[name] for name in st.inputs if name not in context}
+                running[pool.submit(_run_stage, st.func, st.inputs, values, options)] = st
+                pending.remove(st)
+            if not running:
+                missing = sorted({n for st in pending for n in st.inputs} - set(results))
+                raise RuntimeError(f"Unsatisfiable stage inputs: {missing}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                st = running.pop(future)
+                finish(st, *future.result(), cached=False)
+    replay()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Meebits metadata aggregation & rule derivation")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="parallel workers for parsing raw metadata (default: 1)")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread",
+                        help="pool type used when --workers > 1 (default: thread)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"ignore and do not write {CACHE_PATH}")
+    parser.add_argument("--verify-cache", action="store_true",
+                        help="also hash source file contents when validating the cache "
+                             "(names, sizes and mtimes are always checked)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="processes for running independent analysis stages, and shards "
+                             "with --shard-size (default: 1)")
+    parser.add_argument("--no-stage-cache", action="store_true",
+                        help=f"rerun every stage instead of reusing results from {STAGE_CACHE_DIR}/")
+    parser.add_argument("--json-style", choices=sorted(JSON_STYLES), default="pretty",
+                        help="formatting of exported JSON (default: pretty)")
+    parser.add_argument("--db-layout", choices=["records", "rows"], default="records",
+                        help="database JSON as record objects or a shared header plus rows "
+                             "(default: records)")
+    parser.add_argument("--compress", action="append", choices=["gz", "br"], default=[],
+                        help="also write content-hashed precompressed copies (repeatable)")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"time each step (wall, CPU, peak RSS); writes {PROFILE_PATH} and {PROFILE_TRACE_PATH}")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile, also tracemalloc each step (peak and top allocating lines); "
+                             "slows the run several-fold")
+    parser.add_argument("--cprofile", action="store_true",
+                        help=f"with --profile, also cProfile each step into {PROFILE_STATS_DIR}/")
+    parser.add_argument("--shard-size", type=int, metavar="RECORDS",
+                        help="out-of-core mode: count the collection in shards of this many records "
+                             "and analyze the merged counts (no database export, EM or three-way rules)")
+    parser.add_argument("--input-jsonl", metavar="PATH",
+                        help="with --shard-size, read records from a JSON lines file "
+                             "(e.g. meebits_generate.py output) instead of the raw metadata")
+    parser.add_argument("--sketch-width", type=int, nargs="?", const=SKETCH_WIDTH, metavar="COUNTERS",
+                        help="approximate the near-exclusion and bias stages with count-min and "
+                             "heavy-hitter sketches this wide (default with no value: "
+                             f"{SKETCH_WIDTH}), filled chunk by chunk (fixed memory; exact as it "
+                             "grows; warns when too narrow for the data); the other pairwise "
+                             "stages need exact counts and are skipped")
+    parser.add_argument("--sketch-depth", type=int, default=SKETCH_DEPTH,
+                        help=f"count-min rows with --sketch-width (default: {SKETCH_DEPTH})")
+    parser.add_argument("--min-gender-confidence", type=float, metavar="P",
+                        help="leave humans whose inferred gender has a lower posterior confidence "
+                             "out of the gender-stratified rules (e.g. 0.9)")
+    args = parser.parse_args(argv)
+    if args.input_jsonl and not args.shard_size:
+        parser.error("--input-jsonl requires --shard-size")
+    if args.sketch_width is not None and args.sketch_width < 1:
+        parser.error("--sketch-width must be positive")
+    if args.min_gender_confidence is not None and args.shard_size:
+        parser.error("--min-gender-confidence needs EM confidences, which --shard-size does not compute")
+    args.profile = args.profile or args.profile_memory or args.cprofile
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profile = None
+    if args.profile:
+        profile = PipelineProfile(ProfileOptions(
+            args.profile_memory, os.path.join(OUTPUT_DIR, PROFILE_STATS_DIR) if args.cprofile else None))
+    measure = profile.span if profile else (lambda name: contextlib.nullcontext())
+
+    print("=" * 60)
+    print("Meebits Metadata Aggregation & Rule Derivation (v3 - Comprehensive)")
+    print("=" * 60)
+
+    if args.shard_size:
+        # Steps 1-2 out of core: shards are read, gendered and counted in worker processes
+        if not args.input_jsonl and not os.path.isdir(INPUT_DIR):
+            sys.exit(f"--shard-size reads {INPUT_DIR} or --input-jsonl, and neither was found")
+        shards = (jsonl_shards(args.input_jsonl, args.shard_size) if args.input_jsonl
+                  else file_shards(args.shard_size))
+        print(f"\n[1/{PIPELINE_STEPS}] Counting {len(shards)} shards of up to {args.shard_size:,} records...")
+        sketch = SketchEngine(args.sketch_width, args.sketch_depth) if args.sketch_width else None
+        with measure("map_reduce"):
+            table, trait_classification = run_sharded(shards, args.jobs, sketch)
+        print(f"  Counted {len(table)} records")
+        if sketch:
+            report_sketch(sketch)
+        print(f"\n[2/{PIPELINE_STEPS}] Gender of Human meebits by trait vote (no EM across shards)...")
+        gender_counts, gender_trait_values = gender_stats(table)
+        gender_confidence = None
+        gender_table = table
+        for g in ["male", "female"]:
+            print(f"  {g}: {gender_counts.get(g, 0):,}")
+    else:
+        # Step 1: Load records (from the record cache, raw files or existing database)
+        cache_path = os.path.join(OUTPUT_DIR, CACHE_PATH)
+        fingerprint = source_fingerprint(verify_content=args.verify_cache)
+        with measure("load_records"):
+            table = None if args.no_cache else load_table_cache(cache_path, fingerprint)
+            cached_genders = None
+            if table is not None:
+                print(f"\n[1/{PIPELINE_STEPS}] Source unchanged. Memory-mapped {CACHE_PATH}...")
+                cached_genders = table.decode("gender")
+            else:
+                if os.path.isdir(INPUT_DIR):
+                    print(f"\n[1/{PIPELINE_STEPS}] Loading all 20,000 Meebit files from raw metadata...")
+                    records = load_all_meebits(workers=args.workers, executor=args.executor)
+                else:
+                    print(f"\n[1/{PIPELINE_STEPS}] Raw metadata not found. Loading from {DATABASE_PATH}...")
+                    records = load_from_database()
+                table = MeebitTable.from_records(records)
+                del records
+        print(f"  Loaded {len(table)} records")
+
+        # Step 2: Infer gender
+        print(f"\n[2/{PIPELINE_STEPS}] Inferring gender for Human meebits...")
+        gendered = run_stages(
+            [GENDER_STAGE], {"table": table}, profile=profile,
+            cache_dir=None if args.no_stage_cache else os.path.join(OUTPUT_DIR, STAGE_CACHE_DIR),
+            digests={"table": hashlib.sha256(
+                f"{table.content_hash()}:{source_digest(MeebitTable)}".encode()).hexdigest()})
+        (genders, gender_counts, trait_classification, gender_trait_values,
+         gender_confidence) = map(gendered.get, GENDER_STAGE.outputs)
+        table.set_column("gender", genders)
+        for g in ["male", "female"]:
+            print(f"  {g}: {gender_counts.get(g, 0):,}")
+        low_confidence = sum(1 for c in gender_confidence if c is not None and c < LOW_GENDER_CONFIDENCE)
+        print(f"  {low_confidence:,} humans below {LOW_GENDER_CONFIDENCE:.0%} confidence")
+        # Gender-stratified counts (the contingency engine) see only confident genders
+        gender_table, dropped = confident_genders(table, gender_confidence, args.min_gender_confidence)
+        if dropped:
+            print(f"  {dropped:,} humans below {args.min_gender_confidence:.0%} confidence "
+                  "left out of gender-stratified rules")
+    male_traits = sum(1 for v in trait_classification.values() if v == "male")
+    female_traits = sum(1 for v in trait_classification.values() if v == "female")
+    unisex_traits = sum(1 for v in trait_classification.values() if v == "unisex")
+    print(f"  Trait values: {male_traits} male-only, {female_traits} female-only, {unisex_traits} unisex")
+
+    # Shared pairwise contingency tables, stratified by type and gender. Built
+    # lazily: only needed if some engine-backed stage misses the stage cache.
+    def build_engine():
+        with measure("build_engine"):
+            engine = ContingencyEngine(gender_table).build()
+        print(f"  Cached {len(engine)} pairwise contingency tables")
+        return engine
+
+    # Fixed-size sketches for the approximate stages, with --sketch-width
+    def build_sketch():
+        with measure("build_sketch"):
+            sketch = SketchEngine.build(table, args.sketch_width, args.sketch_depth)
+        report_sketch(sketch)
+        return sketch
+
+    # Per-value bitsets over rows, also built only if a stage needs them
+    def build_bitmaps():
+        with measure("build_bitmaps"):
+            index = BitmapIndex.build(table)
+        print(f"  Indexed {sum(map(len, index.bitmaps.values()))} trait value bitmaps")
+        return index
+
+    export_options = ExportOptions(args.json_style, args.db_layout, tuple(sorted(set(args.compress))))
+
+    # Steps 3 onward run as a dependency graph (see PIPELINE_STAGES)
+    stages = PIPELINE_STAGES
+    skip, skipped_outputs = set(), {}
+    if args.sketch_width:
+        # Sketched stages read the sketches; no exact pair counts are built for the rest
+        stages = [st._replace(inputs=("sketch",)) if st.func.__name__ in SKETCH_STAGES else st
+                  for st in PIPELINE_STAGES]
+        skip, skipped_outputs = set(SKETCH_SKIP), SKETCH_SKIPPED_OUTPUTS
+    if args.shard_size:
+        # Merged counts stand in for both the table and the bitmap index
+        results = run_stages(stages,
+                             {"table": table, "engine": build_engine, "bitmaps": table,
+                              "sketch": sketch, "export_options": export_options, "gender_confidence": None,
+                              "multi_attribute": [], "three_way": [], "rarity": None, **skipped_outputs},
+                             jobs=args.jobs, skip=SHARDED_SKIP | skip, profile=profile)
+    else:
+        table_digest = table.content_hash()
+        digests = {
+            "export_options": hashlib.sha256(repr(export_options).encode()).hexdigest(),
+            "table": hashlib.sha256(f"{table_digest}:{source_digest(MeebitTable)}".encode()).hexdigest(),
+            "engine": hashlib.sha256(
+                f"{table_digest if gender_table is table else gender_table.content_hash()}:"
+                f"{source_digest(MeebitTable, ContingencyEngine)}".encode()).hexdigest(),
+            "bitmaps": hashlib.sha256(
+                f"{table_digest}:{source_digest(MeebitTable, BitmapIndex)}".encode()).hexdigest(),
+            "gender_confidence": hashlib.sha256(json.dumps(gender_confidence).encode()).hexdigest(),
+            "sketch": hashlib.sha256(
+                f"{table_digest}:{args.sketch_width}:{args.sketch_depth}:"
+                f"{source_digest(MeebitTable, SketchEngine, CountMinSketch, SpaceSaving)}".encode()).hexdigest(),
+        }
+
+        export = not (cached_genders is not None and cached_genders == table.decode("gender")
+                      and export_is_current(DATABASE_PATH, export_options)
+                      and export_is_current(QUIZ_COLUMNS_PATH, export_options)
+                      and export_is_current(QUIZ_POSTINGS_PATH, export_options))
+        results = run_stages(stages,
+                             {"table": table, "engine": build_engine, "bitmaps": build_bitmaps,
+                              "sketch": build_sketch,
+                              "export_options": export_options, "gender_confidence": gender_confidence,
+                              **skipped_outputs},
+                             jobs=args.jobs, skip=skip if export else skip | {"export_database"},
+                             cache_dir=None if args.no_stage_cache else os.path.join(OUTPUT_DIR, STAGE_CACHE_DIR),
+                             digests=digests, profile=profile)
+        if not export:
+            print("  Records unchanged since the cache was written, skipped export")
+        elif not args.no_cache:
+            if fingerprint["source"] == "database":
+                # The database we just wrote is the source for the next run
+                fingerprint = source_fingerprint(verify_content=args.verify_cache)
+            write_table_cache(cache_path, table, fingerprint)
+            print(f"\nWrote {cache_path}")
+
+    type_traits, type_counts = results["type_traits"], results["type_counts"]
+    exclusions, value_exclusions = results["exclusions"], results["value_exclusions"]
+    dependencies, value_dependencies = results["dependencies"], results["value_dependencies"]
+    conditional_probs = results["conditional_probs"]
+    cooccurrence, category_counts = results["cooccurrence"], results["category_counts"]
+    real_exclusions, gender_artifacts = results["real_exclusions"], results["gender_artifacts"]
+    gender_cond_probs = results["gender_cond_probs"]
+    per_type_pools, type_exclusive = results["per_type_pools"], results["type_exclusive"]
+    color_mappings, per_type_excl = results["color_mappings"], results["per_type_excl"]
+    jersey_analysis, tattoo_analysis = results["jersey_analysis"], results["tattoo_analysis"]
+    near_excl, comp_biases = results["near_excl"], results["comp_biases"]
+    three_way, deterministic = results["three_way"], results["deterministic"]
+    multi_attribute = results["multi_attribute"]
+    color_cooccurrence = results["color_cooccurrence"]
+    rarity = None if results["rarity"] is None else RarityScorer.from_state(table, results["rarity"])
 
     # Build and export rules
     print("\nExporting rules...")
-    rules = build_rules_json(
-        type_traits, type_counts, exclusions, value_exclusions,
-        dependencies, value_dependencies, conditional_probs,
-        gender_counts=gender_counts,
-        trait_classification=trait_classification,
-        gender_trait_values=gender_trait_values,
-        real_exclusions=real_exclusions,
-        gender_artifacts=gender_artifacts,
-        gender_cond_probs=gender_cond_probs,
-        per_type_pools=per_type_pools,
-        type_exclusive=type_exclusive,
-        color_mappings=color_mappings,
-        per_type_excl=per_type_excl,
-        jersey_analysis=jersey_analysis,
-        tattoo_analysis=tattoo_analysis,
-        near_excl=near_excl,
-        comp_biases=comp_biases,
-        three_way=three_way,
-        deterministic=deterministic,
-    )
-    rules_path = os.path.join(OUTPUT_DIR, "meebits_rules.json")
-    with open(rules_path, 'w') as f:
-        json.dump(rules, f, indent=2)
-    print(f"  Wrote {rules_path}")
-
-    report = build_report(
-        records, type_traits, type_counts, exclusions, value_exclusions,
-        dependencies, value_dependencies, conditional_probs,
-        cooccurrence, category_counts,
-        gender_counts=gender_counts,
-        trait_classification=trait_classification,
-        gender_trait_values=gender_trait_values,
-        real_exclusions=real_exclusions,
-        gender_artifacts=gender_artifacts,
-        gender_cond_probs=gender_cond_probs,
-        per_type_pools=per_type_pools,
-        type_exclusive=type_exclusive,
-        color_mappings=color_mappings,
-        per_type_excl=per_type_excl,
-        jersey_analysis=jersey_analysis,
-        tattoo_analysis=tattoo_analysis,
-        near_excl=near_excl,
-        comp_biases=comp_biases,
-        three_way=three_way,
-        deterministic=deterministic,
-    )
-    report_path = os.path.join(OUTPUT_DIR, "meebits_rules_report.md")
-    with open(report_path, 'w') as f:
-        f.write(report)
-    print(f"  Wrote {report_path}")
+    rule_inputs = (type_traits, type_counts, exclusions, value_exclusions,
+                   dependencies, value_dependencies, conditional_probs)
+    with measure("export_rules"):
+        rule_options = dict(
+            gender_counts=gender_counts,
+            trait_classification=trait_classification,
+            gender_trait_values=gender_trait_values,
+            real_exclusions=real_exclusions,
+            gender_artifacts=gender_artifacts,
+            gender_cond_probs=gender_cond_probs,
+            per_type_pools=per_type_pools,
+            type_exclusive=type_exclusive,
+            color_mappings=color_mappings,
+            per_type_excl=per_type_excl,
+            jersey_analysis=jersey_analysis,
+            tattoo_analysis=tattoo_analysis,
+            near_excl=near_excl,
+            comp_biases=comp_biases,
+            three_way=three_way,
+            deterministic=deterministic,
+            multi_attribute=multi_attribute,
+            color_cooccurrence=color_cooccurrence,
+            min_gender_confidence=args.min_gender_confidence,
+        )
+        rules = build_rules_json(*rule_inputs, **rule_options)
+        rules_path = os.path.join(OUTPUT_DIR, "meebits_rules.json")
+        entry = write_stream(rules_path, json.JSONEncoder(**JSON_STYLES[export_options.style]).iterencode(rules),
+                             export_options.compress)
+        update_export_manifest("meebits_rules.json", entry, export_options)
+        print(f"  {'Wrote' if entry['changed'] else 'Unchanged'} {rules_path} ({entry['bytes']:,} bytes)")
+        for suffix in ("gz", "br"):
+            if suffix in entry:
+                print(f"  Wrote {os.path.join(OUTPUT_DIR, entry[suffix])}")
+
+    # Every rule, untruncated, plus the records (not in sharded mode), for paginated queries
+    full_rules = build_rules_json(*rule_inputs, **rule_options, full=True)
+    with measure("export_rule_store"):
+        store_path = os.path.join(OUTPUT_DIR, RULE_STORE_PATH)
+        entry = export_rule_store(full_rules, None if args.shard_size else table, gender_confidence)
+        update_export_manifest(RULE_STORE_PATH, entry, export_options)
+        print(f"  {'Wrote' if entry['changed'] else 'Unchanged'} {store_path} ({entry['bytes']:,} bytes)")
+
+    # Per-token rarity scores and ranks (not in sharded mode)
+    if rarity is not None:
+        with measure("export_rarity"):
+            rarity_path = os.path.join(OUTPUT_DIR, RARITY_PATH)
+            entry = export_rarity(rarity, export_options)
+            print(f"  {'Wrote' if entry['changed'] else 'Unchanged'} {rarity_path} ({entry['bytes']:,} bytes)")
+
+    # Precompiled compatibility bitsets for the Builder, from every exclusion rule
+    with measure("export_builder_index"):
+        index_path = os.path.join(OUTPUT_DIR, BUILDER_INDEX_PATH)
+        entry = write_stream(index_path, json.JSONEncoder(**JSON_STYLES[export_options.style]).iterencode(
+            build_builder_index(full_rules)), export_options.compress)
+        update_export_manifest(BUILDER_INDEX_PATH, entry, export_options)
+        print(f"  {'Wrote' if entry['changed'] else 'Unchanged'} {index_path} ({entry['bytes']:,} bytes)")
+
+    with measure("build_report"):
+        report = build_report(
+            table, type_traits, type_counts, exclusions, value_exclusions,
+            dependencies, value_dependencies, conditional_probs,
+            cooccurrence, category_counts,
+            gender_counts=gender_counts,
+            gender_confidence=gender_confidence,
+            trait_classification=trait_classification,
+            gender_trait_values=gender_trait_values,
+            real_exclusions=real_exclusions,
+            gender_artifacts=gender_artifacts,
+            gender_cond_probs=gender_cond_probs,
+            per_type_pools=per_type_pools,
+            type_exclusive=type_exclusive,
+            color_mappings=color_mappings,
+            per_type_excl=per_type_excl,
+            jersey_analysis=jersey_analysis,
+            tattoo_analysis=tattoo_analysis,
+            near_excl=near_excl,
+            comp_biases=comp_biases,
+            three_way=three_way,
+            deterministic=deterministic,
+            multi_attribute=multi_attribute,
+            color_cooccurrence=color_cooccurrence,
+            rarity=rarity,
+        )
+        report_path = os.path.join(OUTPUT_DIR, "meebits_rules_report.md")
+        if write_if_changed(report_path, report):
+            print(f"  Wrote {report_path}")
+        else:
+            print(f"  Unchanged {report_path}")
+
+    if profile:
+        timeline = profile.write(os.path.join(OUTPUT_DIR, PROFILE_PATH),
+                                 os.path.join(OUTPUT_DIR, PROFILE_TRACE_PATH))
+        print(f"\nProfile ({timeline['wall_seconds']:.2f}s wall, {timeline['main_cpu_seconds']:.2f}s main-process CPU):")
+        measured = sorted((r for r in timeline["spans"] if "share" in r), key=lambda r: -r["wall_seconds"])
+        for r in measured[:PROFILE_SUMMARY_ROWS]:
+            traced = f" {r['traced_peak_bytes'] / 2**20:9.1f} MiB" if "traced_peak_bytes" in r else ""
+            print(f"  {r['name']:<40} {r['wall_seconds']:9.3f}s {r['share']:7.1%}{traced}")
+        print(f"  {'(outside any step)':<40} {timeline['unmeasured_seconds']:9.3f}s")
+        if timeline["overhead_seconds"]:
+            print(f"  {'(profiling overhead, not in shares)':<40} {timeline['overhead_seconds']:9.3f}s")
+        cached = sum(1 for r in timeline["spans"] if r.get("cached"))
+        if cached:
+            print(f"  ({cached} stages loaded from {STAGE_CACHE_DIR}/; --no-stage-cache to measure them)")
+        print(f"  Wrote {os.path.join(OUTPUT_DIR, PROFILE_PATH)} and {os.path.join(OUTPUT_DIR, PROFILE_TRACE_PATH)}")
 
     print("\nDone!")
 
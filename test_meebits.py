@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Checks of MeebitRecord, rarity state, the query service, the rule store
+and sharded counts against brute-force references on a small seeded
+synthetic collection.
+
+    python -m unittest test_meebits
+"""
+
+import contextlib
+import io
+import json
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from contextlib import closing
+from http.server import ThreadingHTTPServer
+from itertools import combinations
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import process_meebits
+from meebits_query import (ARCHETYPE_FIELDS, QueryHandler, QueryIndex, QuizRetriever, parse_cli_terms,
+                           parse_terms)
+from process_meebits import (QUIZ_CATEGORY_IMPORTANCE, QUIZ_SCORED_CATEGORIES, QUIZ_TYPE_RARE_BOOST,
+                             RARITY_MODELS, RECORD_FIELDS, RULE_STORE_PATH, TRAIT_CATEGORIES, MeebitRecord,
+                             MeebitTable, RarityScorer, analyze_rarity, export_rule_store, jsonl_shards,
+                             query_rules, run_sharded)
+
+TYPES = ["Human", "Human", "Human", "Pig", "Elephant", "Robot", "Visitor"]
+
+
+def synthetic_records(n, seed=0):
+    """n flat record dicts with a few values per category and some missing."""
+    rng = random.Random(seed)
+    records = []
+    for token_id in range(1, n + 1):
+        record = {"token_id": token_id, "type": rng.choice(TYPES)}
+        for cat in TRAIT_CATEGORIES:
+            if rng.random() < 0.7:
+                record[cat] = f"{cat}-{rng.randrange(4)}"
+        if record["type"] != "Human":
+            record.pop("beard", None)
+        records.append(record)
+    return records
+
+
+def score_meebit(meebit, profile, prefer_none):
+    """scoreMeebit from MeebitQuiz.jsx, one record at a time."""
+    score = max_possible = 0
+    type_prefs = profile.get("type") or {}
+    if type_prefs:
+        importance = QUIZ_CATEGORY_IMPORTANCE["type"]
+        raw = (type_prefs.get(meebit["type"]) or 0) * QUIZ_TYPE_RARE_BOOST.get(meebit["type"], 1)
+        max_raw = max(w * QUIZ_TYPE_RARE_BOOST.get(t, 1) for t, w in type_prefs.items())
+        score += raw / max(max_raw, 1) * importance
+        max_possible += importance
+    for cat in QUIZ_SCORED_CATEGORIES[1:]:
+        importance = QUIZ_CATEGORY_IMPORTANCE.get(cat, 1.0)
+        value = meebit.get(cat)
+        if cat in prefer_none:
+            if not value:
+                score += importance
+            max_possible += importance
+            continue
+        prefs = profile.get(cat)
+        if not prefs:
+            continue
+        if value and prefs.get(value):
+            score += prefs[value] / max(prefs.values()) * importance
+        max_possible += importance
+    return score / max_possible * 100 if max_possible > 0 else 50
+
+
+def rank_meebits(records, profile, prefer_none, k):
+    """rankMeebits: stable sort by score, then one result per archetype."""
+    scored = sorted(((score_meebit(r, profile, prefer_none), r) for r in records), key=lambda x: -x[0])
+    results, seen = [], set()
+    for score, record in scored:
+        key = tuple(record.get(f) for f in ARCHETYPE_FIELDS)
+        if key not in seen:
+            seen.add(key)
+            results.append((score, record["token_id"]))
+            if len(results) == k:
+                break
+    return results
+
+
+class MeebitRecordTest(unittest.TestCase):
+    def test_mapping(self):
+        flat = synthetic_records(1)[0]
+        record = MeebitRecord.from_dict(flat)
+        as_dict = {f: flat.get(f) for f in RECORD_FIELDS}
+        self.assertEqual(dict(record), as_dict)
+        self.assertEqual(list(record), RECORD_FIELDS)
+        self.assertEqual(dict(record.items()), as_dict)
+        self.assertEqual(list(record.values()), list(as_dict.values()))
+        self.assertIn("hat", record)
+        self.assertNotIn(record["type"], record)
+        self.assertEqual((record["type"], record.get("no_such_field", "-"), record[0]),
+                         (flat["type"], "-", flat["token_id"]))
+
+    def test_tuple_helpers(self):
+        record = MeebitRecord.from_dict(synthetic_records(1)[0])
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+        self.assertEqual(record._replace(hat="Cap").hat, "Cap")
+        self.assertEqual(record._asdict(), dict(record))
+        with self.assertRaises(ValueError):
+            record._replace(no_such_field=1)
+
+
+class RarityStateTest(unittest.TestCase):
+    def test_state_round_trip(self):
+        table = MeebitTable.from_records(synthetic_records(500, seed=4))
+        scorer = RarityScorer(table)
+        rebuilt = RarityScorer.from_state(table, pickle.loads(pickle.dumps(analyze_rarity(table))))
+        for model in RARITY_MODELS:
+            self.assertEqual(rebuilt.leaderboard(model, 50), scorer.leaderboard(model, 50))
+            self.assertEqual(rebuilt.ranks(model), scorer.ranks(model))
+        weights = {"hat": 2.0, "type": 0.5}
+        self.assertEqual(rebuilt.set_weights(weights), scorer.set_weights(weights))
+        for model in RARITY_MODELS:
+            self.assertEqual(rebuilt.leaderboard(model, 50), scorer.leaderboard(model, 50))
+
+
+class QueryIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.records = synthetic_records(2000)
+        cls.index = QueryIndex(MeebitTable.from_records(cls.records))
+
+    def check(self, terms):
+        matches = [r["token_id"] for r in self.records
+                   if all(r.get(col) in values for col, values in terms.items())]
+        result = self.index.query(terms, limit=len(self.records))
+        self.assertEqual(result["count"], len(matches))
+        self.assertEqual(result["token_ids"], matches)
+        for col in ("hat", "type"):
+            expected = Counter(r.get(col) for r in self.records if r["token_id"] in set(matches))
+            self.assertEqual(result["histograms"][col], dict(expected))
+
+    def test_single_value(self):
+        self.check({"hat": ["hat-1"]})
+
+    def test_or_within_and_across_columns(self):
+        self.check({"hat": ["hat-0", "hat-2"], "type": ["Human"], "shirt": ["shirt-3"]})
+
+    def test_missing_value(self):
+        self.check({"glasses": [None], "pants": ["pants-1", None]})
+
+    def test_no_match(self):
+        self.check({"hat": ["hat-0"], "type": ["No such type"]})
+
+    def test_limit(self):
+        result = self.index.query({"type": ["Human"]}, limit=5, histograms=False)
+        self.assertEqual(len(result["token_ids"]), 5)
+        self.assertNotIn("histograms", result)
+
+    def test_unknown_column(self):
+        with self.assertRaises(KeyError):
+            self.index.query({"no_such_category": ["x"]})
+
+
+class QueryFrontEndTest(unittest.TestCase):
+    """The CLI's term parser and the HTTP server, end to end."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.records = synthetic_records(1000, seed=3)
+        cls.query_index = QueryIndex(MeebitTable.from_records(cls.records))
+        QueryHandler.query_index = cls.query_index
+        QueryHandler.retriever = QuizRetriever(cls.query_index.index)
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), QueryHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def get(self, path, params):
+        url = f"http://127.0.0.1:{self.server.server_port}{path}?{urlencode(params, doseq=True)}"
+        with contextlib.redirect_stderr(io.StringIO()), urlopen(url) as response:
+            return json.load(response)
+
+    def count(self, **terms):
+        return sum(all(r.get(col) in values for col, values in terms.items()) for r in self.records)
+
+    def test_parse_cli_terms(self):
+        self.assertEqual(parse_cli_terms(["hat=hat-1", "hat=", "shirt=a=b"], ["Pig"], ["male"]),
+                         {"hat": ["hat-1", None], "shirt": ["a=b"], "type": ["Pig"], "gender": ["male"]})
+        self.assertEqual(parse_terms([("hat", "")]), {"hat": [None]})
+        with self.assertRaises(ValueError):
+            parse_cli_terms(["hat"])
+
+    def test_cli_query(self):
+        result = self.query_index.query(parse_cli_terms(["hat=hat-1", "hat="], ["Human"]), histograms=False)
+        self.assertEqual(result["count"], self.count(hat=["hat-1", None], type=["Human"]))
+
+    def test_http_query(self):
+        served = self.get("/query", [("hat", "hat-2"), ("hat", ""), ("type", "Pig"), ("histograms", 0)])
+        self.assertEqual(served["count"], self.count(hat=["hat-2", None], type=["Pig"]))
+        self.assertEqual(served["query"], {"hat": ["hat-2", None], "type": ["Pig"]})
+        self.assertNotIn("histograms", served)
+
+    def test_http_errors(self):
+        for params in ({"no_such_category": "x"}, {"hat": "hat-1", "limit": "many"}):
+            with self.assertRaises(HTTPError) as caught, contextlib.redirect_stderr(io.StringIO()):
+                self.get("/query", params)
+            self.assertEqual(caught.exception.code, 400)
+            caught.exception.close()
+
+
+class QuizRetrieverTest(unittest.TestCase):
+    PROFILES = [
+        ({"type": {"Pig": 1.5, "Robot": 1.0}, "hat": {"hat-1": 2.0, "hat-2": 1.0},
+          "shirt": {"shirt-0": 2.5}}, ()),
+        ({"shoes": {"shoes-3": 1.0}, "glasses": {"glasses-0": 1.5}}, ("hat", "earring")),
+        ({"type": {"Visitor": 1.0}}, ("beard",)),
+        ({}, ()),
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.records = synthetic_records(3000, seed=1)
+        cls.retriever = QuizRetriever(QueryIndex(MeebitTable.from_records(cls.records)).index)
+
+    def test_matches_brute_force(self):
+        for profile, prefer_none in self.PROFILES:
+            for k in (1, 6, 25):
+                with self.subTest(profile=profile, prefer_none=prefer_none, k=k):
+                    expected = rank_meebits(self.records, profile, set(prefer_none), k)
+                    results = self.retriever.rank(profile, prefer_none, k)["results"]
+                    self.assertEqual([r["meebit"]["token_id"] for r in results], [t for _, t in expected])
+                    for result, (score, _) in zip(results, expected):
+                        self.assertAlmostEqual(result["score"], score, places=9)
+
+
+class RuleStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(prefix="meebits_test_")
+        self.saved_output_dir = process_meebits.OUTPUT_DIR
+        process_meebits.OUTPUT_DIR = self.output_dir
+        self.rules = {
+            "metadata": {"total_meebits": 3},
+            "value_exclusion_rules_all_population": [
+                {"trait_a": f"hat=hat-{i}", "trait_b": f"shirt=shirt-{i % 7}", "count_a": i}
+                for i in range(250)],
+            "per_type_exclusion_rules": {
+                "Pig": [{"trait_a": "hat=hat-0", "trait_b": "pants=pants-1"}]},
+            "comprehensive_pairwise_biases": [
+                {"category_pair": "shirt + hat", "total_records": 100,
+                 "biases": [{"trait_a": "shirt=shirt-1", "trait_b": "hat=hat-3", "ratio": 2.0}]}],
+        }
+
+    def tearDown(self):
+        process_meebits.OUTPUT_DIR = self.saved_output_dir
+        shutil.rmtree(self.output_dir)
+
+    def connect(self):
+        return sqlite3.connect(os.path.join(self.output_dir, RULE_STORE_PATH))
+
+    def pages(self, conn, **filters):
+        rules, after = [], 0
+        while after is not None:
+            page = query_rules(conn, after=after, limit=100, **filters)
+            self.assertLessEqual(len(page["rules"]), 100)
+            rules += page["rules"]
+            after = page["next"]
+        return rules
+
+    def test_round_trip(self):
+        self.assertTrue(export_rule_store(self.rules)["changed"])
+        self.assertFalse(export_rule_store(self.rules)["changed"])
+        with closing(self.connect()) as conn:
+            rules = self.pages(conn)
+            self.assertEqual([r["id"] for r in rules], list(range(1, 253)))
+            self.assertEqual([r["rule"] for r in rules[:250]], self.rules["value_exclusion_rules_all_population"])
+            self.assertEqual(json.loads(conn.execute("SELECT data FROM sections WHERE name = 'metadata'")
+                                        .fetchone()[0]), self.rules["metadata"])
+
+    def test_filters(self):
+        export_rule_store(self.rules)
+        with closing(self.connect()) as conn:
+            self.assertEqual(len(self.pages(conn, kind="value_exclusion")), 250)
+            self.assertEqual(len(self.pages(conn, kind="value_exclusion", trait="shirt=shirt-3")), 36)
+            self.assertEqual([r["kind"] for r in self.pages(conn, type_name="Pig")], ["type_exclusion"])
+            biases = self.pages(conn, category_pair="hat + shirt", kind="pairwise_bias")
+            self.assertEqual([r["rule"]["ratio"] for r in biases], [2.0])
+            self.assertEqual(biases[0]["rule"]["total_records"], 100)
+
+
+class ShardedMergeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.records = synthetic_records(500, seed=2)
+        cls.table = MeebitTable.from_records(cls.records)
+        cls.tmp = tempfile.mkdtemp(prefix="meebits_test_")
+        cls.path = os.path.join(cls.tmp, "records.jsonl")
+        with open(cls.path, "w") as f:
+            for record in cls.records:
+                f.write(json.dumps(record) + "\n")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    @staticmethod
+    def decoded(counts, *cols):
+        tensor = counts.joint_counts(*cols, include_missing=True)
+        return Counter({tuple(counts.values(c)[v] for c, v in zip(cols, key)): n for key, n in tensor.items()})
+
+    def test_shards_match_one_shard(self):
+        whole, whole_classification = run_sharded(jsonl_shards(self.path, len(self.records)))
+        merged, classification = run_sharded(jsonl_shards(self.path, 37))
+        self.assertEqual(classification, whole_classification)
+        self.assertEqual(merged.dictionaries, whole.dictionaries)
+        self.assertEqual(merged.first_rows, whole.first_rows)
+        for cat_a, cat_b in combinations(TRAIT_CATEGORIES, 2):
+            self.assertEqual(merged.tensors[cat_a, cat_b], whole.tensors[cat_a, cat_b])
+
+    def test_matches_table(self):
+        merged, _ = run_sharded(jsonl_shards(self.path, 64))
+        self.assertEqual(len(merged), len(self.table))
+        for col in ("type", "hat", "tattoo_motif"):
+            self.assertEqual(list(merged.value_counts(col).items()), list(self.table.value_counts(col).items()))
+        for cat_a, cat_b in [("hat", "shirt"), ("beard", "glasses"), ("shoes", "jersey_number")]:
+            self.assertEqual(self.decoded(merged, "type", cat_a, cat_b),
+                             self.decoded(self.table, "type", cat_a, cat_b))
+        pigs = self.table.where("type", "Pig")
+        self.assertEqual(merged.where("type", "Pig").count_present("hat", "shirt"),
+                         pigs.count_present("hat", "shirt"))
+        self.assertEqual(merged.where("type", "Pig").first_present(TRAIT_CATEGORIES),
+                         pigs.first_present(TRAIT_CATEGORIES))
+        self.assertEqual(merged.first_present(TRAIT_CATEGORIES), self.table.first_present(TRAIT_CATEGORIES))
+
+
+if __name__ == "__main__":
+    unittest.main()